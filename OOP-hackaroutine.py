@@ -1,790 +1,5929 @@
 import numpy as np
+import scipy.sparse
 # import pandas as pd
+import os
 import re
+import mmap
+import bisect
+import csv
+import functools
+import io
+import json
 import time
-import pickle
+import zlib
+import random
+import atexit
+import gc
+import asyncio
+import contextlib
+import sqlite3
+import platform
+import threading
+import tracemalloc
+import uuid
+try:
+    import fcntl
+except ImportError:     # Windows: logs of other processes are left alone
+    fcntl = None
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 # from glob import glob
 # from string import punctuation
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from collections.abc import Mapping
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+from pyquery.text import extract_text
 
 import requests
-from requests_html import HTMLSession
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests_html import HTML, HTMLSession, AsyncHTMLSession
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.neighbors import NearestNeighbors
 
 
+# bundled data lives next to this file, wherever it is run from
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
 class OrderedCounter(Counter, OrderedDict):
     # no additional code is needed to combine these objects
     pass
 
 
-class CosDNA(HTMLSession):
-    '''
-    Parent class for connecting to CosDNA.com database.
-    Not intended to be used on its own.
-    '''
+# why a Product() or Ingredient() could not be linked or synced
+# stage: 'search', 'sync' or 'parse'
+# kind: exception class name, message: exception message
+Failure = namedtuple('Failure', ['stage', 'url', 'kind', 'message'])
 
-    with open('./data/master_dict.pickle', 'rb') as handle:
-        master_dict = pickle.load(handle)
+# ingredients of every product in a routine
+# matrix: scipy.sparse CSC matrix of products x ingredients, holding how
+#     many times product i lists the ingredient of column j
+# columns: Interner code of every column, sorted
+# codes, offsets: product i lists the Interner codes
+#     codes[offsets[i]:offsets[i+1]], in page order
+ProductVectors = namedtuple('ProductVectors',
+                            ['matrix', 'columns', 'codes', 'offsets'])
 
-    def __init__(self, name=None):
-        super().__init__()
-        self._name = name
-        self._synced = False    # synced in child classes
 
+# raised by the parse_*_page() functions when a page is not laid out as
+# expected; recorded as a 'parse' Failure()
+PARSE_ERRORS = (AttributeError, IndexError, TypeError, ValueError)
 
-class Cosmetic(CosDNA):
+
+class CircuitOpen(requests.exceptions.ConnectionError):
     '''
-    Parent class for organizing Products and Ingredients from CosDNA.com.
-    Not intended to be used on its own.
+    Raised instead of sending a request while CircuitBreaker is open
     '''
+    pass
 
-    domain = 'https://cosdna.com'
 
-    product_stop_words = [
-        'cleanser',
-        'cream',
-        'lotion',
-        'mask',
-        'masque',
-        'moisturizer',
-        'serum',
-        'sunblock',
-        'sunscreen',
-        'toner',
-        'treatment'
-    ]
+class ResponseCache():
+    '''
+    Disk-backed cache of HTTP responses keyed by URL.
 
-    sort_dict = {
-        'latest': '&sort=date',
-        'featured': '&sort=featured',
-        'clicks': '&sort=click',
-        'reviews': '&sort=review'
-    }
+    Responses are stored in a SQLite file. Entries younger than `ttl` are
+    served without touching the network; older entries are revalidated
+    with their ETag / Last-Modified headers, so an unchanged page costs a
+    304 instead of a full download. When the stored bodies exceed
+    `max_size` bytes, the least recently used entries are evicted.
 
+    Parameters
+    ----------
+    path : str, default DATA_DIR/cache/responses.sqlite
+        Location of the cache file. Created on first use
 
-    def __init__(self, name=None, cosdna_url=None, cosdna_id=None):
-        super().__init__(name)
-        self._cosdna_url = cosdna_url
-        self._cosdna_id = cosdna_id
-        self._skip = False
+    ttl : float, default 604800 (one week)
+        Seconds an entry is served without revalidation
 
-    def link(self, sort=None, cosdna_url=None, _base_url=None):
-        '''
-        Updates self._cosdna_url if cosdna_url is valid.
-        If cosdna_url blank, checks if self._cosdna_url is valid
-        If self._cosdna_url blank, searches for CosDNA URL
-        '''
-        if cosdna_url:
-            self._set_cosdna_url(cosdna_url)
-        elif not self.cosdna_url:
-            self._search(sort=sort, _base_url=_base_url)
+    max_size : int, default 256 MB
+        Maximum total size of stored (compressed) bodies in bytes
 
-    def _search(self, sort=None, _base_url=None):
+    >>> cache = CosDNA.transport.cache
+    >>> cache.stats
+    Counter({'hits': 10, 'misses': 2, 'stores': 2})
+    '''
+
+    cacheable = (200, 203, 300, 301, 302, 307, 308)
+
+    def __init__(self,
+                 path=os.path.join(DATA_DIR, 'cache', 'responses.sqlite'),
+                 ttl=604800, max_size=256 * 2**20):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = Counter()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    status INTEGER,
+                    headers TEXT,
+                    body BLOB,
+                    etag TEXT,
+                    last_modified TEXT,
+                    stored_at REAL,
+                    accessed_at REAL,
+                    size INTEGER
+                )''')
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS responses_accessed
+                ON responses (accessed_at)''')
+            self._conn.commit()
+        return self._conn
+
+    def lookup(self, url):
         '''
-        self.link() > _search()
-        Makes a GET request to search_url
-        Child classes define more actions
+        Returns the cached entry for url as a dict, or None
         '''
-        # self._query defined in child classes
-        if self._query and not self._skip:
-            search_url = self._get_search_url(query=self._query,
-                                              sort=sort,
-                                              _base_url=_base_url)
-            self._r = self.get(search_url)
-            top = self._r.html.find('td', first=True)   # top result
-            if top:
-                self._cosdna_url = (Cosmetic.domain
-                                    + top.xpath('//a/@href', first=True))
-                return self
-            else:
-#                 temp_query = self._query.split(' ')
-#                 temp_query = ' '.join([w for w in temp_query if w not in Cosmetic.stop_words])
-#                 temp_search_url = self._get_search_url(sort, temp_query, _base_url)
-                # no result
-                if self._r.html.find('.text-danger'):
-                    print(f'No results for {self._name} on CosDNA.')
-                    print("Enter new search (to skip search, enter 'SKIP' w/o quotes):")
-                    self._query = input(' ')
-                    if self._query == 'SKIP':
-                        self._skip = True
-                        return self
-                    else:
-                        return self._search(sort=sort, _base_url=_base_url)
-                else:
-                    self._cosdna_url = self._r.url
-                    return self
-        else:
-            print('Link with valid CosDNA URL or product name to proceed.')
-            return self
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT status, headers, body, etag, last_modified, '
+                'stored_at FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE responses SET accessed_at = ? WHERE url = ?',
+                (time.time(), url)
+            )
+            self.conn.commit()
+        status, headers, body, etag, last_modified, stored_at = row
+        return {
+            'url': url,
+            'status': status,
+            'headers': json.loads(headers),
+            'body': zlib.decompress(body),
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': time.time() - stored_at < self.ttl,
+        }
 
-    def _get_search_url(self, query, sort=None, _base_url=None):
+    def store(self, url, response):
         '''
-        self.link() > _search() > _get_search_url()
-        Generates a php search_url directly from query
-        Child classes define _base_url
+        Stores a requests.Response under url and evicts old entries
         '''
-        query = re.sub("[^a-z0-9\s\-\']", '', query.lower())
-        query = re.sub('([a-z])\-([a-z])', r'\1 \2', query)
-        query = query.replace(' ', '+')
-        # _base_url defined in child classes
-        # Product() has different sort options, Ingredient() does not
-        if sort in [*Cosmetic.sort_dict]:
-            search_url = _base_url + query + Cosmetic.sort_dict[sort]
-        else:
-            search_url = _base_url + query
-        return search_url
+        if response.status_code not in ResponseCache.cacheable:
+            return
+        body = zlib.compress(response.content)
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, response.status_code, json.dumps(dict(response.headers)),
+                 body, response.headers.get('ETag'),
+                 response.headers.get('Last-Modified'), now, now, len(body))
+            )
+            self.conn.commit()
+            self.stats['stores'] += 1
+            self._evict()
 
-    def sync(self):
+    def refresh(self, url):
         '''
-        Sets up scrape from linked url
-        Child classes define more actions
+        Marks the entry for url as fresh after a 304 Not Modified
         '''
-        if self._skip:
-            pass
-        elif self.cosdna_url:
-            # child classes define more actions
-            self._r = self.get(self.cosdna_url)
-        else:
-            print('Initialize or link with valid CosDNA URL to proceed')
-        return self
-
-    # @property
-    # def cosdna_url(self):
-    #     return self._check_url(self._cosdna_url)
-
-    # def _set_cosdna_url(self, url=None):
-    #     if url:
-    #         if _check_url(url):
-    #             self._cosdna_url = _check_url(url)
-
-
+        with self._lock:
+            self.conn.execute(
+                'UPDATE responses SET stored_at = ? WHERE url = ?',
+                (time.time(), url)
+            )
+            self.conn.commit()
 
-    @property
-    def cosdna_id(self):
+    def _evict(self):
         '''
-        Returns a unique ingredient identifier based on the URL
-
-        Aliases of the same ingredient point to the same URL in the CosDNA
-        database. In the absence of our own relational database, we rely on
-        this identifier to collapse multiple aliases into a single entry,
-        allowing us to:
-        - collapse aliases together when analyzing routines
-        - search for aliases
+        Helper function for self.store()
+        Deletes least recently used entries until under self.max_size
         '''
-        if not self._cosdna_id:
-            if self.cosdna_url:
-                return re.findall("eng/(.*).html", self.cosdna_url)[0]
-            else:
-                self._cosdna_id = 'unavailable'
-        return self._cosdna_id
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.conn.execute(
+            'SELECT url, size FROM responses ORDER BY accessed_at'
+        )
+        evict = []
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            evict.append((url,))
+            total -= size
+        self.conn.executemany('DELETE FROM responses WHERE url = ?', evict)
+        self.conn.commit()
+        self.stats['evictions'] += len(evict)
 
-    # linked and synced defined as properties
-    # since Routine() will not share this behavior
-    @property
-    def linked(self):
-        if self.cosdna_url:
-            return True
-        else:
-            return False
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+        self.stats.clear()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses') \
+                   .fetchone()[0]
 
     @property
-    def synced(self):
-        return self._synced
+    def size(self):
+        return self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
 
 
-class Ingredient(Cosmetic):
+class RateLimiter():
     '''
-    Syncs and stores ingredient information from CosDNA.com.
+    Paces every request to CosDNA.com. Thread-safe.
 
-    Search for ingredients based on name, link to CosDNA page, and scrape
-    information to store in instance.
+    Combines three mechanisms:
+    - a token bucket allowing `rate` requests per second on average, with
+      bursts of up to `burst` requests
+    - an AIMD limit on requests in flight: the limit grows by 1/limit after
+      each response faster than `target_latency`, and is multiplied by
+      `decrease` after each slower response or throttled response
+    - a pause after HTTP 429/503 responses, for as long as the server's
+      Retry-After header asks, or an exponential backoff without one,
+      never longer than `max_pause`
 
     Parameters
     ----------
-    name : str, default None
-        Name of ingredient.
+    rate : float, default 4.0
+        Average requests per second
 
-    cas_no : str, default None
-        CAS Registry Number
+    burst : int, default 8
+        Size of the token bucket
 
-    cosdna_url : str, default None
-        URL of ingredient in CosDNA database
+    max_concurrency : int, default 8
+        Upper bound of the AIMD limit on requests in flight
 
-    >>> i = Ingredient('salicylic acid')
-    >>> i.name                                     # returns assigned name
-    'salicylic acid'
-    >>> i.link_sync()                              # scrapes top result
-    >>> i.name                                     # returns CosDNA name
-    'bha'
+    target_latency : float, default 1.0
+        Responses slower than this (seconds) decrease the limit
 
-    >>> i.link('https://cosdna.com/eng/0f1b7f1402.html')    # directly update link
-    >>> i.sync()
-    >>> i.name
-    'capryloyl salicylic acid'
+    decrease : float, default 0.5
+        Multiplicative decrease factor
+
+    backoff : float, default 1.0
+        Initial pause (seconds) after a 429/503 without Retry-After. Doubles
+        on each consecutive throttled response, up to max_backoffs times
+
+    max_backoffs : int, default 5
+        Times CosDNAAdapter re-sends a throttled request before returning
+        the 429/503 response
+
+    max_pause : float, default 60.0
+        Longest pause (seconds) after a throttled response, whether from
+        Retry-After or the backoff
     '''
 
-    def __init__(self, name=None, cas_no=None, cosdna_url=None,
-                 cosdna_id=None):
-        super().__init__(name=name, cosdna_url=cosdna_url, cosdna_id=cosdna_id)
-        self.cas_no = cas_no
+    throttled = (429, 503)
 
-    def link(self, cosdna_url=None):
+    def __init__(self, rate=4.0, burst=8, max_concurrency=8,
+                 target_latency=1.0, decrease=0.5, backoff=1.0,
+                 max_backoffs=5, max_pause=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_backoffs = max_backoffs
+        self.max_pause = max_pause
+        self.limit = float(max_concurrency)
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.stats = Counter()
+        self._strikes = 0           # consecutive throttled responses
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
         '''
-        Links Ingredient() to cosdna_url
+        Blocks until a request may be sent
+        '''
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.in_flight >= int(self.limit):
+                        wait = None     # until release()
+                    elif self.tokens < 1:
+                        wait = (1 - self.tokens) / self.rate
+                    else:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        return
+                self.stats['waits'] += 1
+                self._cond.wait(wait)
+
+    def release(self, status=None, latency=None, retry_after=None):
+        '''
+        Records the outcome of a request sent after acquire()
 
         Parameters
         ----------
-        cosdna_url : str, default None
-            CosDNA URL of ingredient
-            If cosdna_url is None, searches for cosdna_url using either:
-                - cas_no (preferential), or
-                - name
+        status : int, default None
+            HTTP status code. None if the request failed without a response
+
+        latency : float, default None
+            Seconds between sending the request and receiving the response
+
+        retry_after : str, default None
+            Value of the Retry-After response header
         '''
-        # self._query separated from self._name
-        # to give priority to search via CAS No.
-        if self.cas_no:
-            self._query = self.cas_no
-        else:
-            self._query = self._name
-        return super().link(sort=None, cosdna_url=cosdna_url,
-                            _base_url='https://cosdna.com/eng/stuff.php?q=')
+        with self._cond:
+            self.in_flight -= 1
+            if status in RateLimiter.throttled:
+                self.stats['throttled'] += 1
+                self.limit = max(1.0, self.limit * self.decrease)
+                pause = self._parse_retry_after(retry_after)
+                if pause is None:
+                    pause = self.backoff * 2**self._strikes
+                pause = min(pause, self.max_pause)
+                self._strikes = min(self._strikes + 1, self.max_backoffs)
+                self._paused_until = max(self._paused_until,
+                                         time.monotonic() + pause)
+            elif status is not None:
+                self._strikes = 0
+                if latency is not None and latency > self.target_latency:
+                    self.limit = max(1.0, self.limit * self.decrease)
+                else:
+                    self.limit = min(float(self.max_concurrency),
+                                     self.limit + 1 / self.limit)
+            self._cond.notify_all()
 
-    def sync(self):
+    def _refill(self, now):
         '''
-        Scrapes information from linked URL
-        - name on CosDNA website
-        - ingredient aliases
-        - molar mass
-        - hydro-/lipo-philic balance
-        - CAS Registry Number
-        - ingredient description
+        Helper function for self.acquire()
+        Adds the tokens accumulated since the last refill
+        '''
+        self.tokens = min(float(self.burst),
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
 
-        Visit the following websites for more information:
-        - molar mass: <https://en.wikipedia.org/wiki/Molar_mass>
-        - HLB: <https://en.wikipedia.org/wiki/Hydrophilic-lipophilic_balance>
-        - CAS No.: <https://en.wikipedia.org/wiki/CAS_Registry_Number>
+    @staticmethod
+    def _parse_retry_after(retry_after):
         '''
-        super().sync()          # goes to cosdna_url
-        if not self._skip:
-            self._cosdna_name, self.aliases = self._get_names()
-            self.mass, self.hlb, self.cas_no = self._get_chemical_info()
-            self.description = self._r.html.find(
-                'div.chem.mb-5 > div.linkb1.ls-2.lh-1', first=True
-                ).text
-            self._synced = True
-        return self
+        Helper function for self.release()
+        Returns Retry-After (delta-seconds or HTTP-date) in seconds
+        '''
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, date.timestamp() - time.time())
 
-    def link_sync(self, cosdna_url=None):
-        self.link(cosdna_url=cosdna_url)
-        self.sync()
-        return self
 
-    def _get_names(self):
-        '''
-        Helper function for self.sync()
-        self.sync() > self._get_names()
+class SearchCache():
+    '''
+    Persistent memo of CosDNA searches: normalized query -> CosDNA URL.
 
-        Returns the name and aliases of the ingredient as they appear in the
-        linked URL
-        '''
-        cosdna_name = self._r.html.find('.text-vampire', first=True) \
-                          .text.lower()
-        aliases = self._r.html.find('div.chem.mb-5 > div.mb-2', first=True) \
-                      .text.lower().split(', ')
-        return cosdna_name, aliases
+    Keys are (search URL base, query as cleaned by Cosmetic.clean(), sort
+    option), so product and ingredient searches never collide. Queries
+    without hits are stored too (negative results), and are not searched
+    again until `negative_ttl` has passed.
 
-    def _get_chemical_info(self):
+    Parameters
+    ----------
+    path : str, default DATA_DIR/cache/searches.sqlite
+        Location of the cache file. Created on first use
+
+    negative_ttl : float, default 2592000 (30 days)
+        Seconds a query without hits is remembered
+
+    >>> Cosmetic.searches.lookup(Product._url('search'),
+    ...                          'cerave+hydrating+cleanser', 'featured')
+    'https://cosdna.com/eng/cosmetic_a5c2170468.html'
+    '''
+
+    MISS = object()     # lookup() result for queries never searched
+
+    def __init__(self,
+                 path=os.path.join(DATA_DIR, 'cache', 'searches.sqlite'),
+                 negative_ttl=2592000):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.stats = Counter()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS searches (
+                    base_url TEXT,
+                    query TEXT,
+                    sort TEXT,
+                    cosdna_url TEXT,
+                    resolved_at REAL,
+                    PRIMARY KEY (base_url, query, sort)
+                )''')
+            self._conn.commit()
+        return self._conn
+
+    def lookup(self, base_url, query, sort=None):
         '''
-        Helper function for self.sync()
-        self.sync() > self._get_chemical_info()
+        Returns the CosDNA URL for query, None if the query is known to
+        have no hits, or SearchCache.MISS if it has to be searched
+        '''
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT cosdna_url, resolved_at FROM searches '
+                'WHERE base_url = ? AND query = ? AND sort = ?',
+                (base_url, query, sort or '')
+            ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return SearchCache.MISS
+        cosdna_url, resolved_at = row
+        if cosdna_url:
+            self.stats['hits'] += 1
+            return cosdna_url
+        if time.time() - resolved_at < self.negative_ttl:
+            self.stats['negative_hits'] += 1
+            return None
+        self.stats['misses'] += 1
+        return SearchCache.MISS
 
-        Returns the molar mass, hydro-/lipo-philic balance, and CAS Registry
-        Number as they appear in the linked URL
+    def store(self, base_url, query, sort=None, cosdna_url=None):
         '''
-        mass, hlb, cas_no = None, None, None
-        ci = self._r.html                                                \
-                 .find('div.d-flex.justify-content-between', first=True) \
-                 .text
-        if 'Molecular Weight' in ci:
-            try:
-                mass = float(re.findall(".*Weight[^\d\.]+(\d+\.\d+).*", ci)[0])
-            except:
-                mass = None
-        if 'HLB' in ci:
-            try:
-                hlb = float(re.findall(".*HLB[^\d\.]+(\d+\.\d+).*", ci)[0])
-            except:
-                hlb = None
-        if 'Cas No' in ci:
-            cas_no = re.findall(".*Cas No[^\d\-]+(\d+\-\d+\-\d+).*", ci)[0]
-        return mass, hlb, cas_no
+        Remembers the result of a search. cosdna_url None means no hits
+        '''
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?)',
+                (base_url, query, sort or '', cosdna_url, time.time())
+            )
+            self.conn.commit()
+        self.stats['stores'] += 1
 
-    @property
-    def name(self):
-        if self.synced:
-            return self._cosdna_name
-        elif self._skip:
-            return 'SKIP: ' + self._name
-        else:
-            return self._name
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM searches')
+            self.conn.commit()
+        self.stats.clear()
 
-    # def __str__(self):
-    #     return self.name
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM searches') \
+                   .fetchone()[0]
 
 
-class Product(Cosmetic):
+class PendingQueue():
     '''
-    Syncs and stores product information from CosDNA.com.
+    Persisted queue of searches that found nothing while running in batch
+    mode (Cosmetic.interactive = False).
 
-    Search for products based on name, link to CosDNA page, and scrape
-    information to store in instance.
+    Instead of prompting with input(), Cosmetic._search() adds the query
+    here and moves on, leaving the product or ingredient unlinked. The
+    queue can later be resolved in bulk with resolve_pending(), from a
+    corrections CSV (see export()) or from the command line:
+
+        python OOP-hackaroutine.py export pending.csv
+        python OOP-hackaroutine.py resolve --corrections pending.csv
+
+    A resolution is a CosDNA URL, a new search query, or 'SKIP'. Resolved
+    URLs are written to Cosmetic.searches, so the next link() of the same
+    query picks them up without a request.
 
     Parameters
     ----------
-    name : str, default None
-        Name of ingredient.
+    path : str, default DATA_DIR/pending.sqlite
+        Location of the queue file. Created on first use
+    '''
 
-    brand : str, default None
-        Name of brand. Does not affect search--purely for internal purposes.
+    fields = ['base_url', 'query', 'sort', 'name', 'status', 'resolution']
 
-    product : str, default None
-        Name of product. Does not affect search--purely for internal purposes.
+    def __init__(self, path=os.path.join(DATA_DIR, 'pending.sqlite')):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
 
-    cosdna_url : str, default None
-        URL of ingredient in CosDNA database
-    '''
+    @property
+    def conn(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS pending (
+                    base_url TEXT,
+                    query TEXT,
+                    sort TEXT,
+                    name TEXT,
+                    status TEXT,
+                    resolution TEXT,
+                    added_at REAL,
+                    PRIMARY KEY (base_url, query, sort)
+                )''')
+            self._conn.commit()
+        return self._conn
 
-    def __init__(self, name=None, brand=None, product=None, cosdna_url=None,
-                 cosdna_id=None):
-        # need `self._name` for `name` property
-        self._name, self.brand, self.product = name, brand, product
-        # initialize using 'name' property
-        super().__init__(name=self.name, cosdna_url=cosdna_url,
-                         cosdna_id=cosdna_id)
+    def add(self, base_url, query, sort=None, name=None):
+        '''
+        Queues a query without hits. Queries already queued, skipped or
+        resolved are left as they are
+        '''
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO pending VALUES '
+                "(?, ?, ?, ?, 'pending', NULL, ?)",
+                (base_url, query, sort or '', name, time.time())
+            )
+            self.conn.commit()
 
-    def link(self, sort='featured', cosdna_url=None):
+    def entries(self, status='pending'):
         '''
-        Links Product() to cosdna_url
+        Returns queue entries with the given status as dicts
+        If status is None, returns every entry
+        '''
+        sql = 'SELECT ' + ', '.join(PendingQueue.fields) + ' FROM pending'
+        args = ()
+        if status:
+            sql += ' WHERE status = ?'
+            args = (status,)
+        with self._lock:
+            rows = self.conn.execute(sql + ' ORDER BY added_at', args) \
+                       .fetchall()
+        return [dict(zip(PendingQueue.fields, row)) for row in rows]
 
-        Parameters
-        ----------
-        sort : str, default 'featured'
-            Selects the search parameters to use:
-            - None (the default sort option on CosDNA)
-            - 'latest' : most recent entries first
-            - 'featured': seems to be a weighted average of 'latest' and
-                    'clicks'
-            - 'clicks' : most visited entries first
-            - 'reviews' : most reviews first
-        cosdna_url : str, default None
-            CosDNA URL of ingredient
-            If cosdna_url is None, searches for cosdna_url using name
+    def set_status(self, base_url, query, sort, status, resolution=None):
+        with self._lock:
+            self.conn.execute(
+                'UPDATE pending SET status = ?, resolution = ? '
+                'WHERE base_url = ? AND query = ? AND sort = ?',
+                (status, resolution, base_url, query, sort or '')
+            )
+            self.conn.commit()
+
+    def skipped(self, base_url, query, sort=None):
         '''
-        self._query = self.name
-        return super().link(sort=sort, cosdna_url=cosdna_url,
-                            _base_url='https://cosdna.com/eng/product.php?q=')
+        Returns True if query was resolved with 'SKIP'
+        '''
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT status FROM pending '
+                'WHERE base_url = ? AND query = ? AND sort = ?',
+                (base_url, query, sort or '')
+            ).fetchone()
+        return row is not None and row[0] == 'skip'
 
-    def sync(self, deep=False, sleep=0.5):
+    def export(self, path):
         '''
-        Scrapes information from linked URL
-        - brand name
-        - product name
-        - ingredient names and corresponding URLs
-        Saves ingredients as Ingredient()
+        Writes pending entries to a CSV file. Fill in the `resolution`
+        column and pass the file to resolve_pending(corrections=path)
+        '''
+        with open(path, 'w', newline='') as handle:
+            writer = csv.DictWriter(handle, fieldnames=PendingQueue.fields)
+            writer.writeheader()
+            writer.writerows(self.entries())
+        return path
 
-        Parameters
-        ----------
-        deep : bool, default False
-            Calls Ingredient.sync() on every ingredient in the routine
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM pending WHERE status = 'pending'"
+        ).fetchone()[0]
+
+
+class SyncLog():
+    '''
+    Append-only JSON Lines log of sync results, for Catalog(log=...).
+
+    Every completed sync is one appended line, flushed to the operating
+    system right away, so a crash of the scraper loses nothing; fsync() is
+    batched every `fsync_every` records or `fsync_interval` seconds, so a
+    crawl doesn't wait on the disk for every page. Catalog.compact() folds
+    the log into the catalog tables.
+
+    The records in the log (its tail) are kept in memory, latest record
+    per (kind, cosdna_id), so reads see them before they are folded. A log
+    belongs to one process: each process (and each forked child) writes
+    its own file next to `path`, e.g. DATA_DIR/catalog.log.1234-9f2c.jsonl,
+    and holds a lock on it while it is open. Catalog folds the logs left
+    behind by processes that are gone (see orphans()).
+
+    Parameters
+    ----------
+    path : str, default DATA_DIR/catalog.log.jsonl
+        Name the per-process logs are derived from. Logs left over from
+        a crash are folded by the catalog on open
+
+    fsync_every : int, default 64
+        Records appended between fsync() calls
+
+    fsync_interval : float, default 1.0
+        Seconds after which an append always calls fsync()
+    '''
+
+    def __init__(self, path=os.path.join(DATA_DIR, 'catalog.log.jsonl'),
+                 fsync_every=64, fsync_interval=1.0):
+        self.base = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.tail = None        # (kind, cosdna_id) -> record in the log
+        self.folding = {}       # records being folded, see rotate()
+        self._handle = None
+        self._held = None       # open lock file, see _acquire()
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.RLock()
+        self._own()
+
+    def _own(self):
         '''
-        super().sync()
-        if self._skip:
-            self._ingredients = []
-            return self
-        else:
-            self._set_name_brand_product(self._query)
-            self._ingredients = self._get_ingredients(deep=deep,
-                                                      sleep=sleep)
-            self._synced = True
-            return self
+        Helper function for self.__init__() and self._open()
+        Picks a log file for this process
+        '''
+        stem, extension = os.path.splitext(self.base)
+        self.path = f'{stem}.{os.getpid()}-{uuid.uuid4().hex[:8]}{extension}'
+        self._pid = os.getpid()
 
-    def link_sync(self, sort='featured', cosdna_url=None, deep=False,
-                  sleep=0.5):
-        self.link(sort=sort, cosdna_url=cosdna_url)
-        self.sync(deep=deep, sleep=sleep)
+    @property
+    def compacting_path(self):
+        return self.path + '.compacting'
 
-    def _set_name_brand_product(self, name):
-        """
-        Helper function for self.sync()
-        Returns the brand name and product name of the product as they appear
-        in the linked URL
-        """
-        cosdna_brand = self._r.html.find('.brand-name', first=True).text.lower()
-        cosdna_product = self._r.html.find('.prod-name', first=True).text.lower()
-        cosdna_name = str(cosdna_brand + ' ' + cosdna_product).strip()
-        if cosdna_brand:
-            self.brand, self.product = cosdna_brand, cosdna_product
-        else:
-            self._name = name
+    @property
+    def lock_path(self):
+        return self.path + '.lock'
 
-    def _get_ingredients(self, deep, sleep=0.5):
+    def _open(self):
         '''
-        Helper function for self.sync()
-        self.sync() > self._get_ingredients()
+        Helper function for self.append() and reads
+        Replays the log (and the log of an interrupted compaction), then
+        opens it for appending
+        '''
+        if self._pid != os.getpid():    # forked: the parent's log isn't ours
+            self.tail, self.folding = None, {}
+            self._handle = self._held = None
+            self._own()
+        if self.tail is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._acquire()
+            if os.path.exists(self.compacting_path):
+                self.folding = self._replay(self.compacting_path)
+            self.tail = self._replay(self.path)
+            self._handle = open(self.path, 'a', encoding='utf-8')
 
-        Returns a list of ingredients in the product as Ingredient()
+    def _acquire(self, block=True):
+        '''
+        Helper function for self._open() and self.orphans()
+        Takes the lock on the log, which marks it as in use. Returns False
+        if another process holds it
+        '''
+        if self._held is not None or fcntl is None:
+            return self._held is not None or block
+        while True:
+            handle = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX
+                            | (0 if block else fcntl.LOCK_NB))
+            except BlockingIOError:
+                handle.close()
+                return False
+            try:
+                # the lock file may have been removed while we waited
+                if os.fstat(handle.fileno()).st_ino == \
+                        os.stat(self.lock_path).st_ino:
+                    self._held = handle
+                    return True
+            except FileNotFoundError:
+                pass
+            handle.close()
+
+    def orphans(self):
+        '''
+        Returns a SyncLog, locked, for every log derived from the same
+        path whose process is gone (including a log at exactly `path`,
+        as written before logs were per process)
+        '''
+        stem, extension = os.path.splitext(self.base)
+        directory = os.path.dirname(self.base) or '.'
+        if not os.path.isdir(directory):
+            return []
+        paths = {self.base}
+        for name in os.listdir(directory):
+            path = os.path.join(os.path.dirname(self.base), name)
+            if path.endswith('.compacting'):
+                path = path[:-len('.compacting')]
+            if path.startswith(stem + '.') and path.endswith(extension):
+                paths.add(path)
+        paths.discard(self.path)
+        orphans = []
+        for path in sorted(paths):
+            orphan = SyncLog(self.base)
+            orphan.path = path
+            if not (os.path.exists(path)
+                    or os.path.exists(orphan.compacting_path)):
+                continue
+            if orphan._acquire(block=False):
+                orphans.append(orphan)
+        return orphans
+
+    def discard(self):
+        '''
+        Helper function for Catalog.compact()
+        Deletes a folded orphan log, see self.orphans()
+        '''
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+            for path in (self.path, self.lock_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._release()
+            self._handle, self.tail = None, None
+
+    def _release(self):
+        if self._held is not None:
+            self._held.close()      # closing drops the lock
+            self._held = None
+
+    @staticmethod
+    def _replay(path):
+        '''
+        Helper function for self._open()
+        Returns the latest record per (kind, cosdna_id) in the log at path.
+        A last line torn by a crash is cut off
+        '''
+        records, good = {}, 0
+        if not os.path.exists(path):
+            return records
+        with open(path, 'rb') as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                    records[entry['kind'], entry['cosdna_id']] = \
+                        entry['record']
+                except (ValueError, KeyError):
+                    break
+                good += len(line)
+        if good < os.path.getsize(path):
+            with open(path, 'r+b') as handle:
+                handle.truncate(good)
+        return records
+
+    def append(self, kind, cosdna_id, record):
+        '''
+        Appends a sync result
 
         Parameters
         ----------
-        deep : bool, default False
-            Calls Ingredient.sync() on every ingredient in the routine
+        kind : str
+            'ingredient' or 'product'
+
+        record : dict
+            Catalog record, see Ingredient._record() and Product._record()
         '''
-        ingredients = []
-        table = self._r.html.find('.tr-i')
-        # not sure if this improves performance. idea taken from scikit-learn
-        ingredients_append = ingredients.append
-        for row in table:
-            cells = row.find('td')
-            if len(cells) == 5:
-                # ingredient, function, acne, irritant, safety
-                ing, _, _, _, _ = cells
-                ing_name = ing.text.strip().lower()
-                print(ing_name)
-                ing_url = (Cosmetic.domain
-                           + ing.xpath('//a/@href', first=True))
-                # function = self._get_function_info(fun)
-                ingredient = Ingredient(name=ing_name,
-                                        cosdna_url=ing_url)
-                if deep:
-                    ingredient.sync()
-                    time.sleep(sleep)
-            else:
-                ing = cells[0]
-                ing_name = ing.find('.text-muted', first=True).text.strip() \
-                              .lower()
-                ingredient = Ingredient(name=ing_name)
-            ingredients_append(ingredient)
-        return ingredients
+        line = json.dumps({'kind': kind, 'cosdna_id': cosdna_id,
+                           'record': record, 'at': time.time()})
+        with self._lock:
+            self._open()
+            self._handle.write(line + '\n')
+            self._handle.flush()
+            self.tail[kind, cosdna_id] = record
+            self._unsynced += 1
+            if (self._unsynced >= self.fsync_every or time.monotonic()
+                    - self._synced_at >= self.fsync_interval):
+                self.sync()
 
-    # def _get_function_info(self, fun):
-    #     function = fun.text.strip().lower().split(',')
-    #     if 'sunscreen' in function:
-    #         try:
-    #             uva = re.search("uv[ab]\d",
-    #                             fun.xpath('//img')[0].attrs['src'])[0]
-    #             uvb = re.search("uv[ab]\d",
-    #                             fun.xpath('//img')[1].attrs['src'])[0]
-    #             function.append(uva)
-    #             function.append(uvb)
-    #         except:
-    #             pass
-    #     return function
+    def sync(self):
+        '''
+        Forces appended records to disk
+        '''
+        with self._lock:
+            if self._handle is not None and self._unsynced:
+                self._handle.flush()
+                os.fsync(self._handle.fileno())
+            self._unsynced = 0
+            self._synced_at = time.monotonic()
 
-    @property
-    def name(self):
-        if self.brand is None and self.product is None:
-            return self._name
-        else:
-            self._name = self.brand + ' ' + self.product
-            return self._name
+    def get(self, kind, cosdna_id):
+        '''
+        Returns the latest logged record, or None
+        '''
+        with self._lock:
+            self._open()
+            record = self.tail.get((kind, cosdna_id))
+            if record is None:
+                record = self.folding.get((kind, cosdna_id))
+        return record
 
-    @property
-    def ingredients(self):
-        return [ing.name for ing in self._ingredients]
+    def records(self, kind):
+        '''
+        Returns {cosdna_id: record} of every logged record of kind
+        '''
+        with self._lock:
+            self._open()
+            records = {cosdna_id: record for (kind_, cosdna_id), record
+                       in self.folding.items() if kind_ == kind}
+            records.update({cosdna_id: record for (kind_, cosdna_id), record
+                            in self.tail.items() if kind_ == kind})
+        return records
 
-    @property
-    def cosdna_urls(self):
-        return [ing.cosdna_url for ing in self._ingredients]
+    def rotate(self):
+        '''
+        Helper function for Catalog.compact()
+        Moves the log aside to be folded, and starts a new one. Returns the
+        records to fold. If a previous compaction was interrupted, returns
+        its records instead and leaves the log alone
+        '''
+        with self._lock:
+            self._open()
+            if self.folding or os.path.exists(self.compacting_path):
+                return dict(self.folding)
+            self.sync()
+            self._handle.close()
+            os.replace(self.path, self.compacting_path)
+            self.folding, self.tail = self.tail, {}
+            self._handle = open(self.path, 'a', encoding='utf-8')
+            return dict(self.folding)
 
-    # _cosdna_ids and _ing_dict used for Routine()
-    @property
-    def _cosdna_ids(self):
-        return [ing.cosdna_id for ing in self._ingredients]
+    def folded(self):
+        '''
+        Helper function for Catalog.compact()
+        Drops the rotated log once its records are in the catalog
+        '''
+        with self._lock:
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+            self.folding = {}
 
-    @property
-    def _ingredient_dict(self):
-        return dict(zip(self._cosdna_ids, self.ingredients))
+    def close(self):
+        with self._lock:
+            self.sync()
+            if self._handle is not None:
+                self._handle.close()
+                if not (self.tail or self.folding) and \
+                        os.path.getsize(self.path) == 0:
+                    # nothing left to fold: don't leave the files behind
+                    for path in (self.path, self.lock_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+            self._release()
+            self._handle, self.tail = None, None
 
-    def __str__(self):
-        return f'{self.name}\n\n{self.ingredients}'
+    def __len__(self):
+        with self._lock:
+            self._open()
+            return len(self.tail) + len(self.folding)
 
 
-class Routine(CosDNA):
+class Catalog():
     '''
-    Container for Product() and Ingredient() objects.
+    Persisted catalog of synced ingredients and products, in SQLite.
 
-    Tabulates all ingredients in routine.
+    Replaces rewriting all of DATA_DIR/ingredients/ingredients.json after
+    every sync: each sync upserts its own rows, so writes cost the same
+    however large the catalog is, and concurrent writers (threads or
+    processes) no longer overwrite each other. Ingredient.sync() and
+    Product.sync() read from here before fetching, and write here after.
+
+    Tables, each indexed for its lookups:
+    - ingredients: cosdna_id, name, cosdna_name, mass, hlb, description
+    - aliases: alias -> cosdna_id
+    - cas_numbers: cas_no -> cosdna_id
+    - products: cosdna_id, name, brand, product
+    - product_ingredients: product, position, ingredient name and
+        cosdna_id (NULL if the ingredient has no CosDNA page)
 
     Parameters
     ----------
-    name : str, default None
-        Name of routine. Optional
+    path : str, default DATA_DIR/catalog.sqlite
+        Location of the catalog file. Created on first use
 
-    routine : list, default None
-        List if products in routine. Products are stored as Product() objects.
+    seed : str, default DATA_DIR/ingredients/ingredients.json
+        JSON catalog imported when the catalog is created (see
+        import_json()). None starts empty
+
+    log : SyncLog, default None
+        If given, store() appends sync results to the log instead of
+        writing the tables, and a background thread folds the log into the
+        tables (see compact()) every `compact_interval` seconds, or sooner
+        once it holds `compact_every` records. Reads merge the tables with
+        the log
+
+    compact_every : int, default 1000
+
+    compact_interval : float, default 60.0
+
+    >>> with Cosmetic.catalog.batch():           # one transaction
+    ...     routine.link_sync(deep=True)
+    >>> Cosmetic.catalog.lookup('aqua')
+    '90172810251'
+    >>> Cosmetic.catalog.export_json(IndexBundle.catalog)
     '''
 
-    def __init__(self, name=None, routine=None):
-        super().__init__(name)
-        self.products = []
-        if routine:
-            self.add(routine)
+    ingredient_fields = ['name', 'cosdna_name', 'aliases', 'mass', 'hlb',
+                         'cas_no', 'description']
 
-    def add(self, routine):
-        '''
-        Adds products to the routine
+    def __init__(self, path=os.path.join(DATA_DIR, 'catalog.sqlite'),
+                 seed=os.path.join(DATA_DIR, 'ingredients',
+                                   'ingredients.json'),
+                 log=None, compact_every=1000, compact_interval=60.0):
+        self.path = path
+        self.seed = seed
+        self.log = log
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self._conn = None
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._compactor = None
+        self._compact_now = threading.Event()
+        self._closed = threading.Event()
 
-        Parameters
-        ----------
-        routine : list, default None
-            List if products in routine. Products are stored as Product()
-            objects.
-        '''
-        routine = np.array([routine])
-        routine = routine.ravel()
-        routine = [p for p in routine if len(p) > 1]
-        for product in routine:
-            if type(product) == Product:
-                self.products.append(product)
-            else:
-                self.products.append(Product(product))
-        return self
+    @property
+    def conn(self):
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self._conn = self._connect()
+        return self._conn
 
-    def link(self, sort='featured', force=False):
+    def _connect(self):
         '''
-        Calls Product.link() for all products in routine
-
-        Parameters
-        ----------
-        sort : str, default 'featured'
-            Chooses how to sort the search results for each Product()
+        Helper function for self.conn
+        Opens the catalog, creating and seeding it if needed
+        '''
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               timeout=30)
+        conn.execute('PRAGMA journal_mode = WAL')   # readers don't block
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS ingredients (
+                cosdna_id TEXT PRIMARY KEY,
+                name TEXT,
+                cosdna_name TEXT,
+                mass REAL,
+                hlb REAL,
+                description TEXT,
+                synced INTEGER,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS ingredients_name
+                ON ingredients (name);
+            CREATE INDEX IF NOT EXISTS ingredients_cosdna_name
+                ON ingredients (cosdna_name);
+            CREATE TABLE IF NOT EXISTS aliases (
+                cosdna_id TEXT,
+                position INTEGER,
+                alias TEXT,
+                PRIMARY KEY (cosdna_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (alias);
+            CREATE TABLE IF NOT EXISTS cas_numbers (
+                cas_no TEXT,
+                cosdna_id TEXT,
+                PRIMARY KEY (cas_no, cosdna_id)
+            );
+            CREATE INDEX IF NOT EXISTS cas_numbers_cosdna_id
+                ON cas_numbers (cosdna_id);
+            CREATE TABLE IF NOT EXISTS products (
+                cosdna_id TEXT PRIMARY KEY,
+                name TEXT,
+                brand TEXT,
+                product TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS products_name ON products (name);
+            CREATE TABLE IF NOT EXISTS product_ingredients (
+                product_id TEXT,
+                position INTEGER,
+                name TEXT,
+                ingredient_id TEXT,
+                PRIMARY KEY (product_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS product_ingredients_ingredient_id
+                ON product_ingredients (ingredient_id);
+        ''')
+        empty = conn.execute('SELECT COUNT(*) FROM ingredients') \
+            .fetchone()[0] == 0
+        self._conn = conn
+        if empty and self.seed and os.path.exists(self.seed):
+            self.import_json(self.seed)
+        if self.log is not None:
+            self.compact()      # folds what crashed processes left behind
+        return conn
 
-        force : bool, default False
-            Calls Product.link() on Product() even if it has already been
-            linked.
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Groups every upsert inside the `with` block into one transaction,
+        committed when the outermost batch() exits
         '''
-        self.link_sync(sort=sort, force=force, _link=True, _sync=False)
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.conn.commit()
+
+    def _commit(self):
+        if not self._batch_depth:
+            self.conn.commit()
 
-    def sync(self, force=False, deep=False, sleep=0.5):
+    def upsert_ingredients(self, records, synced=True):
         '''
-        Calls Product.sync() for all products in routine
+        Inserts or updates ingredients in one transaction
 
         Parameters
         ----------
-        force : bool, default False
-            Calls Product.sync() on Product() even if it has already been
-            synced
+        records : dict
+            cosdna_id -> record with Catalog.ingredient_fields, as in
+            DATA_DIR/ingredients/ingredients.json. Missing fields are NULL
 
-        deep : bool, default False
-            Calls Ingredient.sync() on every ingredient in the routine
+        synced : bool, default True
+            False for records that only name an ingredient (e.g.
+            ingredient-names.json); Ingredient.sync() still fetches those
         '''
-        self.link_sync(force=force, deep=deep, sleep=sleep,
-                       _link=False, _sync=True)
+        now = time.time()
+        rows, aliases, cas_numbers = [], [], []
+        for cosdna_id, record in records.items():
+            rows.append((cosdna_id, record.get('name'),
+                         record.get('cosdna_name'), record.get('mass'),
+                         record.get('hlb'), record.get('description'),
+                         int(synced), now))
+            aliases += [(cosdna_id, position, alias) for position, alias
+                        in enumerate(record.get('aliases') or [])]
+            if record.get('cas_no'):
+                cas_numbers.append((record['cas_no'], cosdna_id))
+        ids = [(cosdna_id,) for cosdna_id in records]
+        with self._lock:
+            conn = self.conn
+            # keeps the first name an ingredient was known by
+            conn.executemany('''
+                INSERT INTO ingredients VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (cosdna_id) DO UPDATE SET
+                    name = COALESCE(ingredients.name, excluded.name),
+                    cosdna_name = excluded.cosdna_name,
+                    mass = excluded.mass,
+                    hlb = excluded.hlb,
+                    description = excluded.description,
+                    synced = MAX(ingredients.synced, excluded.synced),
+                    updated_at = excluded.updated_at
+                ''', rows)
+            if synced:
+                conn.executemany('DELETE FROM aliases WHERE cosdna_id = ?',
+                                 ids)
+                conn.executemany(
+                    'DELETE FROM cas_numbers WHERE cosdna_id = ?', ids
+                )
+            conn.executemany(
+                'INSERT OR IGNORE INTO aliases VALUES (?, ?, ?)', aliases
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO cas_numbers VALUES (?, ?)',
+                cas_numbers
+            )
+            self._commit()
 
-    def link_sync(self, sort='featured', force=False, deep=False, sleep=0.5,
-                  _link=True, _sync=True):
+    def upsert_products(self, records):
         '''
-        Calls Product.link().sync() for all products in routine
-        Tabulates frequency of ingredients across entire routine
+        Inserts or updates products and their ingredient lists in one
+        transaction
 
         Parameters
         ----------
-        force : bool, default False
-            Calls Product.sync() on Product() even if it has already been
-            synced
+        records : dict
+            cosdna_id -> {'name', 'brand', 'product', 'ingredients'}, where
+            'ingredients' lists {'name', 'cosdna_id'} in label order
+        '''
+        now = time.time()
+        rows, members = [], []
+        for cosdna_id, record in records.items():
+            rows.append((cosdna_id, record.get('name'), record.get('brand'),
+                         record.get('product'), now))
+            members += [(cosdna_id, position, row['name'], row['cosdna_id'])
+                        for position, row in enumerate(record['ingredients'])]
+        with self._lock:
+            conn = self.conn
+            conn.executemany(
+                'INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)', rows
+            )
+            conn.executemany(
+                'DELETE FROM product_ingredients WHERE product_id = ?',
+                [(cosdna_id,) for cosdna_id in records]
+            )
+            conn.executemany(
+                'INSERT INTO product_ingredients VALUES (?, ?, ?, ?)', members
+            )
+            self._commit()
 
-        deep : bool, default False
-            Calls Ingredient.sync() on every ingredient in the routine
+    def store(self, cosmetic):
         '''
-        for product in self.products:
-            if _link:
-                if force:
-                    product.link(sort=sort)
-                else:
-                    if not product.linked:
-                        product.link(sort=sort)
-            if _sync:
-                if force:
-                    product.sync(deep=deep, sleep=sleep)
-                    changes = True
-                else:
-                    if not product.synced:
-                        product.sync(deep=deep, sleep=sleep)
-                        changes = True
-            time.sleep(sleep)
-        if changes:
-            self._analyze()
+        Upserts a synced Product() or Ingredient(), or appends it to
+        self.log
+        '''
+        if not cosmetic.synced or cosmetic._skip:
+            return
+        kind = 'product' if isinstance(cosmetic, Product) else 'ingredient'
+        if self.log is not None:
+            self.log.append(kind, cosmetic.cosdna_id, cosmetic._record())
+            self._start_compactor()
+            if len(self.log) >= self.compact_every:
+                self._compact_now.set()
+        elif kind == 'product':
+            self.upsert_products({cosmetic.cosdna_id: cosmetic._record()})
         else:
-            return self
+            self.upsert_ingredients({cosmetic.cosdna_id: cosmetic._record()})
 
-    def _analyze(self):
+    def compact(self):
         '''
-        Helper function for self.sync()
-        self.sync() > self._analyze()
+        Folds self.log into the tables and commits, including the log of a
+        compaction interrupted by a crash and the logs of processes that
+        are gone (see SyncLog.orphans()). Inside a batch(), this commits
+        the batch so far as well
+        Returns the number of records folded
+        '''
+        if self.log is None:
+            return 0
+        with self._lock:
+            folded = self._fold(self.log)
+            for orphan in self.log.orphans():
+                folded += self._fold(orphan)
+                orphan.discard()
+            return folded
 
-        Tabulates frequency of cosdna_ids across all Products
+    def _fold(self, log):
         '''
-        self._routine_ids, self._routine_dict = self._get_routine_info()
-        self._counts = self._translate_counter(self._routine_dict,
-                                               Counter(self._routine_ids))
-        self._product_vectors = self._get_product_vectors()
-        return self
+        Helper function for self.compact()
+        Folds one log into the tables
+        '''
+        folded = 0
+        with self._lock:
+            while True:
+                interrupted = os.path.exists(log.compacting_path)
+                records = log.rotate()
+                ingredients, products = {}, {}
+                for (kind, cosdna_id), record in records.items():
+                    if kind == 'product':
+                        products[cosdna_id] = record
+                    else:
+                        ingredients[cosdna_id] = record
+                self.upsert_ingredients(ingredients)
+                self.upsert_products(products)
+                # commits even inside an outer batch(): the rotated log is
+                # only dropped once its records are on disk
+                self.conn.commit()
+                log.folded()
+                folded += len(records)
+                if not interrupted:
+                    return folded
 
-    def _get_routine_info(self):
+    def _start_compactor(self):
         '''
-        Helper function for self.sync()
-        self.sync() > self._analyze() > self._get_routine_info()
+        Helper function for self.store()
+        Starts the background compaction thread on first use
+        '''
+        if self._compactor is None:
+            with self._lock:
+                if self._compactor is None:
+                    self._compactor = threading.Thread(
+                        target=self._compact_loop, daemon=True
+                    )
+                    self._compactor.start()
+                    atexit.register(self.close)
 
-        Creates dictionary to translate cosdna_id to ingredient name
-        Creates routine_ids and routine_dict for entire routine
+    def _compact_loop(self):
+        while not self._closed.is_set():
+            self._compact_now.wait(self.compact_interval)
+            self._compact_now.clear()
+            if len(self.log):
+                self.compact()
+
+    def close(self):
         '''
-        routine_ids = []
-        routine_dict = {}
-        for product in self.products:
-            if not product._skip:
-                product_dict = product._ingredient_dict
-                routine_ids += product._cosdna_ids
-                routine_dict.update(product_dict)
-        routine_dict.update({'unavailable': 'unavailable'})
-        return routine_ids, routine_dict
+        Stops background compaction, folds what is left of the log and
+        closes the catalog
+        '''
+        self._closed.set()
+        self._compact_now.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            if self.log is not None:
+                self.compact()
+                self.log.close()
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+        self._closed.clear()
 
-    def _translate_counter(self, translation_dict, counter):
+    def ingredient(self, cosdna_id):
         '''
-        Helper function for self.sync()
-        self.sync() > self._analyze() > self._translate_counter()
+        Returns the synced record for cosdna_id, or None
+        '''
+        if self.log is not None:
+            record = self.log.get('ingredient', cosdna_id)
+            if record is not None:
+                return dict(record)
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT name, cosdna_name, mass, hlb, description '
+                'FROM ingredients WHERE cosdna_id = ? AND synced',
+                (cosdna_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            aliases = [alias for (alias,) in self.conn.execute(
+                'SELECT alias FROM aliases WHERE cosdna_id = ? '
+                'ORDER BY position', (cosdna_id,)
+            )]
+            cas_no = self.conn.execute(
+                'SELECT cas_no FROM cas_numbers WHERE cosdna_id = ?',
+                (cosdna_id,)
+            ).fetchone()
+        name, cosdna_name, mass, hlb, description = row
+        return {'name': name, 'cosdna_name': cosdna_name, 'aliases': aliases,
+                'mass': mass, 'hlb': hlb, 'cas_no': cas_no and cas_no[0],
+                'description': description}
 
-        Translates Counter() object using routine_dict
-        Visit <https://stackoverflow.com/questions/51423217/> for more
-        information
+    def product(self, cosdna_id):
         '''
-        return OrderedCounter(dict(
-            (translation_dict.get(k, k), v) for (k, v) in counter.items()
-        ))
+        Returns the record for cosdna_id, or None
+        '''
+        if self.log is not None:
+            record = self.log.get('product', cosdna_id)
+            if record is not None:
+                return dict(record)
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT name, brand, product FROM products '
+                'WHERE cosdna_id = ?', (cosdna_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            members = self.conn.execute(
+                'SELECT name, ingredient_id FROM product_ingredients '
+                'WHERE product_id = ? ORDER BY position', (cosdna_id,)
+            ).fetchall()
+        name, brand, product = row
+        return {'name': name, 'brand': brand, 'product': product,
+                'ingredients': [{'name': member, 'cosdna_id': ingredient_id}
+                                for member, ingredient_id in members]}
 
-    def _get_product_vectors(self):
+    def lookup(self, name):
         '''
-        Helper function for self.sync()
-        self.sync() > self._analyze() > self._get_product_vectors()
+        Returns the cosdna_id whose CosDNA name, name, alias or CAS No. is
+        name, in that order of preference, or None
+        '''
+        name = name.lower().strip()
+        if not name:
+            return None
+        if self.log is not None:
+            logged = self.log.records('ingredient')
+            for field in ('cosdna_name', 'name', 'aliases', 'cas_no'):
+                for cosdna_id, record in logged.items():
+                    value = record.get(field)
+                    if value == name or (field == 'aliases'
+                                         and name in (value or [])):
+                        return cosdna_id
+        with self._lock:
+            row = self.conn.execute('''
+                SELECT cosdna_id FROM ingredients WHERE cosdna_name = ?
+                UNION ALL
+                SELECT cosdna_id FROM ingredients WHERE name = ?
+                UNION ALL
+                SELECT cosdna_id FROM aliases WHERE alias = ?
+                UNION ALL
+                SELECT cosdna_id FROM cas_numbers WHERE cas_no = ?
+                LIMIT 1''', (name,) * 4).fetchone()
+        return row and row[0]
 
-        Generates product vectors in order to quickly assess the presence of
-        ingredients in a routine. Over 5x than searching through
-        Product._cosdna_ids
+    def product_names(self):
         '''
-        product_vectors = []
-        for product in self.products:
-            product_vector = []
-            product_vector_append = product_vector.append
-            for cosdna_id in self._routine_ids:
-                if cosdna_id in product._cosdna_ids:
-                    product_vector_append(1)
-                else:
-                    product_vector_append(0)
-            product_vectors.append(product_vector)
-        return product_vectors
+        Returns dict of cosdna_id -> name of every product
+        '''
+        with self._lock:
+            names = dict(self.conn.execute(
+                'SELECT cosdna_id, name FROM products'
+            ).fetchall())
+        if self.log is not None:
+            names.update((cosdna_id, record.get('name')) for cosdna_id, record
+                         in self.log.records('product').items())
+        return names
 
-    def top_ingredients(self, top=None, mask=None):
+    def product_count(self):
         '''
-        Returns specified number of most common ingredients
+        Returns the number of products, without reading them
+        '''
+        logged = list(self.log.records('product')) if self.log else []
+        with self._lock:
+            count = self.conn.execute(
+                'SELECT COUNT(*) FROM products'
+            ).fetchone()[0]
+            for start in range(0, len(logged), 500):
+                chunk = logged[start:start + 500]
+                count += len(chunk) - self.conn.execute(
+                    'SELECT COUNT(*) FROM products WHERE cosdna_id IN '
+                    f'({", ".join("?" * len(chunk))})', chunk
+                ).fetchone()[0]
+        return count
+
+    def product_ingredients(self):
+        '''
+        Returns dict of cosdna_id -> ingredient cosdna_ids, in label order,
+        of every product
+        '''
+        products = defaultdict(list)
+        with self._lock:
+            for product_id, ingredient_id in self.conn.execute(
+                    'SELECT product_id, ingredient_id '
+                    'FROM product_ingredients ORDER BY product_id, position'):
+                products[product_id].append(ingredient_id)
+        products = dict(products)
+        if self.log is not None:
+            products.update(
+                (cosdna_id,
+                 [row['cosdna_id'] for row in record['ingredients']])
+                for cosdna_id, record in self.log.records('product').items()
+            )
+        return products
+
+    def products_with(self, cosdna_id):
+        '''
+        Returns the cosdna_ids of every product listing the ingredient
+        '''
+        with self._lock:
+            products = [product_id for (product_id,) in self.conn.execute(
+                'SELECT DISTINCT product_id FROM product_ingredients '
+                'WHERE ingredient_id = ?', (cosdna_id,)
+            )]
+        if self.log is not None:
+            # logged products replace their rows in the tables
+            logged = self.log.records('product')
+            products = [product_id for product_id in products
+                        if product_id not in logged]
+            products += [product_id for product_id, record in logged.items()
+                         if any(row['cosdna_id'] == cosdna_id
+                                for row in record['ingredients'])]
+        return products
+
+    def import_json(self, path, synced=None):
+        '''
+        Upserts ingredients from a JSON catalog, e.g.
+        DATA_DIR/ingredients/ingredients.json, or names only from
+        DATA_DIR/ingredients/ingredient-names.json
 
         Parameters
         ----------
-        top : int, default None
-            Specifies number of ingredients to return
-
-        mask : list, default None
-            Specifies which ingredients to return
+        synced : bool, default None
+            Whether the records are complete. If None, records with a
+            cosdna_name are
         '''
-        # dict(Counter) returns a dictionary
-        # then import scipy.sparse?
-        if mask:
-            mask = [Ingredient(x).link_sync().cosdna_id for x in mask]
-            masked_counts = OrderedCounter(
-                [x for x in self._routine_ids if x in mask]
-            )
-            return masked_counts.most_common(top)
+        with open(path) as handle:
+            records = json.load(handle)
+        records.pop('unavailable', None)
+        if synced is None:
+            complete = {cosdna_id: record
+                        for cosdna_id, record in records.items()
+                        if record.get('cosdna_name')}
+            self.upsert_ingredients(complete)
+            self.upsert_ingredients({cosdna_id: record
+                                     for cosdna_id, record in records.items()
+                                     if cosdna_id not in complete},
+                                    synced=False)
         else:
-            return self._counts.most_common(top)
+            self.upsert_ingredients(records, synced=synced)
+        return len(records)
 
-    def has(self, ingredient):
+    def export_json(self, path, names=None):
         '''
-        Returns products which include ingredient
+        Writes synced ingredients in the format of
+        DATA_DIR/ingredients/ingredients.json, and optionally every
+        ingredient name in the format of ingredient-names.json to `names`
+        '''
+        self.compact()
+        with self._lock:
+            ids = [(cosdna_id, synced) for cosdna_id, synced in
+                   self.conn.execute('SELECT cosdna_id, synced '
+                                     'FROM ingredients ORDER BY rowid')]
+            records = {cosdna_id: self.ingredient(cosdna_id)
+                       for cosdna_id, synced in ids if synced}
+            all_names = dict(self.conn.execute(
+                'SELECT cosdna_id, name FROM ingredients ORDER BY rowid'
+            ).fetchall())
+        with open(path, 'w') as handle:
+            json.dump({cosdna_id: {field: record[field]
+                                   for field in Catalog.ingredient_fields}
+                       for cosdna_id, record in records.items()},
+                      handle, indent=4)
+        if names:
+            all_names['unavailable'] = 'unavailable'
+            with open(names, 'w') as handle:
+                json.dump({cosdna_id: {'name': name}
+                           for cosdna_id, name in all_names.items()},
+                          handle, indent=4)
+        return path
+
+    def __len__(self):
+        count = self.conn.execute(
+            'SELECT COUNT(*) FROM ingredients WHERE synced'
+        ).fetchone()[0]
+        if self.log is not None:
+            for cosdna_id in self.log.records('ingredient'):
+                count += self.conn.execute(
+                    'SELECT NOT EXISTS (SELECT 1 FROM ingredients '
+                    'WHERE cosdna_id = ? AND synced)', (cosdna_id,)
+                ).fetchone()[0]
+        return count
+
+
+class SyncRegistry():
+    '''
+    Process-wide single-flight registry of synced products and ingredients.
+
+    Keyed by (class name, cosdna_id). The first sync of a key fetches and
+    parses the page; every later sync of the same key, including ones
+    that arrive while the first is still in flight, waits for it and
+    copies its parsed result instead of fetching again. Water, glycerin
+    and the like are then fetched once per process instead of once per
+    product.
+
+    >>> CosDNA.registry.report()
+    {'Ingredient': {'requests': 412, 'fetches': 163, 'shared': 249,
+                    'dedup_ratio': 0.604}, ...}
+    '''
+
+    def __init__(self):
+        self._results = {}      # key -> state, see Cosmetic._get_state()
+        self._in_flight = {}    # key -> threading.Event()
+        self._lock = threading.RLock()
+        self.stats = defaultdict(Counter)
+
+    @staticmethod
+    def key(cosmetic):
+        return (type(cosmetic).__name__, cosmetic.cosdna_id)
+
+    def count(self, cosmetic, what):
+        with self._lock:
+            self.stats[type(cosmetic).__name__][what] += 1
+
+    def share(self, cosmetic):
+        '''
+        Copies the registered result for cosmetic onto it
+        Returns False if there is none yet
+        '''
+        with self._lock:
+            state = self._results.get(self.key(cosmetic))
+            if state is None:
+                return False
+            cosmetic._set_state(state)
+            self.count(cosmetic, 'shared')
+        return True
+
+    def store(self, cosmetic):
+        if cosmetic.synced:
+            with self._lock:
+                self._results[self.key(cosmetic)] = cosmetic._get_state()
+
+    def sync(self, cosmetic, sync, force=False):
+        '''
+        Calls sync() for cosmetic unless its result is registered or
+        another thread is already syncing the same key
 
         Parameters
         ----------
-        ingredient : str
-            Name of ingredient. Works for aliases as long as they are present
-            in CosDNA.
-        '''
-        # add 'AND' / 'OR' functionality!
-        ingredient_id = Ingredient(ingredient).link_sync().cosdna_id
-        isolated_products = []
-        for i, product_vector in enumerate(self._product_vectors):
+        cosmetic : Product or Ingredient
+
+        sync : callable
+            Fetches and parses the page into cosmetic
+
+        force : bool, default False
+            Ignores a registered result and syncs again. Callers arriving
+            while the forced sync is in flight still share it
+        '''
+        if cosmetic._skip or not cosmetic.linked:
+            sync()      # nothing to share
+            return cosmetic
+        key = self.key(cosmetic)
+        self.count(cosmetic, 'requests')
+        with self._lock:
+            if not force and self.share(cosmetic):
+                return cosmetic
+            event = self._in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = self._in_flight[key] = threading.Event()
+        if not leader:
+            event.wait()
+            if self.share(cosmetic):
+                return cosmetic
+        self.count(cosmetic, 'fetches')     # leader, or leader failed
+        try:
+            sync()
+            self.store(cosmetic)
+        finally:
+            if leader:
+                with self._lock:
+                    self._in_flight.pop(key, None)
+                event.set()
+        return cosmetic
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.stats.clear()
+
+    def report(self):
+        '''
+        Returns requests, fetches, shared results and the dedup ratio
+        (shared / requests) for products and ingredients
+        '''
+        report = {}
+        with self._lock:
+            for kind, counts in self.stats.items():
+                requests_ = counts['requests']
+                report[kind] = {
+                    'requests': requests_,
+                    'fetches': counts['fetches'],
+                    'shared': counts['shared'],
+                    'dedup_ratio': (counts['shared'] / requests_
+                                    if requests_ else 0.0),
+                }
+        return report
+
+    def __len__(self):
+        return len(self._results)
+
+
+class CircuitBreaker():
+    '''
+    Fails fast while CosDNA.com is down. Thread-safe.
+
+    After `threshold` consecutive failed requests (connection errors,
+    timeouts, 5xx responses or 429s left after CosDNAAdapter's retries)
+    the circuit opens and requests raise
+    CircuitOpen without touching the network. After `reset_timeout`
+    seconds one trial request is let through: success closes the
+    circuit, failure opens it again.
+
+    Parameters
+    ----------
+    threshold : int, default 5
+        Consecutive failures that open the circuit
+
+    reset_timeout : float, default 30.0
+        Seconds the circuit stays open before a trial request
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = 'closed'
+        self.stats = Counter()
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before(self, url=None):
+        '''
+        Raises CircuitOpen if requests should not be sent
+        '''
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if (self.state == 'open' and
+                    time.monotonic() - self._opened_at >= self.reset_timeout):
+                self.state = 'half-open'    # let one trial request through
+                return
+            self.stats['rejected'] += 1
+        raise CircuitOpen(f'CosDNA circuit open, not requesting {url}')
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.state = 'closed'
+                return
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.stats['opened'] += 1
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+class CosDNAAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter used by Transport() for every request to CosDNA.com.
+
+    GET requests are answered from `cache` when possible. Requests that
+    reach the network are paced by `limiter`, time out after `timeout`,
+    are retried up to `retries` times with jittered exponential backoff on
+    connection errors, timeouts and 5xx responses, and are refused while
+    `breaker` is open. Anything mounted with this adapter (the shared
+    HTMLSession, or the AsyncHTMLSession in
+    Routine.link_sync(concurrency=N)) shares all of these.
+
+    Parameters
+    ----------
+    cache : ResponseCache, default None
+        Response cache. If None, every request goes to the network
+
+    limiter : RateLimiter, default None
+        Rate limiter. If None, requests are not paced
+
+    breaker : CircuitBreaker, default None
+        Circuit breaker. If None, requests are always sent
+
+    timeout : float or tuple, default (5, 20)
+        Connect and read timeouts (seconds), unless the caller passes one
+
+    retries : int, default 3
+        Times a failed request is re-sent
+
+    backoff : float, default 0.5
+        Base of the exponential backoff between retries (seconds). The
+        wait before retry n is uniform in [0, backoff * 2**n]
+    '''
+
+    retry_statuses = (500, 502, 504)
+
+    def __init__(self, cache=None, limiter=None, breaker=None,
+                 timeout=(5, 20), retries=3, backoff=0.5, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.limiter = limiter
+        self.breaker = breaker
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, request, **kwargs):
+        if self.cache is None or request.method != 'GET':
+            return self._send(request, **kwargs)
+        entry = self.cache.lookup(request.url)
+        if entry and entry['fresh']:
+            self.cache.stats['hits'] += 1
+            return self._cached_response(request, entry)
+        if entry:
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+        response = self._send(request, **kwargs)
+        if entry and response.status_code == 304:
+            self.cache.stats['revalidated'] += 1
+            self.cache.refresh(request.url)
+            return self._cached_response(request, entry)
+        self.cache.stats['misses'] += 1
+        self.cache.store(request.url, response)
+        return response
+
+    def _send(self, request, **kwargs):
+        '''
+        Helper function for self.send()
+        Sends request over the network with timeouts, bounded retries and
+        the circuit breaker
+        '''
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        for attempt in range(self.retries + 1):
+            if self.breaker is not None:
+                self.breaker.before(request.url)
+            try:
+                response = self._paced_send(request, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                if attempt == self.retries:
+                    raise
+            else:
+                failed = response.status_code in CosDNAAdapter.retry_statuses
+                if self.breaker is not None:
+                    # a 503, or a 429 still throttled after the limiter's
+                    # backoffs, means CosDNA is down as much as a 500 does
+                    self.breaker.record(response.status_code < 500
+                                        and response.status_code != 429)
+                if not failed or attempt == self.retries:
+                    return response
+            time.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+    def _paced_send(self, request, **kwargs):
+        '''
+        Helper function for self._send()
+        Sends request over the network, paced by self.limiter. Throttled
+        (429/503) requests are re-sent once the limiter's pause is over
+        '''
+        if self.limiter is None:
+            return super().send(request, **kwargs)
+        for _ in range(self.limiter.max_backoffs + 1):
+            self.limiter.acquire()
+            status, retry_after = None, None
+            start = time.monotonic()
             try:
-                ingredient_index = self._routine_ids.index(ingredient_id)
-                if product_vector[ingredient_index] == 1:
-                    isolated_products.append(self.products[i].name)
-            except:
-                print(f'Routine does not have {ingredient}.')
+                response = super().send(request, **kwargs)
+                status = response.status_code
+                retry_after = response.headers.get('Retry-After')
+            finally:
+                self.limiter.release(status, time.monotonic() - start,
+                                     retry_after)
+            if status not in RateLimiter.throttled:
                 break
-        return isolated_products
+        return response
 
-    @property
-    def routine(self):
-        try:
-            return [product.name for product in self.products]
-        except:
-            return self.products
+    def _cached_response(self, request, entry):
+        '''
+        Helper function for self.send()
+        Rebuilds a requests.Response from a ResponseCache entry
+        '''
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body']
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers
+        )
+        response.url = entry['url']
+        response.request = request
+        response.connection = self
+        return response
 
-    @property
-    def cosdna_urls(self):
-        return [product.cosdna_url for product in self.products]
 
-    @property
-    def brands(self):
-        return [product.brand for product in self.products]
+class Transport():
+    '''
+    Keep-alive HTTP transport shared by every CosDNA() object.
 
-    @property
-    def linked(self):
-        try:
-            return all([product.linked for product in self.products])
-        except:
-            return False
+    Product(), Ingredient() and Routine() used to each be their own
+    HTMLSession, so every object opened its own connection pool. All
+    requests now go through one HTMLSession whose connection pool is
+    reused across objects.
+
+    Parameters
+    ----------
+    pool_size : int, default 10
+        Maximum number of keep-alive connections kept open per host.
+        Should be at least the `concurrency` used in Routine.link_sync()
+
+    cache : ResponseCache, default None
+        On-disk response cache used under Cosmetic.sync() and
+        Cosmetic._search(). If None, responses are not cached
+
+    limiter : RateLimiter, default None
+        Rate limiter shared by all requests. If None, requests are not paced
+
+    breaker : CircuitBreaker, default None
+        Circuit breaker shared by all requests. If None, requests are
+        always sent
+
+    timeout, retries : see CosDNAAdapter()
+    '''
+
+    def __init__(self, pool_size=10, cache=None, limiter=None, breaker=None,
+                 timeout=(5, 20), retries=3):
+        self.session = HTMLSession()
+        self.requests = 0
+        self.cache = cache
+        self.limiter = limiter
+        self.breaker = breaker
+        self.timeout = timeout
+        self.retries = retries
+        self.adapter = None
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size):
+        '''
+        Replaces the connection pool with one holding `pool_size`
+        connections per host. Open connections in the old pool are closed
+        '''
+        if self.adapter is not None:
+            self.adapter.close()
+        self.pool_size = pool_size
+        self.adapter = CosDNAAdapter(cache=self.cache, limiter=self.limiter,
+                                     breaker=self.breaker,
+                                     timeout=self.timeout,
+                                     retries=self.retries,
+                                     pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        return self
+
+    def set_cache(self, cache):
+        '''
+        Replaces the response cache. Pass None to disable caching
+        '''
+        self.cache = cache
+        self.adapter.cache = cache
+        return self
+
+    def set_limiter(self, limiter):
+        '''
+        Replaces the rate limiter. Pass None to disable pacing
+        '''
+        self.limiter = limiter
+        self.adapter.limiter = limiter
+        return self
+
+    def set_breaker(self, breaker):
+        '''
+        Replaces the circuit breaker. Pass None to disable it
+        '''
+        self.breaker = breaker
+        self.adapter.breaker = breaker
+        return self
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return self.session.get(url, **kwargs)
 
     @property
-    def synced(self):
+    def sockets_opened(self):
+        '''
+        Number of connections opened by the pool since set_pool_size()
+        '''
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+# CSS selectors used on CosDNA pages, compiled to XPath once.
+# parse_*_page() run them straight on the lxml tree instead of wrapping
+# every match in a requests_html Element
+_SELECT = {
+    name: CSSSelector(css, translator='html') for name, css in [
+        ('td', 'td'),
+        ('text_danger', '.text-danger'),
+        ('rows', '.tr-i'),
+        ('text_muted', '.text-muted'),
+        ('brand', '.brand-name'),
+        ('product', '.prod-name'),
+        ('name', '.text-vampire'),
+        ('aliases', 'div.chem.mb-5 > div.mb-2'),
+        ('chemistry', 'div.d-flex.justify-content-between'),
+        ('description', 'div.chem.mb-5 > div.linkb1.ls-2.lh-1'),
+    ]
+}
+_HREF = lxml.etree.XPath('.//a/@href')
+_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def _first(name, element):
+    '''
+    Helper function for parse_*_page()
+    Returns the first match of selector `name` under element, or None
+    '''
+    found = _SELECT[name](element)
+    return found[0] if found else None
+
+
+def _text(name, element):
+    '''
+    Helper function for parse_*_page()
+    Returns the text of the first match of selector `name`, the same way
+    requests_html's Element.text does. Raises AttributeError if there is
+    no match
+    '''
+    return extract_text(_first(name, element))
+
+
+def _href(element):
+    found = _HREF(element)
+    return found[0] if found else None
+
+
+def parse_search_page(content):
+    '''
+    Reads a CosDNA search results page
+
+    Parameters
+    ----------
+    content : bytes
+        Raw page
+
+    Returns
+    -------
+    dict with
+    - 'href' : link to the top result, or None if there is none
+    - 'no_results' : True if CosDNA says the search has no hits
+    '''
+    root = lxml.html.document_fromstring(content, parser=_PARSER)
+    top = _first('td', root)    # top result
+    if top is not None:
+        return {'href': _href(top), 'no_results': False}
+    return {'href': None,
+            'no_results': _first('text_danger', root) is not None}
+
+
+def parse_product_page(content):
+    '''
+    Reads a CosDNA product page
+
+    Parameters
+    ----------
+    content : bytes
+        Raw page
+
+    Returns
+    -------
+    dict with
+    - 'brand', 'product' : names as they appear on the page
+    - 'ingredients' : list of {'name', 'href'} in the order listed. 'href'
+      is None for ingredients without a CosDNA page
+    '''
+    root = lxml.html.document_fromstring(content, parser=_PARSER)
+    ingredients = []
+    for row in _SELECT['rows'](root):
+        cells = _SELECT['td'](row)
+        if len(cells) == 5:
+            # ingredient, function, acne, irritant, safety
+            ing = cells[0]
+            ingredients.append({
+                'name': extract_text(ing).strip().lower(),
+                'href': _href(ing),
+            })
+        else:
+            ingredients.append({
+                'name': _text('text_muted', cells[0]).strip().lower(),
+                'href': None,
+            })
+    return {
+        'brand': _text('brand', root).lower(),
+        'product': _text('product', root).lower(),
+        'ingredients': ingredients,
+    }
+
+
+def parse_ingredient_page(content):
+    '''
+    Reads a CosDNA ingredient page
+
+    Parameters
+    ----------
+    content : bytes
+        Raw page
+
+    Returns
+    -------
+    dict with 'cosdna_name', 'aliases', 'mass', 'hlb', 'cas_no' and
+    'description'
+    '''
+    root = lxml.html.document_fromstring(content, parser=_PARSER)
+    mass, hlb, cas_no = _chemical_info(_text('chemistry', root))
+    return {
+        'cosdna_name': _text('name', root).lower(),
+        'aliases': _text('aliases', root).lower().split(', '),
+        'mass': mass,
+        'hlb': hlb,
+        'cas_no': cas_no,
+        'description': _text('description', root),
+    }
+
+
+def _parse_search_page_html(content):
+    '''
+    Reference implementation of parse_search_page() on requests_html.
+    Used by check_parsers() and benchmark_parsers()
+    '''
+    html = HTML(html=content)
+    top = html.find('td', first=True)   # top result
+    if top:
+        return {'href': top.xpath('//a/@href', first=True),
+                'no_results': False}
+    return {'href': None, 'no_results': bool(html.find('.text-danger'))}
+
+
+def _parse_product_page_html(content):
+    '''
+    Reference implementation of parse_product_page() on requests_html.
+    Used by check_parsers() and benchmark_parsers()
+    '''
+    html = HTML(html=content)
+    ingredients = []
+    for row in html.find('.tr-i'):
+        cells = row.find('td')
+        if len(cells) == 5:
+            # ingredient, function, acne, irritant, safety
+            ing, _, _, _, _ = cells
+            ingredients.append({
+                'name': ing.text.strip().lower(),
+                'href': ing.xpath('//a/@href', first=True),
+            })
+        else:
+            ing = cells[0]
+            ingredients.append({
+                'name': ing.find('.text-muted', first=True).text.strip()
+                           .lower(),
+                'href': None,
+            })
+    return {
+        'brand': html.find('.brand-name', first=True).text.lower(),
+        'product': html.find('.prod-name', first=True).text.lower(),
+        'ingredients': ingredients,
+    }
+
+
+def _parse_ingredient_page_html(content):
+    '''
+    Reference implementation of parse_ingredient_page() on requests_html.
+    Used by check_parsers() and benchmark_parsers()
+    '''
+    html = HTML(html=content)
+    mass, hlb, cas_no = _chemical_info(
+        html.find('div.d-flex.justify-content-between', first=True).text
+    )
+    return {
+        'cosdna_name': html.find('.text-vampire', first=True).text.lower(),
+        'aliases': html.find('div.chem.mb-5 > div.mb-2', first=True)
+                       .text.lower().split(', '),
+        'mass': mass,
+        'hlb': hlb,
+        'cas_no': cas_no,
+        'description': html.find('div.chem.mb-5 > div.linkb1.ls-2.lh-1',
+                                 first=True).text,
+    }
+
+
+def _chemical_info(ci):
+    '''
+    Helper function for parse_ingredient_page()
+
+    Returns the molar mass, hydro-/lipo-philic balance, and CAS Registry
+    Number from the chemical information block of an ingredient page
+    '''
+    mass, hlb, cas_no = None, None, None
+    if 'Molecular Weight' in ci:
         try:
-            return all([product.synced for product in self.products])
-        except:
-            return False
+            mass = float(re.findall(r".*Weight[^\d\.]+(\d+\.\d+).*", ci)[0])
+        except (IndexError, ValueError):
+            mass = None
+    if 'HLB' in ci:
+        try:
+            hlb = float(re.findall(r".*HLB[^\d\.]+(\d+\.\d+).*", ci)[0])
+        except (IndexError, ValueError):
+            hlb = None
+    if 'Cas No' in ci:
+        cas_no = re.findall(r".*Cas No[^\d\-]+(\d+\-\d+\-\d+).*", ci)[0]
+    return mass, hlb, cas_no
 
-    @property
-    def ingredients(self):
-        return list(set(self._routine_ingredients))
 
-    @property
-    def top(self):
-        return self.top_ingredients(10)
+class _StringTable():
+    '''
+    Read-only list of strings stored in an IndexBundle section: UTF-8
+    bytes back to back, plus int32 offsets. Sorted tables support find()
+    '''
 
-#     def __str__(self):
-#         return f'Routine "{self.name}" with {len(self.routine)} products'
+    def __init__(self, buffer, start, offsets):
+        self._buffer, self._start, self._offsets = buffer, start, offsets
 
-#     def __repr__(self):
-#         return f'Routine(name={self.name}, routine={[product.name for product in self.routine]})'
+    def __len__(self):
+        return len(self._offsets) - 1
 
+    def __getitem__(self, i):
+        start = self._start + int(self._offsets[i])
+        end = self._start + int(self._offsets[i + 1])
+        return self._buffer[start:end].decode()
 
-def ngrams(string, n=3):
-    string = string.encode("ascii", errors="ignore").decode()
-    string = string.lower()
-    chars_to_remove = [")", "(", ".", "|", "[", "]", "{", "}", "'", '"',
-                       "?", "!"]
-    rx = '[' + re.escape(''.join(chars_to_remove)) + ']'
-    string = re.sub(rx, '', string)
-    string = string.replace('&', 'and')
-    string = string.replace(',', ' ')
-    string = string.replace('-', ' ')
-    string = re.sub(' +',' ',string).strip()
-    string = ' '+ string +' ' # pad names for ngrams...
-    ngrams = zip(*[string[i:] for i in range(n)])
-    return [''.join(ngram) for ngram in ngrams]
+    def find(self, string):
+        '''
+        Returns the position of string, or -1. Only for sorted tables
+        '''
+        i = bisect.bisect_left(self, string)
+        if i < len(self) and self[i] == string:
+            return i
+        return -1
+
+    @staticmethod
+    def pack(strings):
+        encoded = [string.encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype='<i4')
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        return b''.join(encoded), offsets
+
+
+class _BundleNames(Mapping):
+    '''
+    cosdna_id -> name, read from an IndexBundle. Stands in for the dict
+    that was unpickled from DATA_DIR/master_dict.pickle
+    '''
+
+    def __init__(self, bundle):
+        self._bundle = bundle
+
+    def __getitem__(self, cosdna_id):
+        i = self._bundle.intern(cosdna_id)
+        if i < 0:
+            raise KeyError(cosdna_id)
+        return self._bundle.name(i)
+
+    def __iter__(self):
+        return iter(self._bundle.ids)
+
+    def __len__(self):
+        return len(self._bundle)
+
+
+class IndexBundle():
+    '''
+    Versioned, memory-mapped index of the ingredient catalog, built
+    offline with IndexBundle.build() and opened lazily with
+    IndexBundle.load().
+
+    Every process maps the same file instead of deserializing the catalog,
+    so the operating system shares its pages and opening it takes the same
+    time however large the catalog grows.
+
+    Holds:
+    - ids: every cosdna_id, sorted. A cosdna_id's position is its interned
+        int32 id, see intern()
+    - names / cosdna_names: per interned id
+    - keys: every cleaned name, CosDNA name, alias and CAS No., sorted, and
+        the interned id each resolves to, see lookup()
+    - grams: character trigrams of the keys (see ngrams()) with their
+        posting lists, see fuzzy()
+
+    Parameters
+    ----------
+    path : str
+        Bundle built with IndexBundle.build(). IndexBundle.load() and
+        IndexBundle.build() default to IndexBundle.path,
+        DATA_DIR/index.bundle, where DATA_DIR is the data directory next
+        to this file
+
+    >>> bundle = IndexBundle.load()
+    >>> bundle.lookup('Aqua')
+    '90172810251'
+    >>> bundle.fuzzy('niacinamid', k=1)
+    [('af81356377', 'niacinamide', 0.75)]
+    '''
+
+    version = 1
+    magic = b'HKRIDX\x00\x00'
+    path = os.path.join(DATA_DIR, 'index.bundle')
+    catalog = os.path.join(DATA_DIR, 'ingredients', 'ingredients.json')
+
+    _shared = {}                # path -> IndexBundle, one per process
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            self._mmap = mmap.mmap(handle.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        if self._mmap[:8] != IndexBundle.magic:
+            raise ValueError(f'{path} is not an index bundle')
+        version, size = np.frombuffer(self._mmap, '<u4', 2, 8)
+        self.header = json.loads(self._mmap[16:16 + size].decode())
+        if version != IndexBundle.version:
+            raise ValueError(f'{path} has version {version}, '
+                             f'expected {IndexBundle.version}')
+        self.ids = self._strings('ids')
+        self.names = self._strings('names')
+        self.cosdna_names = self._strings('cosdna_names')
+        self.keys = self._strings('keys')
+        self.key_ids = self._array('key_ids')
+        self.grams = self._strings('grams')
+        self.gram_indptr = self._array('gram_indptr')
+        self.gram_keys = self._array('gram_keys')
+        self.key_gram_counts = self._array('key_gram_counts')
+
+    def _array(self, section):
+        offset, length, dtype = self.header['sections'][section]
+        return np.frombuffer(self._mmap, dtype,
+                             length // np.dtype(dtype).itemsize, offset)
+
+    def _strings(self, section):
+        return _StringTable(self._mmap,
+                            self.header['sections'][section][0],
+                            self._array(section + '_offsets'))
+
+    @classmethod
+    def load(cls, path=None, catalog=None):
+        '''
+        Returns this process's IndexBundle for path, mapping it on first
+        use. (Re)builds the bundle first if it is missing, from an older
+        version, or older than the catalog
+        '''
+        path = path or cls.path
+        catalog = catalog or cls.catalog
+        with cls._lock:
+            bundle = cls._shared.get(path)
+            if bundle is None:
+                try:
+                    bundle = cls(path)
+                    if bundle.stale(catalog):
+                        bundle = None
+                except (OSError, ValueError):
+                    bundle = None
+                if bundle is None:
+                    cls.build(catalog, path)
+                    bundle = cls(path)
+                cls._shared[path] = bundle
+        return bundle
+
+    def stale(self, catalog=None):
+        '''
+        Returns True if catalog changed since the bundle was built.
+        A bundle shipped without its catalog is never stale
+        '''
+        catalog = catalog or IndexBundle.catalog
+        if not os.path.exists(catalog):
+            return False
+        built_from = self.header['catalog']
+        return (os.path.getsize(catalog) != built_from['size']
+                or os.path.getmtime(catalog) != built_from['mtime'])
+
+    @staticmethod
+    def build(catalog=None, path=None):
+        '''
+        Builds an IndexBundle from the catalog (see load_catalog()) and
+        writes it to path. The file is replaced atomically, so processes
+        that mapped the old bundle keep reading it undisturbed
+
+        Returns path
+        '''
+        catalog = catalog or IndexBundle.catalog
+        path = path or IndexBundle.path
+        records = load_catalog(catalog)
+        records.setdefault('unavailable', {'name': 'unavailable',
+                                           'cosdna_name': 'unavailable',
+                                           'aliases': [], 'cas_no': None})
+        ids = sorted(records)
+        interned = {cosdna_id: i for i, cosdna_id in enumerate(ids)}
+        # earlier fields win when two records share a key
+        key_ids = {}
+        for field in ('cosdna_name', 'name', 'aliases', 'cas_no'):
+            for cosdna_id in ids:
+                values = records[cosdna_id].get(field) or []
+                if isinstance(values, str):
+                    values = [values]
+                for value in values:
+                    key = Cosmetic.clean(value)
+                    if key and cosdna_id != 'unavailable':
+                        key_ids.setdefault(key, interned[cosdna_id])
+        keys = sorted(key_ids)
+        postings = defaultdict(list)
+        key_gram_counts = np.zeros(len(keys), dtype='<i4')
+        for i, key in enumerate(keys):
+            grams = set(ngrams(key))
+            key_gram_counts[i] = len(grams)
+            for gram in grams:
+                postings[gram].append(i)
+        grams = sorted(postings)
+        gram_indptr = np.zeros(len(grams) + 1, dtype='<i4')
+        gram_indptr[1:] = np.cumsum([len(postings[g]) for g in grams])
+        gram_keys = np.array([i for g in grams for i in postings[g]],
+                             dtype='<i4')
+
+        sections = {}
+        for name, strings in [
+            ('ids', ids),
+            ('names', [records[i]['name'] for i in ids]),
+            ('cosdna_names', [records[i]['cosdna_name'] for i in ids]),
+            ('keys', keys),
+            ('grams', grams),
+        ]:
+            sections[name], sections[name + '_offsets'] = \
+                _StringTable.pack(strings)
+        sections['key_ids'] = np.array([key_ids[k] for k in keys],
+                                       dtype='<i4')
+        sections['gram_indptr'] = gram_indptr
+        sections['gram_keys'] = gram_keys
+        sections['key_gram_counts'] = key_gram_counts
+
+        # header size depends on the offsets it lists: lay out the
+        # sections after a generously sized header
+        body, layout, offset = [], {}, 0
+        for name, data in sections.items():
+            raw = data if isinstance(data, bytes) else data.tobytes()
+            dtype = 'u1' if isinstance(data, bytes) else data.dtype.str
+            padding = -offset % 8
+            body.append(b'\x00' * padding + raw)
+            offset += padding
+            layout[name] = [offset, len(raw), dtype]
+            offset += len(raw)
+        header = {
+            'version': IndexBundle.version,
+            'built_at': time.time(),
+            'catalog': {'path': os.path.abspath(catalog),
+                        'size': os.path.getsize(catalog),
+                        'mtime': os.path.getmtime(catalog)},
+            'ingredients': len(ids),
+            'sections': layout,
+        }
+        base = 16 + len(json.dumps(header)) + 64 * len(layout)
+        base += -base % 8
+        for section in layout.values():
+            section[0] += base
+        header = json.dumps(header).encode()
+        header += b' ' * (base - 16 - len(header))
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as handle:
+            handle.write(IndexBundle.magic)
+            handle.write(np.array([IndexBundle.version, len(header)],
+                                  dtype='<u4').tobytes())
+            handle.write(header)
+            handle.write(b''.join(body))
+        os.replace(temp_path, path)
+        return path
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, cosdna_id):
+        '''
+        Returns the int32 id of cosdna_id, or -1 if it is not in the bundle
+        '''
+        return self.ids.find(cosdna_id)
+
+    def cosdna_id(self, i):
+        return self.ids[i]
+
+    def name(self, i):
+        return self.names[i]
+
+    @property
+    def master_dict(self):
+        return _BundleNames(self)
+
+    def lookup(self, name):
+        '''
+        Returns the cosdna_id whose name, CosDNA name, alias or CAS No. is
+        name, or None
+        '''
+        i = self.keys.find(Cosmetic.clean(name))
+        if i < 0:
+            return None
+        return self.ids[int(self.key_ids[i])]
+
+    def fuzzy(self, name, k=5):
+        '''
+        Returns up to k (cosdna_id, key, score) for the keys sharing the
+        most character trigrams with name, best first. score is the
+        Jaccard similarity of the trigram sets
+        '''
+        grams = set(ngrams(Cosmetic.clean(name)))
+        postings = []
+        for gram in grams:
+            i = self.grams.find(gram)
+            if i >= 0:
+                postings.append(
+                    self.gram_keys[self.gram_indptr[i]:self.gram_indptr[i + 1]]
+                )
+        if not postings:
+            return []
+        overlap = np.bincount(np.concatenate(postings),
+                              minlength=len(self.keys))
+        scores = overlap / (len(grams) + self.key_gram_counts - overlap)
+        k = min(k, np.count_nonzero(overlap))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(self.ids[int(self.key_ids[i])], self.keys[i],
+                 float(scores[i])) for i in best]
+
+
+class Interner():
+    '''
+    Maps cosdna_ids to dense int32 codes, in order of first use, so
+    routines can be analyzed as integer arrays (see Routine._analyze())
+    instead of lists of strings. Thread-safe.
+
+    >>> CosDNA.interner.codes(['90172810251', '205eb9166'])
+    array([0, 1], dtype=int32)
+    >>> CosDNA.interner.ids([1])
+    ['205eb9166']
+    '''
+
+    def __init__(self):
+        self._codes = {}
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def code(self, cosdna_id):
+        '''
+        Returns the code of cosdna_id, assigning the next one if it has none
+        '''
+        code = self._codes.get(cosdna_id)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(cosdna_id)
+                if code is None:
+                    code = self._codes[cosdna_id] = len(self._ids)
+                    self._ids.append(cosdna_id)
+        return code
+
+    def codes(self, cosdna_ids):
+        return np.array([self.code(cosdna_id) for cosdna_id in cosdna_ids],
+                        dtype=np.int32)
+
+    def get(self, cosdna_id):
+        '''
+        Returns the code of cosdna_id, or -1 if it has none
+        '''
+        return self._codes.get(cosdna_id, -1)
+
+    def ids(self, codes):
+        return [self._ids[code] for code in codes]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class _Lazy():
+    '''
+    Class attribute computed on first access, once per process
+    '''
+
+    def __init__(self, load):
+        self._load = load
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._load()
+        return self._value
+
+
+class CosDNA():
+    '''
+    Parent class for connecting to CosDNA.com database.
+    Not intended to be used on its own.
+
+    All instances share CosDNA.transport. Resize its connection pool with
+    CosDNA.transport.set_pool_size(), or change how requests are paced with
+    CosDNA.transport.set_limiter()
+
+    Catalog data is served from an IndexBundle, mapped on first use
+    (see CosDNA.master_dict and CosDNA.index)
+    '''
+
+    # cosdna_id -> name, mapped from the IndexBundle on first use
+    master_dict = _Lazy(lambda: IndexBundle.load().master_dict)
+    index = _Lazy(IndexBundle.load)
+
+    # cosdna_id <-> int32 code, shared by every Routine()
+    interner = Interner()
+
+    transport = Transport(cache=ResponseCache(), limiter=RateLimiter(),
+                          breaker=CircuitBreaker())
+
+    # synced products and ingredients, shared by cosdna_id
+    registry = SyncRegistry()
+
+    # products and ingredients keep no per-instance __dict__, see
+    # measure_memory(). Routine() has one, it does not declare __slots__
+    __slots__ = ('_name', '_synced')
+
+    # fields of old pickles that are not restored: responses, and the
+    # session settings of pickles from when CosDNA was an HTMLSession
+    _unpickled_fields = ('_r',) + tuple(requests.Session.__attrs__)
+
+    def __init__(self, name=None):
+        self._name = name
+        self._synced = False    # synced in child classes
+
+    def get(self, url, **kwargs):
+        return CosDNA.transport.get(url, **kwargs)
+
+    def __setstate__(self, state):
+        '''
+        Restores a pickle, including pickles from before __slots__ (a plain
+        __dict__). Fields the pickle lacks keep the defaults of a new
+        instance; fields since removed are dropped
+        '''
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        defaults = type(self)()
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(defaults, name):
+                    setattr(self, name, getattr(defaults, name))
+        if hasattr(defaults, '__dict__'):
+            self.__dict__.update(defaults.__dict__)
+        for name, value in state.items():
+            if name in CosDNA._unpickled_fields:
+                continue
+            try:
+                setattr(self, name, value)
+            except AttributeError:
+                pass
+
+    @staticmethod
+    def response_hook(response, *args, **kwargs):
+        # referenced by pickles from when CosDNA was an HTMLSession
+        return response
+
+
+class Cosmetic(CosDNA):
+    '''
+    Parent class for organizing Products and Ingredients from CosDNA.com.
+    Not intended to be used on its own.
+    '''
+
+    # every URL is built from _domain, see Cosmetic.set_domain()
+    _domain = 'https://cosdna.com'
+
+    # cosdna_id in a CosDNA URL, see Cosmetic.cosdna_id
+    _id_pattern = re.compile("eng/(.*).html")
+
+    product_stop_words = [
+        'cleanser',
+        'cream',
+        'lotion',
+        'mask',
+        'masque',
+        'moisturizer',
+        'serum',
+        'sunblock',
+        'sunscreen',
+        'toner',
+        'treatment'
+    ]
+
+    sort_dict = {
+        'latest': '&sort=date',
+        'featured': '&sort=featured',
+        'clicks': '&sort=click',
+        'reviews': '&sort=review'
+    }
+
+    # query -> cosdna_url memo shared by every Product() and Ingredient()
+    searches = SearchCache()
+
+    # if False (batch mode), searches without hits are added to
+    # Cosmetic.pending instead of asking for a new search with input()
+    interactive = True
+    pending = PendingQueue()
+
+    # synced products and ingredients, read before fetching. Syncs are
+    # appended to a log and folded into the catalog in the background
+    catalog = Catalog(log=SyncLog())
+
+    # if True (debugging), pages are kept zlib-compressed after parsing,
+    # see Cosmetic.html. Otherwise only the parsed fields are kept
+    keep_html = False
+
+    __slots__ = ('_cosdna_url', '_cosdna_id', '_query', '_skip', 'failure',
+                 '_r', '_html')
+
+    def __init__(self, name=None, cosdna_url=None, cosdna_id=None):
+        super().__init__(name)
+        self._cosdna_url = cosdna_url
+        self._cosdna_id = cosdna_id
+        self._query = name      # child classes set search terms in link()
+        self._skip = False
+        self.failure = None     # Failure() if link or sync went wrong
+        self._r = None          # response being parsed, see self._release()
+        self._html = None
+
+    def link(self, sort=None, cosdna_url=None, _base_url=None):
+        '''
+        Updates self._cosdna_url if cosdna_url is valid.
+        If cosdna_url blank, checks if self._cosdna_url is valid
+        If self._cosdna_url blank, searches for CosDNA URL
+        '''
+        if cosdna_url:
+            self._set_cosdna_url(cosdna_url)
+        elif not self.cosdna_url:
+            self._search(sort=sort, _base_url=_base_url)
+
+    def _search(self, sort=None, _base_url=None):
+        '''
+        self.link() > _search()
+        Makes a GET request to search_url
+        Child classes define more actions
+        '''
+        # self._query defined in child classes
+        if self._query and not self._skip:
+            if self._cached_search(sort=sort, _base_url=_base_url):
+                return self
+            search_url = self._get_search_url(query=self._query,
+                                              sort=sort,
+                                              _base_url=_base_url)
+            if self._fetch(search_url, stage='search'):
+                self._parse(self._read_search, sort=sort, _base_url=_base_url)
+            return self
+        else:
+            print('Link with valid CosDNA URL or product name to proceed.')
+            return self
+
+    def _read_search(self, sort=None, _base_url=None):
+        '''
+        self.link() > _search() > _read_search()
+        Reads the top result from the search page stored in self._r
+        Kept apart from _search() so search pages fetched elsewhere (e.g.
+        Routine.link_sync(concurrency=N)) are read the same way
+        '''
+        query = self.clean(self._query, query=True)
+        page = parse_search_page(self._r.content)
+        if page['href']:
+            self._cosdna_url = Cosmetic._domain + page['href']
+            Cosmetic.searches.store(_base_url, query, sort, self._cosdna_url)
+            return self
+        else:
+#                 temp_query = self._query.split(' ')
+#                 temp_query = ' '.join([w for w in temp_query if w not in Cosmetic.stop_words])
+#                 temp_search_url = self._get_search_url(sort, temp_query, _base_url)
+            # no result
+            if page['no_results']:
+                Cosmetic.searches.store(_base_url, query, sort, None)
+                return self._no_results(sort=sort, _base_url=_base_url)
+            else:
+                self._cosdna_url = self._r.url
+                Cosmetic.searches.store(_base_url, query, sort,
+                                        self._cosdna_url)
+                return self
+
+    def _cached_search(self, sort=None, _base_url=None):
+        '''
+        self.link() > _search() > _cached_search()
+        Resolves self._query from Cosmetic.searches without a request
+        Returns False if the query has to be searched on CosDNA
+        '''
+        cosdna_url = Cosmetic.searches.lookup(
+            _base_url, self.clean(self._query, query=True), sort
+        )
+        if cosdna_url is SearchCache.MISS:
+            return False
+        if cosdna_url:
+            self._cosdna_url = cosdna_url
+        else:
+            self._no_results(sort=sort, _base_url=_base_url)
+        return True
+
+    def _no_results(self, sort=None, _base_url=None):
+        '''
+        Helper function for self._read_search() and self._cached_search()
+        Asks for a new search when self._query has no hits on CosDNA
+        In batch mode, queues self._query in Cosmetic.pending instead
+        '''
+        query = self.clean(self._query, query=True)
+        if Cosmetic.pending.skipped(_base_url, query, sort):
+            self._skip = True
+            return self
+        if not Cosmetic.interactive:
+            Cosmetic.pending.add(_base_url, query, sort, name=self._name)
+            return self
+        print(f'No results for {self._name} on CosDNA.')
+        print("Enter new search (to skip search, enter 'SKIP' w/o quotes):")
+        self._query = input(' ')
+        if self._query == 'SKIP':
+            self._skip = True
+            return self
+        else:
+            return self._search(sort=sort, _base_url=_base_url)
+
+    def _get_search_url(self, query, sort=None, _base_url=None):
+        '''
+        self.link() > _search() > _get_search_url()
+        Generates a php search_url directly from query
+        Child classes define _base_url
+        '''
+        query = self.clean(query, query=True)
+        # _base_url defined in child classes
+        # Product() has different sort options, Ingredient() does not
+        if sort in [*Cosmetic.sort_dict]:
+            search_url = _base_url + query + Cosmetic.sort_dict[sort]
+        else:
+            search_url = _base_url + query
+        return search_url
+
+    @staticmethod
+    def clean(string, query=False):
+        '''
+        Normalizes a product or ingredient name: lowercase, only letters,
+        digits, spaces, hyphens and apostrophes, hyphenated words split
+        If query, joins words with '+' for use in a search URL
+        '''
+        string = _clean_name(string)
+        if query:
+            string = string.replace(' ', '+')
+        return string
+
+    def sync(self):
+        '''
+        Sets up scrape from linked url
+        Child classes define more actions
+        '''
+        if self._skip:
+            pass
+        elif self.cosdna_url:
+            # child classes define more actions
+            self._fetch(self.cosdna_url, stage='sync')
+        else:
+            print('Initialize or link with valid CosDNA URL to proceed')
+        return self
+
+    def _fetch(self, url, stage):
+        '''
+        self.link() > _search() > _fetch()
+        self.sync() > _fetch()
+
+        GETs url into self._r. Returns True on success. If the request
+        fails or CosDNA answers with an error status, records self.failure
+        and returns False instead of raising
+        '''
+        try:
+            self._r = self.get(url)
+            self._r.raise_for_status()
+        except requests.exceptions.RequestException as error:
+            self._fail(stage, url, error)
+            self._release()
+            return False
+        self.failure = None
+        return True
+
+    def _parse(self, read, **kwargs):
+        '''
+        Calls read(**kwargs) on the page stored in self._r, then releases it
+        Records a 'parse' failure instead of raising if the page is not laid
+        out as expected
+        '''
+        try:
+            return read(**kwargs)
+        except PARSE_ERRORS as error:
+            return self._fail('parse', self._r.url, error)
+        finally:
+            self._release()
+
+    def _release(self):
+        '''
+        Helper function for self._fetch() and self._parse()
+        Drops the response once its fields are parsed, keeping the page
+        compressed if Cosmetic.keep_html
+        '''
+        if self._r is not None and Cosmetic.keep_html:
+            self._html = zlib.compress(self._r.content)
+        self._r = None
+
+    @property
+    def html(self):
+        '''
+        Last page fetched, if it was kept with Cosmetic.keep_html
+        '''
+        if self._html is not None:
+            return zlib.decompress(self._html).decode('utf-8', 'replace')
+
+    def _fail(self, stage, url, error):
+        self.failure = Failure(stage, url, type(error).__name__, str(error))
+        return self
+
+    @classmethod
+    def _url(cls, key):
+        '''
+        Returns the URL for cls._urls[key] on the current domain
+        '''
+        return Cosmetic._domain + cls._urls[key]
+
+    @staticmethod
+    def set_domain(domain='https://cosdna.com'):
+        '''
+        Points every search and sync at domain, e.g. the URL of a
+        StandIn() server. Call without arguments to go back to CosDNA.com
+        '''
+        Cosmetic._domain = domain.rstrip('/')
+
+    @property
+    def cosdna_url(self):
+        return self._cosdna_url
+
+    def _set_cosdna_url(self, url=None):
+        if url and Cosmetic._domain in url:
+            self._cosdna_url = url
+        else:
+            print('Invalid CosDNA URL')
+
+    @property
+    def cosdna_id(self):
+        '''
+        Returns a unique ingredient identifier based on the URL
+
+        Aliases of the same ingredient point to the same URL in the CosDNA
+        database. In the absence of our own relational database, we rely on
+        this identifier to collapse multiple aliases into a single entry,
+        allowing us to:
+        - collapse aliases together when analyzing routines
+        - search for aliases
+        '''
+        if not self._cosdna_id:
+            if self.cosdna_url:
+                return Cosmetic._id_pattern.findall(self.cosdna_url)[0]
+            else:
+                self._cosdna_id = 'unavailable'
+        return self._cosdna_id
+
+    # linked and synced defined as properties
+    # since Routine() will not share this behavior
+    @property
+    def linked(self):
+        if self.cosdna_url:
+            return True
+        else:
+            return False
+
+    # attributes set by sync(), copied between instances by SyncRegistry
+    _state_fields = ()
+
+    def _get_state(self):
+        return {field: getattr(self, field) for field in self._state_fields}
+
+    def _set_state(self, state):
+        for field, value in state.items():
+            if isinstance(value, list):
+                value = list(value)
+            setattr(self, field, value)
+        self.failure = None
+        return self
+
+    @property
+    def synced(self):
+        return self._synced
+
+    @property
+    def failed(self):
+        return self.failure is not None
+
+
+class Ingredient(Cosmetic):
+    '''
+    Syncs and stores ingredient information from CosDNA.com.
+
+    Search for ingredients based on name, link to CosDNA page, and scrape
+    information to store in instance.
+
+    Parameters
+    ----------
+    name : str, default None
+        Name of ingredient.
+
+    cas_no : str, default None
+        CAS Registry Number
+
+    cosdna_url : str, default None
+        URL of ingredient in CosDNA database
+
+    >>> i = Ingredient('salicylic acid')
+    >>> i.name                                     # returns assigned name
+    'salicylic acid'
+    >>> i.link_sync()                              # scrapes top result
+    >>> i.name                                     # returns CosDNA name
+    'bha'
+
+    >>> i.link('https://cosdna.com/eng/0f1b7f1402.html')    # directly update link
+    >>> i.sync()
+    >>> i.name
+    'capryloyl salicylic acid'
+    '''
+
+    _urls = {
+        'search': '/eng/stuff.php?q='
+    }
+
+    _state_fields = ('_cosdna_name', 'aliases', 'mass', 'hlb', 'cas_no',
+                     'description', '_synced')
+
+    __slots__ = ('cas_no', '_cosdna_name', 'aliases', 'mass', 'hlb',
+                 'description')
+
+    # splits 'water (aqua)' or 'water/aqua/eau', see Ingredient.resolve()
+    _name_parts = re.compile(r'[/()]')
+
+    def __init__(self, name=None, cas_no=None, cosdna_url=None,
+                 cosdna_id=None):
+        super().__init__(name=name, cosdna_url=cosdna_url, cosdna_id=cosdna_id)
+        self.cas_no = cas_no
+
+    def link(self, cosdna_url=None):
+        '''
+        Links Ingredient() to cosdna_url
+
+        Parameters
+        ----------
+        cosdna_url : str, default None
+            CosDNA URL of ingredient
+            If cosdna_url is None, searches for cosdna_url using either:
+                - cas_no (preferential), or
+                - name
+        '''
+        # self._query separated from self._name
+        # to give priority to search via CAS No.
+        if self.cas_no:
+            self._query = self.cas_no
+        else:
+            self._query = self._name
+        return super().link(sort=None, cosdna_url=cosdna_url,
+                            _base_url=Ingredient._url('search'))
+
+    def sync(self, force=False):
+        '''
+        Scrapes information from linked URL
+        - name on CosDNA website
+        - ingredient aliases
+        - molar mass
+        - hydro-/lipo-philic balance
+        - CAS Registry Number
+        - ingredient description
+
+        Visit the following websites for more information:
+        - molar mass: <https://en.wikipedia.org/wiki/Molar_mass>
+        - HLB: <https://en.wikipedia.org/wiki/Hydrophilic-lipophilic_balance>
+        - CAS No.: <https://en.wikipedia.org/wiki/CAS_Registry_Number>
+
+        Ingredients in Cosmetic.catalog are read from it instead.
+        Ingredients with the same cosdna_id share one fetch through
+        CosDNA.registry
+
+        Parameters
+        ----------
+        force : bool, default False
+            Fetches the page again even if the ingredient was synced before
+        '''
+        if not force and self._load():
+            return self
+        return CosDNA.registry.sync(self, self._sync, force=force)
+
+    def _sync(self):
+        '''
+        Helper function for self.sync()
+        Fetches and reads the linked page
+        '''
+        super().sync()          # goes to cosdna_url
+        if not self._skip and self.linked and not self.failed:
+            self._parse(self._read)
+            Cosmetic.catalog.store(self)
+        return self
+
+    def _load(self):
+        '''
+        Helper function for self.sync()
+        Reads the ingredient from Cosmetic.catalog
+        Returns False if it is not there
+        '''
+        if self._skip or not self.linked:
+            return False
+        record = Cosmetic.catalog.ingredient(self.cosdna_id)
+        if record is None:
+            return False
+        self._apply_page(record)
+        return True
+
+    def _record(self):
+        '''
+        Returns the ingredient as a Cosmetic.catalog record
+        '''
+        return {'name': self._name, 'cosdna_name': self._cosdna_name,
+                'aliases': self.aliases, 'mass': self.mass, 'hlb': self.hlb,
+                'cas_no': self.cas_no, 'description': self.description}
+
+    def _read(self):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._read()
+
+        Scrapes the ingredient page stored in self._r
+        '''
+        return self._apply_page(parse_ingredient_page(self._r.content))
+
+    def _apply_page(self, page):
+        '''
+        Helper function for self._read()
+        Stores a record from parse_ingredient_page()
+        '''
+        self._cosdna_name, self.aliases = page['cosdna_name'], page['aliases']
+        self.mass, self.hlb, self.cas_no = (page['mass'], page['hlb'],
+                                            page['cas_no'])
+        self.description = page['description']
+        self._synced = True
+        return self
+
+    def link_sync(self, cosdna_url=None):
+        self.link(cosdna_url=cosdna_url)
+        self.sync()
+        return self
+
+    @staticmethod
+    def resolve(names):
+        '''
+        Returns dict of name -> cosdna_id
+
+        Names are looked up offline first: in CosDNA.index (names, CosDNA
+        names, aliases and CAS No. of the catalog), then in
+        Cosmetic.catalog (ingredients synced so far). INCI-style names such
+        as 'water (aqua)' or 'water/aqua/eau' are also looked up part by
+        part. Only names missing from both are searched on CosDNA
+
+        Parameters
+        ----------
+        names : iterable
+            Ingredient names, aliases or CAS No.
+
+        >>> Ingredient.resolve(['aqua', '7732-18-5'])
+        {'aqua': '90172810251', '7732-18-5': '90172810251'}
+        '''
+        resolved = {}
+        for name in names:
+            if name in resolved:
+                continue
+            candidates = [name] + [part for part in
+                                   Ingredient._name_parts.split(name)
+                                   if part.strip() and part != name]
+            cosdna_id = None
+            for lookup in (CosDNA.index.lookup, Cosmetic.catalog.lookup):
+                for candidate in candidates:
+                    cosdna_id = lookup(candidate)
+                    if cosdna_id is not None:
+                        break
+                if cosdna_id is not None:
+                    break
+            else:
+                cosdna_id = Ingredient(name).link_sync().cosdna_id
+            resolved[name] = cosdna_id
+        return resolved
+
+    @property
+    def name(self):
+        if self.synced:
+            return self._cosdna_name
+        elif self._skip:
+            return 'SKIP: ' + self._name
+        else:
+            return self._name
+
+    # def __str__(self):
+    #     return self.name
+
+
+class Product(Cosmetic):
+    '''
+    Syncs and stores product information from CosDNA.com.
+
+    Search for products based on name, link to CosDNA page, and scrape
+    information to store in instance.
+
+    Parameters
+    ----------
+    name : str, default None
+        Name of ingredient.
+
+    brand : str, default None
+        Name of brand. Does not affect search--purely for internal purposes.
+
+    product : str, default None
+        Name of product. Does not affect search--purely for internal purposes.
+
+    cosdna_url : str, default None
+        URL of ingredient in CosDNA database
+    '''
+
+    _urls = {
+        'search': '/eng/product.php?q='
+    }
+
+    _state_fields = ('_name', 'brand', 'product', '_ingredients', '_synced')
+
+    # _lazy_ingredients is (rows, details) from Routine.load(), until
+    # _ingredients is read
+    __slots__ = ('brand', 'product', '_ingredient_list', '_lazy_ingredients')
+
+    def __init__(self, name=None, brand=None, product=None, cosdna_url=None,
+                 cosdna_id=None):
+        self._lazy_ingredients = None
+        # need `self._name` for `name` property
+        self._name, self.brand, self.product = name, brand, product
+        # initialize using 'name' property
+        super().__init__(name=self.name, cosdna_url=cosdna_url,
+                         cosdna_id=cosdna_id)
+
+    def link(self, sort='featured', cosdna_url=None):
+        '''
+        Links Product() to cosdna_url
+
+        Parameters
+        ----------
+        sort : str, default 'featured'
+            Selects the search parameters to use:
+            - None (the default sort option on CosDNA)
+            - 'latest' : most recent entries first
+            - 'featured': seems to be a weighted average of 'latest' and
+                    'clicks'
+            - 'clicks' : most visited entries first
+            - 'reviews' : most reviews first
+        cosdna_url : str, default None
+            CosDNA URL of ingredient
+            If cosdna_url is None, searches for cosdna_url using name
+        '''
+        self._query = self.name
+        return super().link(sort=sort, cosdna_url=cosdna_url,
+                            _base_url=Product._url('search'))
+
+    def sync(self, deep=False, force=False):
+        '''
+        Scrapes information from linked URL
+        - brand name
+        - product name
+        - ingredient names and corresponding URLs
+        Saves ingredients as Ingredient()
+
+        Products in Cosmetic.catalog are read from it instead. Products
+        with the same cosdna_id share one fetch and the same Ingredient()
+        objects through CosDNA.registry
+
+        Parameters
+        ----------
+        deep : bool, default False
+            Calls Ingredient.sync() on every ingredient in the routine
+
+        force : bool, default False
+            Fetches the page again even if the product was synced before
+        '''
+        if force or not self._load(deep=deep):
+            CosDNA.registry.sync(self, lambda: self._sync(deep=deep),
+                                 force=force)
+        if deep and self.synced:    # result may have been shared shallow
+            for ingredient in self._ingredients:
+                if ingredient.linked and not ingredient.synced \
+                        and not ingredient.failed:  # tried once already
+                    ingredient.sync()
+        return self
+
+    def _sync(self, deep=False):
+        '''
+        Helper function for self.sync()
+        Fetches and reads the linked page
+        '''
+        super().sync()
+        if not self._skip and self.linked and not self.failed:
+            self._parse(self._read, deep=deep)
+            Cosmetic.catalog.store(self)
+        if self._skip or not self.synced:
+            self._ingredients = []
+        return self
+
+    def _load(self, deep=False):
+        '''
+        Helper function for self.sync()
+        Reads the product from Cosmetic.catalog
+        Returns False if it is not there
+        '''
+        if self._skip or not self.linked:
+            return False
+        record = Cosmetic.catalog.product(self.cosdna_id)
+        if record is None:
+            return False
+        rows = [{'name': row['name'],
+                 'href': row['cosdna_id'] and f"/eng/{row['cosdna_id']}.html"}
+                for row in record['ingredients']]
+        self._apply_page({'brand': record['brand'],
+                          'product': record['product'], 'ingredients': rows},
+                         deep=deep)
+        return True
+
+    def _record(self):
+        '''
+        Returns the product as a Cosmetic.catalog record
+        '''
+        return {'name': self.name, 'brand': self.brand,
+                'product': self.product,
+                'ingredients': [
+                    {'name': ingredient._name,
+                     'cosdna_id': (ingredient.cosdna_id if ingredient.linked
+                                   else None)}
+                    for ingredient in self._ingredients
+                ]}
+
+    def _read(self, deep=False):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._read()
+
+        Scrapes the product page stored in self._r
+        '''
+        return self._apply_page(parse_product_page(self._r.content),
+                                deep=deep)
+
+    def _apply_page(self, page, deep=False):
+        '''
+        Helper function for self._read()
+        Stores a record from parse_product_page()
+        '''
+        self._set_name_brand_product(page, self._query)
+        self._ingredients = self._get_ingredients(page['ingredients'],
+                                                  deep=deep)
+        self._synced = True
+        return self
+
+    def link_sync(self, sort='featured', cosdna_url=None, deep=False):
+        self.link(sort=sort, cosdna_url=cosdna_url)
+        self.sync(deep=deep)
+
+    def _set_name_brand_product(self, page, name):
+        """
+        Helper function for self.sync()
+        Sets the brand name and product name of the product as they appear
+        in the linked URL
+        """
+        cosdna_brand, cosdna_product = page['brand'], page['product']
+        cosdna_name = str(cosdna_brand + ' ' + cosdna_product).strip()
+        if cosdna_brand:
+            self.brand, self.product = cosdna_brand, cosdna_product
+        else:
+            self._name = name
+
+    def _get_ingredients(self, rows, deep):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._get_ingredients()
+
+        Returns a list of ingredients in the product as Ingredient()
+
+        Parameters
+        ----------
+        rows : list
+            'ingredients' from parse_product_page()
+
+        deep : bool, default False
+            Calls Ingredient.sync() on every ingredient in the routine
+        '''
+        ingredients = []
+        # not sure if this improves performance. idea taken from scikit-learn
+        ingredients_append = ingredients.append
+        for row in rows:
+            if row['href']:
+                print(row['name'])
+                # function = self._get_function_info(fun)
+                ingredient = Ingredient(
+                    name=row['name'], cosdna_url=Cosmetic._domain + row['href']
+                )
+                if deep:
+                    ingredient.sync()
+            else:
+                ingredient = Ingredient(name=row['name'])
+            ingredients_append(ingredient)
+        return ingredients
+
+    # def _get_function_info(self, fun):
+    #     function = fun.text.strip().lower().split(',')
+    #     if 'sunscreen' in function:
+    #         try:
+    #             uva = re.search("uv[ab]\d",
+    #                             fun.xpath('//img')[0].attrs['src'])[0]
+    #             uvb = re.search("uv[ab]\d",
+    #                             fun.xpath('//img')[1].attrs['src'])[0]
+    #             function.append(uva)
+    #             function.append(uvb)
+    #         except:
+    #             pass
+    #     return function
+
+    @property
+    def name(self):
+        if self.brand is None and self.product is None:
+            return self._name
+        else:
+            self._name = self.brand + ' ' + self.product
+            return self._name
+
+    @property
+    def _ingredients(self):
+        '''
+        Ingredient() objects of the product. Products loaded with
+        Routine.load() create them on first access
+        '''
+        if self._lazy_ingredients is not None:
+            rows, details = self._lazy_ingredients
+            self._ingredients = [Routine._load_ingredient(row, details)
+                                 for row in rows]
+        try:
+            return self._ingredient_list
+        except AttributeError:
+            raise AttributeError("'Product' object has no attribute "
+                                 "'_ingredients'") from None
+
+    @_ingredients.setter
+    def _ingredients(self, ingredients):
+        self._lazy_ingredients = None
+        self._ingredient_list = ingredients
+
+    @property
+    def ingredients(self):
+        if self._lazy_ingredients is not None:
+            rows, details = self._lazy_ingredients
+            return [Routine._ingredient_name(row, details) for row in rows]
+        return [ing.name for ing in self._ingredients]
+
+    @property
+    def cosdna_urls(self):
+        return [ing.cosdna_url for ing in self._ingredients]
+
+    # _cosdna_ids and _ing_dict used for Routine()
+    @property
+    def _cosdna_ids(self):
+        if self._lazy_ingredients is not None:
+            rows, _ = self._lazy_ingredients
+            return [row[1] or 'unavailable' for row in rows]
+        return [ing.cosdna_id for ing in self._ingredients]
+
+    @property
+    def _ingredient_dict(self):
+        return dict(zip(self._cosdna_ids, self.ingredients))
+
+    @property
+    def _codes(self):
+        return CosDNA.interner.codes(self._cosdna_ids)
+
+    def __str__(self):
+        return f'{self.name}\n\n{self.ingredients}'
+
+
+class Routine(CosDNA):
+    '''
+    Container for Product() and Ingredient() objects.
+
+    Tabulates all ingredients in routine.
+
+    Parameters
+    ----------
+    name : str, default None
+        Name of routine. Optional
+
+    routine : list, default None
+        List if products in routine. Products are stored as Product() objects.
+    '''
+
+    # see Routine.save_all()
+    snapshot_format = 'hack-a-routine snapshot'
+    snapshot_version = 1
+
+    # set by self._analyze()
+    _analysis = ('_product_vectors', '_routine_codes', '_routine_dict',
+                 '_counts', '_postings')
+
+    def __init__(self, name=None, routine=None):
+        super().__init__(name)
+        self.products = []
+        if routine:
+            self.add(routine)
+
+    def __getattr__(self, name):
+        # routines from Routine.load() are analyzed on first use
+        if name in Routine._analysis and \
+                self.__dict__.pop('_analyze_pending', False):
+            self._analyze()
+            return getattr(self, name)
+        raise AttributeError(f"'Routine' object has no attribute '{name}'")
+
+    def save(self, path):
+        '''
+        Saves the routine as a snapshot, see Routine.save_all()
+        '''
+        return Routine.save_all([self], path)
+
+    @staticmethod
+    def save_all(routines, path):
+        '''
+        Saves routines to a compact, versioned snapshot: zlib-compressed
+        JSON holding names, cosdna_ids, ingredient id lists and the
+        chemistry fields of synced ingredients. Sessions and fetched pages
+        are left out. Ingredients and identical products shared by several
+        routines are stored once
+
+        Parameters
+        ----------
+        routines : list
+            Routine() objects
+
+        path : str
+            Snapshot file, read back with Routine.load()
+        '''
+        ingredients = {}        # cosdna_id -> chemistry fields
+        products, product_index = [], {}
+        entries = []
+        for routine in routines:
+            indices = []
+            for product in routine.products:
+                entry = Routine._product_entry(product, ingredients)
+                key = repr(entry)
+                if key not in product_index:
+                    product_index[key] = len(products)
+                    products.append(entry)
+                indices.append(product_index[key])
+            analyzed = '_counts' in vars(routine) or \
+                vars(routine).get('_analyze_pending', False)
+            entries.append([routine._name, indices, analyzed])
+        snapshot = {
+            'format': Routine.snapshot_format,
+            'version': Routine.snapshot_version,
+            'saved_at': time.time(),
+            'ingredients': ingredients,
+            'products': products,
+            'routines': entries,
+        }
+        with open(path, 'wb') as handle:
+            handle.write(zlib.compress(json.dumps(snapshot).encode()))
+        return path
+
+    @staticmethod
+    def load(path):
+        '''
+        Loads the routines saved with Routine.save() or Routine.save_all()
+        Returns a list of Routine() objects
+
+        Loading is lazy: routines analyzed when saved are analyzed again
+        when their analysis is first used, and Ingredient() objects are
+        only created when a product's _ingredients are first read. Names
+        and cosdna_ids (all that Routine._analyze() needs) come straight
+        from the snapshot
+
+        Raises ValueError for files that are not snapshots (including
+        truncated ones), and for snapshot versions it can't read
+        '''
+        with open(path, 'rb') as handle:
+            try:
+                snapshot = json.loads(zlib.decompress(handle.read()))
+            except (zlib.error, ValueError):
+                snapshot = None
+        if not isinstance(snapshot, dict) or \
+                snapshot.get('format') != Routine.snapshot_format:
+            raise ValueError(f'{path} is not a routine snapshot')
+        if not isinstance(snapshot.get('version'), int) or \
+                snapshot['version'] < 1:
+            raise ValueError(f'{path} has no valid snapshot version')
+        if snapshot['version'] > Routine.snapshot_version:
+            raise ValueError(f'{path} has snapshot version '
+                             f'{snapshot["version"]}, this version of '
+                             f'hack-a-routine reads up to '
+                             f'{Routine.snapshot_version}')
+        details = snapshot['ingredients']
+        products = snapshot['products']
+        routines = []
+        for name, indices, analyzed in snapshot['routines']:
+            routine = Routine(name)
+            routine.products = [Routine._load_product(products[i], details)
+                                for i in indices]
+            routine._analyze_pending = analyzed
+            routines.append(routine)
+        return routines
+
+    @staticmethod
+    def _product_entry(product, ingredients):
+        '''
+        Helper function for Routine.save_all()
+        Returns product as a snapshot entry, adding the chemistry of its
+        synced ingredients to `ingredients`
+        '''
+        rows = None
+        if product._lazy_ingredients is not None:
+            rows, details = product._lazy_ingredients
+            for row in rows:
+                if row[1] in details:
+                    ingredients[row[1]] = details[row[1]]
+        elif hasattr(product, '_ingredient_list'):
+            rows = []
+            for ingredient in product._ingredients:
+                cosdna_id = ingredient.cosdna_id if ingredient.linked \
+                    else None
+                rows.append([ingredient._name, cosdna_id, ingredient._skip])
+                if ingredient.synced and cosdna_id:
+                    ingredients[cosdna_id] = [
+                        ingredient._cosdna_name, ingredient.aliases,
+                        ingredient.mass, ingredient.hlb, ingredient.cas_no,
+                        ingredient.description
+                    ]
+        return [product._name, product.brand, product.product,
+                product.cosdna_id if product.linked else None,
+                product._skip, product._synced,
+                product.failure and list(product.failure), rows]
+
+    @staticmethod
+    def _load_product(entry, details):
+        '''
+        Helper function for Routine.load()
+        '''
+        name, brand, product_, cosdna_id, skip, synced, failure, rows = entry
+        product = Product(name, brand, product_, cosdna_url=cosdna_id and
+                          f'{Cosmetic._domain}/eng/{cosdna_id}.html')
+        product._skip, product._synced = skip, synced
+        product.failure = failure and Failure(*failure)
+        if rows is not None:
+            product._lazy_ingredients = (rows, details)
+        return product
+
+    @staticmethod
+    def _load_ingredient(row, details):
+        '''
+        Helper function for Product._ingredients
+        Creates the Ingredient() for a snapshot row
+        '''
+        name, cosdna_id, skip = row
+        ingredient = Ingredient(name=name, cosdna_url=cosdna_id and
+                                f'{Cosmetic._domain}/eng/{cosdna_id}.html')
+        ingredient._skip = skip
+        if cosdna_id in details:
+            cosdna_name, aliases, mass, hlb, cas_no, description = \
+                details[cosdna_id]
+            ingredient._set_state({
+                '_cosdna_name': cosdna_name, 'aliases': aliases,
+                'mass': mass, 'hlb': hlb, 'cas_no': cas_no,
+                'description': description, '_synced': True,
+            })
+        return ingredient
+
+    @staticmethod
+    def _ingredient_name(row, details):
+        '''
+        Helper function for Product.ingredients
+        Ingredient.name of a snapshot row, without creating the Ingredient()
+        '''
+        name, cosdna_id, skip = row
+        if cosdna_id in details:
+            return details[cosdna_id][0]
+        elif skip:
+            return 'SKIP: ' + name
+        return name
+
+    def add(self, routine):
+        '''
+        Adds products to the routine
+
+        Parameters
+        ----------
+        routine : list, default None
+            List if products in routine. Products are stored as Product()
+            objects.
+        '''
+        routine = np.array([routine])
+        routine = routine.ravel()
+        routine = [p for p in routine if len(p) > 1]
+        for product in routine:
+            if type(product) == Product:
+                self.products.append(product)
+            else:
+                self.products.append(Product(product))
+        return self
+
+    def link(self, sort='featured', force=False, resolver=None):
+        '''
+        Calls Product.link() for all products in routine
+
+        Parameters
+        ----------
+        sort : str, default 'featured'
+            Chooses how to sort the search results for each Product()
+
+        force : bool, default False
+            Calls Product.link() on Product() even if it has already been
+            linked.
+
+        resolver : ProductResolver, default None
+            See Routine.link_sync()
+        '''
+        self.link_sync(sort=sort, force=force, resolver=resolver, _link=True,
+                       _sync=False)
+
+    def sync(self, force=False, deep=False):
+        '''
+        Calls Product.sync() for all products in routine
+
+        Parameters
+        ----------
+        force : bool, default False
+            Calls Product.sync() on Product() even if it has already been
+            synced
+
+        deep : bool, default False
+            Calls Ingredient.sync() on every ingredient in the routine
+        '''
+        self.link_sync(force=force, deep=deep, _link=False, _sync=True)
+
+    def link_sync(self, sort='featured', force=False, deep=False,
+                  concurrency=None, parse_workers=None, resolver=None,
+                  _link=True, _sync=True):
+        '''
+        Calls Product.link().sync() for all products in routine
+        Tabulates frequency of ingredients across entire routine
+
+        Parameters
+        ----------
+        force : bool, default False
+            Calls Product.sync() on Product() even if it has already been
+            synced
+
+        deep : bool, default False
+            Calls Ingredient.sync() on every ingredient in the routine
+
+        concurrency : int, default None
+            Links and syncs products concurrently with at most `concurrency`
+            requests in flight. If None, products are linked and synced one
+            at a time. Either way, requests are paced by
+            CosDNA.transport.limiter, 4 requests per second by default,
+            which caps the speedup whatever `concurrency` is. Inside a
+            running event loop (e.g. Jupyter) the requests are made from a
+            worker thread; `await routine.alink_sync()` avoids it
+
+        parse_workers : int, default None
+            With `concurrency`, parses product and ingredient pages in a
+            pool of `parse_workers` processes, so fetching and parsing
+            scale independently. If None, pages are parsed as they arrive
+            in the event loop
+
+        resolver : ProductResolver, default None
+            If given, unlinked products are first matched by name with
+            resolver.resolve(), and only products without a confident
+            match are searched as they are
+        '''
+        if resolver is not None and _link:
+            resolver.resolve(self.products)
+        with Cosmetic.catalog.batch():      # one commit for the routine
+            return self._link_sync(sort=sort, force=force, deep=deep,
+                                   concurrency=concurrency,
+                                   parse_workers=parse_workers, _link=_link,
+                                   _sync=_sync)
+
+    def _link_sync(self, sort='featured', force=False, deep=False,
+                   concurrency=None, parse_workers=None, _link=True,
+                   _sync=True):
+        '''
+        Helper function for self.link_sync()
+        '''
+        if concurrency:
+            coroutine = self._async_link_sync(
+                sort=sort, force=force, deep=deep, concurrency=concurrency,
+                parse_workers=parse_workers, _link=_link, _sync=_sync
+            )
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                changes = asyncio.run(coroutine)
+            else:
+                # asyncio.run() can't be nested in a running loop
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    changes = pool.submit(asyncio.run, coroutine).result()
+            if changes:
+                self._analyze()
+            return self
+        changes = False
+        for product in self.products:
+            if _link:
+                if force:
+                    product.link(sort=sort)
+                else:
+                    if not product.linked:
+                        product.link(sort=sort)
+            if _sync:
+                if force:
+                    product.sync(deep=deep, force=True)
+                    changes = True
+                else:
+                    if not product.synced:
+                        product.sync(deep=deep)
+                        changes = True
+        if changes:
+            self._analyze()
+        return self
+
+    async def alink_sync(self, sort='featured', force=False, deep=False,
+                         concurrency=4, parse_workers=None, resolver=None):
+        '''
+        self.link_sync(concurrency=concurrency) as a coroutine, for code
+        already running in an event loop:
+
+        >>> await routine.alink_sync(deep=True)     # e.g. in Jupyter
+        '''
+        if resolver is not None:
+            resolver.resolve(self.products)
+        with Cosmetic.catalog.batch():      # one commit for the routine
+            changes = await self._async_link_sync(
+                sort=sort, force=force, deep=deep, concurrency=concurrency,
+                parse_workers=parse_workers
+            )
+        if changes:
+            self._analyze()
+        return self
+
+    async def _async_link_sync(self, sort='featured', force=False, deep=False,
+                               concurrency=4, parse_workers=None, _link=True,
+                               _sync=True):
+        '''
+        Helper function for self.link_sync() and self.alink_sync()
+        self.link_sync(concurrency=N) > self._async_link_sync()
+
+        Fetches search, product and ingredient pages with at most
+        `concurrency` requests in flight. Pages are read with the same
+        helpers as the serial path, so self._analyze() sees the same
+        products in the same order. Returns True if any product was synced
+
+        Product and ingredient pages are parsed by the pure
+        parse_*_page() functions, in a process pool if `parse_workers`
+        '''
+        loop = asyncio.get_running_loop()
+        parse_pool = None
+        if parse_workers:
+            parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+        asession = AsyncHTMLSession(loop=asyncio.get_running_loop(),
+                                    workers=concurrency)
+        # reuse the keep-alive connections of the shared transport
+        asession.mount('https://', CosDNA.transport.adapter)
+        asession.mount('http://', CosDNA.transport.adapter)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(cosmetic, url, stage):
+            # same contract as Cosmetic._fetch()
+            async with semaphore:
+                CosDNA.transport.requests += 1
+                try:
+                    cosmetic._r = await asession.get(url)
+                    cosmetic._r.raise_for_status()
+                except requests.exceptions.RequestException as error:
+                    cosmetic._fail(stage, url, error)
+                    cosmetic._release()
+                    return False
+            cosmetic.failure = None
+            return True
+
+        async def parse(cosmetic, parse_page):
+            # same contract as Cosmetic._parse()
+            try:
+                if parse_pool is None:
+                    return parse_page(cosmetic._r.content)
+                return await loop.run_in_executor(parse_pool, parse_page,
+                                                  cosmetic._r.content)
+            except PARSE_ERRORS as error:
+                cosmetic._fail('parse', cosmetic._r.url, error)
+                return None
+            finally:
+                cosmetic._release()
+
+        async def read_product(product):
+            if await fetch(product, product.cosdna_url, 'sync'):
+                page = await parse(product, parse_product_page)
+                if page is not None:
+                    product._apply_page(page, deep=False)
+
+        async def read_ingredient(ingredient):
+            if await fetch(ingredient, ingredient.cosdna_url, 'sync'):
+                page = await parse(ingredient, parse_ingredient_page)
+                if page is not None:
+                    ingredient._apply_page(page)
+
+        registry = CosDNA.registry
+        in_flight = {}      # key -> asyncio.Task, see SyncRegistry.sync()
+
+        async def read_and_store(cosmetic, read):
+            registry.count(cosmetic, 'fetches')
+            await read(cosmetic)
+            registry.store(cosmetic)
+            Cosmetic.catalog.store(cosmetic)
+
+        async def sync_once(cosmetic, read, force=False):
+            if not force and cosmetic._load():
+                return
+            registry.count(cosmetic, 'requests')
+            if not force and registry.share(cosmetic):
+                return
+            key = registry.key(cosmetic)
+            if key not in in_flight:
+                in_flight[key] = asyncio.ensure_future(
+                    read_and_store(cosmetic, read)
+                )
+                await in_flight[key]
+                return
+            await in_flight[key]
+            if not registry.share(cosmetic):    # first sync failed
+                await read_and_store(cosmetic, read)
+
+        async def link_sync_product(product):
+            if _link and (force or not product.linked):
+                product._query = product.name
+                if product.linked or not product._query or product._skip:
+                    product.link(sort=sort)     # no request needed
+                elif product._cached_search(sort=sort,
+                                            _base_url=Product._url('search')):
+                    pass                        # resolved without request
+                else:
+                    search_url = product._get_search_url(
+                        query=product._query, sort=sort,
+                        _base_url=Product._url('search')
+                    )
+                    if await fetch(product, search_url, 'search'):
+                        product._parse(product._read_search, sort=sort,
+                                       _base_url=Product._url('search'))
+            if not _sync or (product.synced and not force):
+                return False
+            if product._skip or not product.linked:
+                product.sync(deep=deep)         # no request needed
+                return True
+            await sync_once(product, read_product, force=force)
+            if not product.synced:
+                product._ingredients = []
+                return True
+            if deep:
+                # like Product.sync(), force refetches the product only
+                await asyncio.gather(
+                    *[sync_once(ing, read_ingredient)
+                      for ing in product._ingredients
+                      if ing.linked and not ing.synced]
+                )
+            return True
+
+        try:
+            changes = await asyncio.gather(
+                *[link_sync_product(product) for product in self.products]
+            )
+        finally:
+            # asession.close() would also close the shared transport's pool
+            asession.thread_pool.shutdown(wait=False)
+            if parse_pool is not None:
+                parse_pool.shutdown()
+        return any(changes)
+
+    def _analyze(self):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._analyze()
+
+        Tabulates frequency of cosdna_ids across all Products
+        '''
+        self._product_vectors = self._get_product_vectors()
+        self._routine_codes, self._routine_dict = self._get_routine_info()
+        self._counts = self._translate_counter(
+            self._routine_dict, self._count_codes(self._routine_codes)
+        )
+        self._postings = {}     # Interner code -> bitset, see self._posting()
+        return self
+
+    def _get_routine_info(self):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._analyze() > self._get_routine_info()
+
+        Creates dictionary to translate cosdna_id to ingredient name
+        Creates routine_codes (Interner codes of every ingredient of every
+        product, skipped and failed products aside) and routine_dict for
+        entire routine
+        '''
+        codes, offsets = self._product_vectors[2:]
+        included = self._included()
+        routine_codes = codes[np.repeat(included, np.diff(offsets))]
+        routine_dict = {}
+        for product, include in zip(self.products, included):
+            if include:
+                routine_dict.update(product._ingredient_dict)
+        routine_dict.update({'unavailable': 'unavailable'})
+        return routine_codes, routine_dict
+
+    def _included(self):
+        '''
+        Helper function for self._get_routine_info() and self.has()
+        Returns which products count towards the routine: all but skipped
+        and failed ones
+        '''
+        return np.array([not product._skip and not product.failed
+                         for product in self.products], dtype=bool)
+
+    def _count_codes(self, codes):
+        '''
+        Helper function for self._analyze() and self.top_ingredients()
+
+        Counts codes with np.bincount(). Returns cosdna_id -> count, in
+        order of first appearance like Counter(list_of_ids)
+        '''
+        counts = np.bincount(codes)
+        unique, first = np.unique(codes, return_index=True)
+        unique = unique[np.argsort(first)]
+        return OrderedCounter(dict(zip(CosDNA.interner.ids(unique),
+                                       counts[unique].tolist())))
+
+    @property
+    def _routine_ids(self):
+        return CosDNA.interner.ids(self._routine_codes)
+
+    def _translate_counter(self, translation_dict, counter):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._analyze() > self._translate_counter()
+
+        Translates Counter() object using routine_dict
+        Visit <https://stackoverflow.com/questions/51423217/> for more
+        information
+        '''
+        return OrderedCounter(dict(
+            (translation_dict.get(k, k), v) for (k, v) in counter.items()
+        ))
+
+    def _get_product_vectors(self):
+        '''
+        Helper function for self.sync()
+        self.sync() > self._analyze() > self._get_product_vectors()
+
+        Generates product vectors in order to quickly assess the presence of
+        ingredients in a routine: a sparse products x ingredients matrix,
+        built in one pass over the products, see ProductVectors
+        '''
+        rows = [product._codes for product in self.products]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row) for row in rows])
+        codes = np.concatenate(rows) if rows else np.zeros(0, np.int32)
+        columns, column_of = np.unique(codes, return_inverse=True)
+        product_of = np.repeat(np.arange(len(rows)), np.diff(offsets))
+        matrix = scipy.sparse.csc_matrix(
+            (np.ones(len(codes), dtype=np.int32), (product_of, column_of)),
+            shape=(len(rows), len(columns))
+        )
+        return ProductVectors(matrix, columns, codes, offsets)
+
+    def _column(self, code):
+        '''
+        Helper function for self.has()
+        Returns the column of an Interner code in self._product_vectors, or
+        None if no product lists it
+        '''
+        columns = self._product_vectors.columns
+        column = np.searchsorted(columns, code) if code is not None else 0
+        if column < len(columns) and columns[column] == code:
+            return column
+
+    def top_ingredients(self, top=None, mask=None):
+        '''
+        Returns specified number of most common ingredients
+
+        Parameters
+        ----------
+        top : int, default None
+            Specifies number of ingredients to return
+
+        mask : list, default None
+            Specifies which ingredients to return, by name, alias or CAS No.
+            (see Ingredient.resolve())
+        '''
+        if mask:
+            cosdna_ids = Ingredient.resolve(mask)
+            # names without a CosDNA page resolve to 'unavailable': drop them
+            mask = [CosDNA.interner.get(cosdna_ids[x]) for x in mask
+                    if cosdna_ids[x] != 'unavailable']
+            codes = self._routine_codes
+            masked_counts = self._count_codes(codes[np.isin(codes, mask)])
+            return masked_counts.most_common(top)
+        else:
+            return self._counts.most_common(top)
+
+    def has(self, ingredient):
+        '''
+        Returns products which include ingredient
+
+        Parameters
+        ----------
+        ingredient : str or list
+            Name of ingredient, or a query combining names with AND, OR,
+            NOT and parentheses (see parse_query()), e.g.
+            'niacinamide AND NOT (glycolic acid OR lactic acid)'. Works for
+            aliases and CAS No., resolved offline when the catalog knows
+            them (see Ingredient.resolve()). A list of queries returns a
+            list of results, one per query
+
+        >>> r.has('niacinamide')
+        >>> r.has(['niacinamide', 'retinol AND NOT glycolic acid'])
+        '''
+        queries = [ingredient] if isinstance(ingredient, str) else ingredient
+        trees = [parse_query(query) for query in queries]
+        names = list(dict.fromkeys(name for tree in trees
+                                   for name in _query_terms(tree)))
+        # -1 for names without a CosDNA page: no product lists them
+        codes = {name: CosDNA.interner.get(cosdna_id)
+                 if cosdna_id != 'unavailable' else -1
+                 for name, cosdna_id in Ingredient.resolve(names).items()}
+        if not self.products:
+            results = [[] for _ in trees]
+        else:
+            for name in names:
+                if not self._posting(codes[name]).any():
+                    print(f'Routine does not have {name}.')
+            universe = np.packbits(self._included())
+            results = []
+            for tree in trees:
+                bits = np.unpackbits(self._evaluate(tree, codes, universe),
+                                     count=len(self.products))
+                results.append([self.products[i].name
+                                for i in np.flatnonzero(bits)])
+        return results[0] if isinstance(ingredient, str) else results
+
+    def _posting(self, code):
+        '''
+        Helper function for self.has()
+        Returns the products listing an Interner code, skipped and failed
+        products aside, as a bitset: one bit per product, packed with
+        np.packbits()
+        '''
+        posting = self._postings.get(code)
+        if posting is None:
+            bits = self._included()
+            column = self._column(code)
+            listed = np.zeros(len(bits), dtype=bool)
+            if column is not None:
+                matrix = self._product_vectors.matrix
+                listed[matrix.indices[matrix.indptr[column]:
+                                      matrix.indptr[column + 1]]] = True
+            posting = self._postings[code] = np.packbits(bits & listed)
+        return posting
+
+    def _evaluate(self, tree, codes, universe):
+        '''
+        Helper function for self.has()
+        Evaluates a parse_query() tree on product bitsets
+        '''
+        if tree[0] == 'term':
+            return self._posting(codes[tree[1]])
+        elif tree[0] == 'not':
+            return universe & ~self._evaluate(tree[1], codes, universe)
+        left = self._evaluate(tree[1], codes, universe)
+        right = self._evaluate(tree[2], codes, universe)
+        return left & right if tree[0] == 'and' else left | right
+
+    def recommend(self, k=10, avoid=None, want=None, candidates=None):
+        '''
+        Recommends catalog products for the routine
+
+        A product scores the share of the routine's products listing each
+        of its ingredients, averaged over its ingredients: products made of
+        ingredients the routine already tolerates score close to 1, and
+        every unfamiliar ingredient lowers the score. With `want`, a
+        product also scores the share of the wanted ingredients that the
+        routine lacks (its gaps) that it would add.
+
+        Products listing any ingredient of `avoid`, and products already in
+        the routine, are left out.
+
+        Parameters
+        ----------
+        k : int, default 10
+            Number of products to return
+
+        avoid : list, default None
+            Ingredients the respondent cannot use, by name, alias or CAS
+            No. (see Ingredient.resolve())
+
+        want : list, default None
+            Ingredients the routine should gain, e.g. 'niacinamide'
+
+        candidates : CandidateIndex, default None
+            Products to choose from. Defaults to CandidateIndex.shared(),
+            every product of Cosmetic.catalog
+
+        Returns
+        -------
+        list of (name, cosdna_id, score), best first
+
+        >>> r.recommend(3, avoid=['fragrance'], want=['niacinamide'])
+        '''
+        candidates = candidates or CandidateIndex.shared()
+        if not len(candidates) or not self.products:
+            return []
+        codes, counts = np.unique(self._routine_codes, return_counts=True)
+        shares = counts / max(int(self._included().sum()), 1)
+        scores = candidates.accumulate(codes, shares)
+        scores /= np.maximum(candidates.sizes, 1)
+        names = (avoid or []) + (want or [])
+        # -1 for names without a CosDNA page, or that no product lists
+        resolved = {name: CosDNA.interner.get(cosdna_id)
+                    if cosdna_id != 'unavailable' else -1
+                    for name, cosdna_id in Ingredient.resolve(names).items()}
+        gaps = np.setdiff1d([resolved[name] for name in want or []
+                             if resolved[name] >= 0], codes)
+        if len(gaps):
+            scores += candidates.accumulate(gaps) / len(gaps)
+        avoided = [resolved[name] for name in avoid or []
+                   if resolved[name] >= 0]
+        scores[candidates.accumulate(avoided) > 0] = -1
+        for product in self.products:
+            position = candidates.position(product.cosdna_id)
+            if position is not None:
+                scores[position] = -1
+        k = min(k, int(np.count_nonzero(scores > 0)))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(candidates.names[i], candidates.ids[i], float(scores[i]))
+                for i in best]
+
+    def resolve_pending(self, sort='featured', deep=False):
+        '''
+        Links and syncs products left unlinked by batch mode whose searches
+        have since been resolved (see resolve_pending()), and re-analyzes
+        the routine if any product changed
+
+        Returns True if the routine was re-analyzed
+        '''
+        changes = False
+        for product in self.products:
+            if product.linked or product._skip:
+                continue
+            product.link(sort=sort)
+            if product.linked:
+                product.sync(deep=deep)
+                changes = True
+        if changes:
+            self._analyze()
+        return changes
+
+    @property
+    def routine(self):
+        try:
+            return [product.name for product in self.products]
+        except:
+            return self.products
+
+    @property
+    def cosdna_urls(self):
+        return [product.cosdna_url for product in self.products]
+
+    @property
+    def failures(self):
+        '''
+        Returns (name, Failure()) for every product and ingredient in the
+        routine that could not be linked or synced
+        '''
+        failures = []
+        for product in self.products:
+            if product.failed:
+                failures.append((product.name, product.failure))
+            for ingredient in getattr(product, '_ingredients', []):
+                if ingredient.failed:
+                    failures.append((ingredient.name, ingredient.failure))
+        return failures
+
+    @property
+    def brands(self):
+        return [product.brand for product in self.products]
+
+    @property
+    def linked(self):
+        try:
+            return all([product.linked for product in self.products])
+        except:
+            return False
+
+    @property
+    def synced(self):
+        try:
+            return all([product.synced for product in self.products])
+        except:
+            return False
+
+    @property
+    def ingredients(self):
+        return list(set(self._routine_ingredients))
+
+    @property
+    def top(self):
+        return self.top_ingredients(10)
+
+#     def __str__(self):
+#         return f'Routine "{self.name}" with {len(self.routine)} products'
+
+#     def __repr__(self):
+#         return f'Routine(name={self.name}, routine={[product.name for product in self.routine]})'
+
+
+class ProductResolver():
+    '''
+    Matches free-text product names, such as survey answers, to known
+    products before CosDNA is searched for them.
+
+    Known products are the products in Cosmetic.catalog and the names in
+    DATA_DIR/brand_product_names.json. Names are compared as TF-IDF vectors of
+    their character trigrams (see ngrams()) with a cosine NearestNeighbors
+    index, so misspellings still find their product. The fitted index is
+    saved to `path` and refitted when its sources change, see
+    ProductResolver.load()
+
+    Parameters
+    ----------
+    names : list
+        Known product names
+
+    records : list
+        (cosdna_id or None, brand, product) of every name
+
+    vectorizer : TfidfVectorizer
+        Fitted on names, with ngrams() as analyzer
+
+    matrix : scipy.sparse matrix
+        vectorizer.transform(names)
+
+    sources : dict
+        What the index was fitted from, see self.stale()
+
+    >>> resolver = ProductResolver.load()
+    >>> resolver.match(["kiels ultra facial cream"], k=1)
+    [[("kiehl's ultra facial cream", None, 0.98)]]
+    '''
+
+    version = 1
+    path = os.path.join(DATA_DIR, 'product_resolver.npz')
+    names_path = os.path.join(DATA_DIR, 'brand_product_names.json')
+
+    # matches scoring at least this are trusted, see self.resolve()
+    threshold = 0.75
+
+    def __init__(self, names, records, vectorizer, matrix, sources):
+        self.names, self.records = names, records
+        self.vectorizer, self.matrix = vectorizer, matrix
+        self.sources = sources
+        self._neighbors = NearestNeighbors(metric='cosine',
+                                           algorithm='brute').fit(matrix)
+
+    @classmethod
+    def fit(cls, catalog=None, names_path=None):
+        '''
+        Fits a ProductResolver on the products of catalog (default
+        Cosmetic.catalog) and the names in names_path
+        '''
+        catalog = catalog or Cosmetic.catalog
+        names_path = names_path or cls.names_path
+        known = {}          # cleaned name -> (name, cosdna_id, brand, product)
+        for cosdna_id, name in sorted(catalog.product_names().items()):
+            if name:
+                record = catalog.product(cosdna_id) or {}
+                known.setdefault(Cosmetic.clean(name), (
+                    name, cosdna_id, record.get('brand'),
+                    record.get('product')
+                ))
+        if os.path.exists(names_path):
+            with open(names_path) as handle:
+                for name, record in json.load(handle).items():
+                    known.setdefault(Cosmetic.clean(name), (
+                        name, None, record.get('brand'),
+                        record.get('product')
+                    ))
+        names = [name for name, *_ in known.values()]
+        records = [tuple(record) for _, *record in known.values()]
+        vectorizer = TfidfVectorizer(analyzer=ngrams).fit(names)
+        return cls(names, records, vectorizer, vectorizer.transform(names),
+                   cls._sources(catalog, names_path))
+
+    @staticmethod
+    def _sources(catalog, names_path):
+        '''
+        Helper function for ProductResolver.fit() and self.stale()
+        '''
+        sources = {'products': catalog.product_count()}
+        if os.path.exists(names_path):
+            sources['names_size'] = os.path.getsize(names_path)
+            sources['names_mtime'] = os.path.getmtime(names_path)
+        return sources
+
+    def stale(self, catalog=None, names_path=None):
+        '''
+        Returns True if the catalog gained or lost products, or the names
+        file changed, since the index was fitted
+        '''
+        return self.sources != ProductResolver._sources(
+            catalog or Cosmetic.catalog, names_path or self.names_path
+        )
+
+    def save(self, path=None):
+        '''
+        Saves the fitted index to path. The file is replaced atomically
+        Returns path
+        '''
+        path = path or self.path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        matrix = self.matrix.tocsr()
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as handle:
+            np.savez_compressed(
+                handle,
+                header=np.array(json.dumps({
+                    'version': ProductResolver.version,
+                    'sources': self.sources,
+                    'records': self.records,
+                })),
+                names=np.array(self.names, dtype=str),
+                # str, not object: np.load() refuses pickled arrays
+                vocabulary=np.array(self.vectorizer.get_feature_names_out(),
+                                    dtype=str),
+                idf=self.vectorizer.idf_,
+                data=matrix.data, indices=matrix.indices,
+                indptr=matrix.indptr, shape=np.array(matrix.shape),
+            )
+        os.replace(temp_path, path)
+        return path
+
+    @classmethod
+    def read(cls, path=None):
+        '''
+        Reads an index saved with self.save()
+        '''
+        path = path or cls.path
+        with np.load(path) as saved:
+            header = json.loads(str(saved['header']))
+            if header['version'] != cls.version:
+                raise ValueError(f"{path} has version {header['version']}, "
+                                 f'expected {cls.version}')
+            vectorizer = TfidfVectorizer(
+                analyzer=ngrams, vocabulary=saved['vocabulary'].tolist()
+            )
+            vectorizer.idf_ = saved['idf']
+            matrix = scipy.sparse.csr_matrix(
+                (saved['data'], saved['indices'], saved['indptr']),
+                shape=tuple(saved['shape'])
+            )
+            names = saved['names'].tolist()
+        records = [tuple(record) for record in header['records']]
+        return cls(names, records, vectorizer, matrix, header['sources'])
+
+    @classmethod
+    def load(cls, path=None, catalog=None):
+        '''
+        Returns the index saved at path, fitting and saving it first if it
+        is missing, from an older version, or stale
+        '''
+        path = path or cls.path
+        try:
+            resolver = cls.read(path)
+            if resolver.stale(catalog):
+                resolver = None
+        except (OSError, ValueError, KeyError):
+            resolver = None
+        if resolver is None:
+            resolver = cls.fit(catalog)
+            resolver.save(path)
+        return resolver
+
+    def match(self, queries, k=3):
+        '''
+        Matches product names in bulk
+
+        Parameters
+        ----------
+        queries : list
+            Free-text product names
+
+        k : int, default 3
+            Candidates per query
+
+        Returns
+        -------
+        list of [(name, cosdna_id, score), ...] per query, best first.
+        score is the cosine similarity of the names, from 0 to 1.
+        cosdna_id is None for products only known by name
+        '''
+        return [[(self.names[i], self.records[i][0], score)
+                 for score, i in candidates]
+                for candidates in self._nearest(queries, k)]
+
+    def _nearest(self, queries, k):
+        '''
+        Helper function for self.match() and self.resolve()
+        Returns [(score, index of name), ...] per query
+        '''
+        k = min(k, len(self.names))
+        if not len(queries) or not k:
+            return [[] for _ in queries]
+        distances, indices = self._neighbors.kneighbors(
+            self.vectorizer.transform(queries), n_neighbors=k
+        )
+        return [[(round(1 - float(d), 4), int(i))
+                 for d, i in zip(row_distances, row_indices)]
+                for row_distances, row_indices in zip(distances, indices)]
+
+    def resolve(self, products, threshold=None):
+        '''
+        Matches unlinked products by name, so that only products without a
+        confident match are searched on CosDNA
+
+        A product whose best match scores at least threshold (default
+        ProductResolver.threshold) takes that match's name, brand and
+        product. If the match has a cosdna_id, the product is linked to it
+        without a request; otherwise Product.link() searches for the
+        corrected name. Other products are left as they are
+
+        Parameters
+        ----------
+        products : list
+            Product() objects
+
+        threshold : float, default None
+            Minimum score of a trusted match
+
+        Returns
+        -------
+        list of (product, (name, cosdna_id, score) or None) for every
+        unlinked product
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        unlinked = [product for product in products
+                    if not product.linked and not product._skip]
+        results = []
+        for product, candidates in zip(unlinked, self._nearest(
+                [product.name for product in unlinked], k=1)):
+            if not candidates:
+                results.append((product, None))
+                continue
+            score, i = candidates[0]
+            cosdna_id, brand, product_ = self.records[i]
+            if score >= threshold:
+                product._name, product.brand, product.product = \
+                    self.names[i], brand, product_
+                if cosdna_id:
+                    product.link(cosdna_url=f'{Cosmetic._domain}/eng/'
+                                            f'{cosdna_id}.html')
+            results.append((product, (self.names[i], cosdna_id, score)))
+        return results
+
+
+class RoutineIndex():
+    '''
+    Finds the routines most like a given one, e.g. the survey respondents
+    whose AM routine is closest to a new respondent's.
+
+    Every routine is a sparse vector over Interner codes: how many of its
+    products list each ingredient (the counts behind Routine._counts),
+    skipped and failed products and the 'unavailable' placeholder aside.
+    Routines can be added, replaced or removed at any time; the matrices
+    are rebuilt on the next query.
+
+    Parameters
+    ----------
+    routines : iterable, default ()
+        Analyzed Routine() objects to add, keyed by name (see self.add())
+
+    metric : str, default 'cosine'
+        'cosine' compares ingredient counts, 'jaccard' ingredient sets
+
+    >>> index = RoutineIndex(am_routines)
+    >>> index.query(new_routine, k=3)
+    [('respondent 12', 0.61), ('respondent 4', 0.55), ('respondent 30', 0.52)]
+    '''
+
+    metrics = ('cosine', 'jaccard')
+
+    def __init__(self, routines=(), metric='cosine'):
+        self.metric = metric
+        self.keys = []
+        self._rows = []         # (codes, counts) per routine
+        self._positions = {}    # key -> row
+        self._matrix = None     # built from self._rows by self._build()
+        for routine in routines:
+            self.add(routine)
+
+    def add(self, routine, key=None):
+        '''
+        Adds a routine under key (default its name), replacing the routine
+        already added under it, if any. Unnamed routines are never replaced:
+        they are keyed by the first free position number. Returns the key
+        '''
+        key = routine._name if key is None else key
+        if key is None:
+            key = len(self.keys)
+            while key in self._positions:
+                key += 1
+        vector = RoutineIndex._vector(routine)
+        if key in self._positions:
+            self._rows[self._positions[key]] = vector
+        else:
+            self._positions[key] = len(self.keys)
+            self.keys.append(key)
+            self._rows.append(vector)
+        self._matrix = None
+        return key
+
+    def remove(self, key):
+        '''
+        Removes the routine added under key
+        '''
+        position = self._positions.pop(key)
+        del self.keys[position]
+        del self._rows[position]
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._matrix = None
+
+    @staticmethod
+    def _vector(routine):
+        '''
+        Helper function for self.add() and self.query()
+        Returns (codes, counts) of the routine's ingredients. Products that
+        couldn't be parsed are left out: they all list 'unavailable'
+        '''
+        if not routine.products:
+            return np.zeros(0, np.int32), np.zeros(0, np.int64)
+        codes, counts = np.unique(routine._routine_codes, return_counts=True)
+        known = codes != CosDNA.interner.get('unavailable')
+        return codes[known], counts[known]
+
+    def _build(self):
+        '''
+        Helper function for self.query()
+        Stacks the rows into a CSR matrix of routines x Interner codes, and
+        precomputes the row norms (cosine) and sizes (jaccard)
+        '''
+        indptr = np.zeros(len(self._rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(codes) for codes, _ in self._rows])
+        if self._rows:
+            indices = np.concatenate([codes for codes, _ in self._rows])
+            data = np.concatenate([counts for _, counts in self._rows])
+        else:
+            indices, data = np.zeros(0, np.int32), np.zeros(0, np.int64)
+        width = int(indices.max()) + 1 if len(indices) else 0
+        self._matrix = scipy.sparse.csr_matrix(
+            (data.astype(np.float64), indices, indptr),
+            shape=(len(self._rows), width)
+        )
+        self._sets = self._matrix.copy()
+        self._sets.data[:] = 1
+        self._norms = np.sqrt(
+            np.asarray(self._matrix.multiply(self._matrix).sum(axis=1))
+        ).ravel()
+        self._sizes = np.diff(indptr)
+        self._keys = np.empty(len(self.keys), dtype=object)
+        self._keys[:] = self.keys
+
+    def query(self, routine, k=10, metric=None, exclude=None):
+        '''
+        Returns up to k (key, score) of the most similar routines, best
+        first. Scores run from 0 (no ingredient in common, left out) to 1
+
+        Parameters
+        ----------
+        routine : Routine
+            Analyzed Routine(), in the index or not
+
+        k : int, default 10
+            Number of routines to return
+
+        metric : str, default None
+            'cosine' or 'jaccard'. Defaults to self.metric
+
+        exclude : default None
+            Key to leave out, e.g. the routine's own
+        '''
+        return self._top(*RoutineIndex._vector(routine), k=k,
+                         metric=metric or self.metric, exclude=exclude)
+
+    def similar(self, key, k=10, metric=None):
+        '''
+        self.query() for the routine added under key, leaving it out
+        '''
+        codes, counts = self._rows[self._positions[key]]
+        return self._top(codes, counts, k=k, metric=metric or self.metric,
+                         exclude=key)
+
+    def _top(self, codes, counts, k, metric, exclude):
+        '''
+        Helper function for self.query() and self.similar()
+        '''
+        if metric not in RoutineIndex.metrics:
+            raise ValueError(f'metric must be one of {RoutineIndex.metrics}')
+        if self._matrix is None:
+            self._build()
+        known = codes < self._matrix.shape[1]
+        vector = np.zeros(self._matrix.shape[1])
+        if metric == 'cosine':
+            vector[codes[known]] = counts[known]
+            norms = self._norms * np.sqrt(np.dot(counts, counts))
+            scores = self._matrix @ vector
+        else:
+            vector[codes[known]] = 1
+            scores = self._sets @ vector
+            norms = self._sizes + len(codes) - scores
+        scores = np.divide(scores, norms, out=np.zeros(len(scores)),
+                           where=norms > 0)
+        if exclude is not None:
+            scores[self._keys == exclude] = -1
+        k = min(k, int(np.count_nonzero(scores > 0)))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(self.keys[i], float(scores[i])) for i in best]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CandidateIndex():
+    '''
+    Inverted index of the products in a Catalog(), for Routine.recommend():
+    for every ingredient (Interner code), the products listing it.
+
+    Built once per process and catalog by CandidateIndex.shared(), and
+    rebuilt when the catalog gains or loses products.
+
+    Parameters
+    ----------
+    catalog : Catalog, default None
+        Defaults to Cosmetic.catalog
+    '''
+
+    _shared = {}            # catalog path -> CandidateIndex
+    _lock = threading.Lock()
+
+    def __init__(self, catalog=None):
+        catalog = catalog or Cosmetic.catalog
+        names = catalog.product_names()
+        rows = catalog.product_ingredients()
+        self.ids = sorted(names)
+        self.names = [names[cosdna_id] for cosdna_id in self.ids]
+        codes = [np.unique(CosDNA.interner.codes(
+                     [i for i in rows.get(cosdna_id, [])
+                      if i and i != 'unavailable']
+                 )) for cosdna_id in self.ids]
+        indptr = np.zeros(len(codes) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row) for row in codes])
+        indices = np.concatenate(codes) if codes else np.zeros(0, np.int32)
+        width = int(indices.max()) + 1 if len(indices) else 0
+        # products x codes, stored by column: the posting lists
+        self.postings = scipy.sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(codes), width)
+        ).tocsc()
+        self.sizes = np.diff(indptr)
+        self._positions = {cosdna_id: i
+                           for i, cosdna_id in enumerate(self.ids)}
+
+    @classmethod
+    def shared(cls, catalog=None):
+        '''
+        Returns this process's CandidateIndex for catalog, (re)building it
+        if it is missing or stale
+        '''
+        catalog = catalog or Cosmetic.catalog
+        with cls._lock:
+            index = cls._shared.get(catalog.path)
+            if index is None or index.stale(catalog):
+                index = cls._shared[catalog.path] = cls(catalog)
+        return index
+
+    def stale(self, catalog=None):
+        '''
+        Returns True if catalog gained or lost products since the index was
+        built
+        '''
+        return (catalog or Cosmetic.catalog).product_count() != len(self.ids)
+
+    def accumulate(self, codes, weights=None):
+        '''
+        Walks the posting lists of codes. Returns, per product, the sum of
+        the weights of the codes it lists (without weights, how many of
+        codes it lists)
+        '''
+        codes = np.asarray(codes, dtype=np.int64)
+        weights = np.ones(len(codes)) if weights is None else \
+            np.asarray(weights, dtype=np.float64)
+        known = (codes >= 0) & (codes < self.postings.shape[1])
+        codes, weights = codes[known], weights[known]
+        starts = self.postings.indptr[codes]
+        lengths = self.postings.indptr[codes + 1] - starts
+        # position of every posting of codes in self.postings.indices
+        postings = np.arange(lengths.sum()) + np.repeat(
+            starts - np.cumsum(lengths) + lengths, lengths
+        )
+        return np.bincount(self.postings.indices[postings],
+                           weights=np.repeat(weights, lengths),
+                           minlength=len(self))
+
+    def position(self, cosdna_id):
+        return self._positions.get(cosdna_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# name normalization shared by Cosmetic.clean() and ngrams(), compiled
+# once. Normalized names are memoized, at most NORMALIZE_CACHE_SIZE each
+_CLEAN_DROP = re.compile(r"[^a-z0-9\s\-']")
+_CLEAN_HYPHEN = re.compile(r'([a-z])-([a-z])')
+_NGRAM_DROP = re.compile(r'[)(.|\[\]{}\'"?!]')
+_SPACES = re.compile(' +')
+NORMALIZE_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _clean_name(string):
+    '''
+    Helper function for Cosmetic.clean()
+    '''
+    return _CLEAN_HYPHEN.sub(r'\1 \2', _CLEAN_DROP.sub('', string.lower()))
+
+
+def _ngram_text(string):
+    '''
+    Helper function for ngrams() and ngrams_all()
+    Normalizes a name and pads it with spaces
+    '''
+    string = string.encode('ascii', errors='ignore').decode().lower()
+    string = _NGRAM_DROP.sub('', string).replace('&', 'and')
+    string = string.replace(',', ' ').replace('-', ' ')
+    return ' ' + _SPACES.sub(' ', string).strip() + ' '
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _ngrams(string, n):
+    '''
+    Helper function for ngrams()
+    '''
+    return _grams(_ngram_text(string), n)
+
+
+def _grams(text, n):
+    return tuple(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def ngrams(string, n=3):
+    '''
+    Returns the character n-grams of a name, normalized and padded with
+    spaces (ascii only, lowercase, no brackets or punctuation, '&' as
+    'and', commas and hyphens as spaces)
+
+    >>> ngrams('Aloe-Vera')
+    [' al', 'alo', 'loe', 'oe ', 'e v', ' ve', 'ver', 'era', 'ra ']
+    '''
+    return list(_ngrams(string, n))
+
+
+def clean_all(strings, query=False):
+    '''
+    Cosmetic.clean() for many strings in one call. Each distinct string
+    is normalized once, and all of them go through each pattern together
+
+    Returns list of cleaned strings, in the order of strings
+    '''
+    unique = list(dict.fromkeys(strings))
+    if any('\n' in string for string in unique):
+        cleaned = [_clean_name(string) for string in unique]
+    else:
+        joined = _CLEAN_DROP.sub('', '\n'.join(unique).lower())
+        cleaned = _CLEAN_HYPHEN.sub(r'\1 \2', joined).split('\n')
+    if query:
+        cleaned = [string.replace(' ', '+') for string in cleaned]
+    cleaned = dict(zip(unique, cleaned))
+    return [cleaned[string] for string in strings]
+
+
+def ngrams_all(strings, n=3):
+    '''
+    ngrams() for many strings in one call. Each distinct string is
+    normalized once, and all of them go through each pattern together
+
+    Returns list of n-gram lists, in the order of strings
+    '''
+    unique = list(dict.fromkeys(strings))
+    if any('\n' in string for string in unique):
+        texts = [_ngram_text(string) for string in unique]
+    else:
+        joined = '\n'.join(unique).encode('ascii', errors='ignore')
+        joined = _NGRAM_DROP.sub('', joined.decode().lower())
+        joined = joined.replace('&', 'and').replace(',', ' ')
+        joined = _SPACES.sub(' ', joined.replace('-', ' '))
+        texts = [' ' + text.strip() + ' ' for text in joined.split('\n')]
+    grams = {string: _grams(text, n) for string, text in zip(unique, texts)}
+    return [list(grams[string]) for string in strings]
+
+
+def _clean_reference(string, query=False):
+    '''
+    Cosmetic.clean() before it was compiled and memoized. Used by
+    benchmark_normalization()
+    '''
+    string = re.sub(r"[^a-z0-9\s\-\']", '', string.lower())
+    string = re.sub(r'([a-z])\-([a-z])', r'\1 \2', string)
+    if query:
+        string = string.replace(' ', '+')
+    return string
+
+
+def _ngrams_reference(string, n=3):
+    '''
+    ngrams() before it was compiled and memoized. Used by
+    benchmark_normalization()
+    '''
+    string = string.encode("ascii", errors="ignore").decode()
+    string = string.lower()
+    chars_to_remove = [")", "(", ".", "|", "[", "]", "{", "}", "'", '"',
+                       "?", "!"]
+    rx = '[' + re.escape(''.join(chars_to_remove)) + ']'
+    string = re.sub(rx, '', string)
+    string = string.replace('&', 'and')
+    string = string.replace(',', ' ')
+    string = string.replace('-', ' ')
+    string = re.sub(' +',' ',string).strip()
+    string = ' '+ string +' ' # pad names for ngrams...
+    ngrams = zip(*[string[i:] for i in range(n)])
+    return [''.join(ngram) for ngram in ngrams]
+
+
+# operators and parentheses of a Routine.has() query
+_QUERY_OPERATORS = re.compile(r'(\(|\)|\bAND\b|\bOR\b|\bNOT\b)')
+
+
+def parse_query(query):
+    '''
+    Parses an ingredient query for Routine.has(): ingredient names combined
+    with AND, OR, NOT (upper case) and parentheses. NOT binds tightest,
+    then AND, then OR. Parentheses group only at the start of the query
+    or after an operator; after a name they are part of it, as in INCI
+    names like 'water (aqua)'
+
+    Returns a tree of tuples: ('term', name), ('not', tree),
+    ('and', tree, tree) or ('or', tree, tree). Raises ValueError if the
+    query is malformed
+
+    >>> parse_query('niacinamide AND NOT (glycolic acid OR lactic acid)')
+    ('and', ('term', 'niacinamide'), ('not', ('or', ('term', 'glycolic acid'),
+    ('term', 'lactic acid'))))
+    '''
+    tokens = _query_tokens(query)
+    position = 0
+
+    def take(expected=None):
+        nonlocal position
+        token = tokens[position] if position < len(tokens) else None
+        if expected is not None and token != expected:
+            raise ValueError(f'expected {expected!r} at {token!r} in query '
+                             f'{query!r}')
+        position += 1
+        return token
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def either():
+        tree = both()
+        while peek() == 'OR':
+            take()
+            tree = ('or', tree, both())
+        return tree
+
+    def both():
+        tree = negated()
+        while peek() == 'AND':
+            take()
+            tree = ('and', tree, negated())
+        return tree
+
+    def negated():
+        token = take()
+        if token == 'NOT':
+            return ('not', negated())
+        elif token == '(':
+            tree = either()
+            take(')')
+            return tree
+        elif token is None or token in ('AND', 'OR', ')'):
+            raise ValueError(f'expected an ingredient at {token!r} in query '
+                             f'{query!r}')
+        return ('term', token)
+
+    tree = either()
+    if peek() is not None:
+        raise ValueError(f'unexpected {peek()!r} in query {query!r}')
+    return tree
+
+
+def _query_tokens(query):
+    '''
+    Helper function for parse_query()
+    Splits query into operators, parentheses and ingredient names
+    '''
+    tokens, name, depth = [], '', 0     # depth: open parentheses of name
+
+    def end_name():
+        if name.strip():
+            tokens.append(' '.join(name.split()))
+
+    for piece in _QUERY_OPERATORS.split(query):
+        if piece == '(' and (name.strip() or depth):
+            name, depth = name + piece, depth + 1
+        elif piece == ')' and depth:
+            name, depth = name + piece, depth - 1
+        elif piece in ('(', ')', 'AND', 'OR', 'NOT') and not depth:
+            end_name()
+            tokens.append(piece)
+            name = ''
+        else:
+            name += piece
+    if depth:
+        raise ValueError(f'unbalanced parentheses in {name.strip()!r} in '
+                         f'query {query!r}')
+    end_name()
+    return tokens
+
+
+def _query_terms(tree):
+    '''
+    Helper function for Routine.has()
+    Yields the ingredient names of a parse_query() tree
+    '''
+    if tree[0] == 'term':
+        yield tree[1]
+    else:
+        for subtree in tree[1:]:
+            yield from _query_terms(subtree)
+
+
+def resolve_pending(routines=None, corrections=None, sort='featured'):
+    '''
+    Resolves the searches queued in Cosmetic.pending by batch mode, then
+    re-analyzes only the routines that contained them
+
+    Parameters
+    ----------
+    routines : list, default None
+        Routine() objects to update once the queue is resolved
+
+    corrections : str, default None
+        CSV written by PendingQueue.export() with the `resolution` column
+        filled in. Rows with an empty resolution stay pending. If None,
+        asks for each pending query with input()
+
+    Each resolution is a CosDNA URL, a new search query, or 'SKIP'
+
+    Returns
+    -------
+    list of the routines that were re-analyzed
+    '''
+    queue = Cosmetic.pending
+    if corrections:
+        with open(corrections, newline='') as handle:
+            entries = [row for row in csv.DictReader(handle)
+                       if row.get('resolution', '').strip()]
+    else:
+        entries = queue.entries()
+        for entry in entries:
+            print(f"No results for {entry['name']} ({entry['query']}).")
+            print("Enter CosDNA URL, new search, or 'SKIP' "
+                  '(leave blank to keep pending):')
+            entry['resolution'] = input(' ')
+        entries = [entry for entry in entries if entry['resolution'].strip()]
+    for entry in entries:
+        _resolve_entry(entry)
+    return [routine for routine in (routines or [])
+            if routine.resolve_pending(sort=sort)]
+
+
+def _resolve_entry(entry):
+    '''
+    Helper function for resolve_pending()
+    Applies one resolution to Cosmetic.pending and Cosmetic.searches
+    '''
+    base_url, query, sort = entry['base_url'], entry['query'], entry['sort']
+    resolution = entry['resolution'].strip()
+    if resolution == 'SKIP':
+        Cosmetic.pending.set_status(base_url, query, sort, 'skip', resolution)
+        return
+    if Cosmetic._domain in resolution:
+        cosdna_url = resolution
+    else:       # new search query
+        kind = Product if base_url == Product._url('search') else Ingredient
+        cosmetic = kind(name=entry['name'])
+        cosmetic._query = resolution
+        cosmetic._search(sort=sort or None, _base_url=base_url)
+        cosdna_url = cosmetic.cosdna_url
+    if cosdna_url:
+        Cosmetic.searches.store(base_url, query, sort or None, cosdna_url)
+        Cosmetic.pending.set_status(base_url, query, sort, 'resolved',
+                                    cosdna_url)
+
+
+def page_kind(url):
+    '''
+    Returns 'search', 'product' or 'ingredient' for a CosDNA page URL
+    '''
+    if '.php?q=' in url:
+        return 'search'
+    elif 'cosmetic_' in url:
+        return 'product'
+    else:
+        return 'ingredient'
+
+
+def save_pages(pages, directory=os.path.join(DATA_DIR, 'pages')):
+    '''
+    Saves pages to a directory: one file per page plus index.json mapping
+    each URL to its file. Existing pages in the directory are kept
+
+    Parameters
+    ----------
+    pages : dict
+        URL -> raw page (bytes)
+    '''
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as handle:
+            index = json.load(handle)
+    for url, content in pages.items():
+        if url not in index:
+            index[url] = f'{page_kind(url)}_{len(index):06d}.html'
+        with open(os.path.join(directory, index[url]), 'wb') as handle:
+            handle.write(content)
+    with open(index_path, 'w') as handle:
+        json.dump(index, handle, indent=4)
+    return directory
+
+
+def load_pages(directory=os.path.join(DATA_DIR, 'pages')):
+    '''
+    Loads pages saved with save_pages()
+    Returns dict of URL -> raw page (bytes)
+    '''
+    with open(os.path.join(directory, 'index.json')) as handle:
+        index = json.load(handle)
+    pages = {}
+    for url, filename in index.items():
+        with open(os.path.join(directory, filename), 'rb') as handle:
+            pages[url] = handle.read()
+    return pages
+
+
+def record_pages(directory=os.path.join(DATA_DIR, 'pages'), cache=None):
+    '''
+    Saves every page in the response cache (see ResponseCache) with
+    save_pages(), for StandIn() to replay or for check_parsers()
+
+    Parameters
+    ----------
+    cache : ResponseCache, default None
+        Cache to record from. If None, uses CosDNA.transport.cache
+    '''
+    cache = cache or CosDNA.transport.cache
+    urls = [url for (url,) in cache.conn.execute(
+        'SELECT url FROM responses WHERE status = 200'
+    )]
+    pages = {url: cache.lookup(url)['body'] for url in urls}
+    save_pages(pages, directory)
+    return len(pages)
+
+
+class StandIn():
+    '''
+    Local stand-in for CosDNA.com that replays recorded pages.
+
+    Serves the pages saved with save_pages() / record_pages() by path and
+    query, so search (stuff.php?q=, product.php?q=), product
+    (cosmetic_*.html) and ingredient pages all work. Latency, server
+    errors and throttling can be injected to load-test concurrency and
+    rate limiting without touching the network.
+
+    Parameters
+    ----------
+    pages : dict or str, default DATA_DIR/pages
+        URL -> raw page, or a directory saved with save_pages()
+
+    port : int, default 0
+        Port to listen on. 0 picks a free port
+
+    latency : float or tuple, default 0.0
+        Seconds to wait before answering, or (min, max) for a uniform
+        random wait
+
+    error_rate : float, default 0.0
+        Share of requests answered with HTTP 500
+
+    throttle_rate : float, default 0.0
+        Share of requests answered with HTTP 429
+
+    retry_after : float, default 1.0
+        Retry-After header sent with HTTP 429
+
+    Pages are served with an ETag (a checksum of the page) and a
+    Last-Modified header (when the StandIn() was created), and
+    conditional requests for unchanged pages are answered with HTTP 304,
+    as ResponseCache() revalidation expects.
+
+    >>> with StandIn(latency=(0.1, 0.4), throttle_rate=0.05) as standin:
+    ...     Cosmetic.set_domain(standin.url)
+    ...     routine.link_sync(force=True, concurrency=8)
+    >>> Cosmetic.set_domain()
+    >>> standin.stats
+    Counter({'requests': 212, 'served': 201, 'throttled': 11,
+             'connections': 8})
+    '''
+
+    def __init__(self, pages=os.path.join(DATA_DIR, 'pages'), port=0,
+                 latency=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1.0):
+        if isinstance(pages, str):
+            pages = load_pages(pages)
+        self.pages = {StandIn._key(url): content
+                      for url, content in pages.items()}
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.last_modified = formatdate(int(time.time()), usegmt=True)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @staticmethod
+    def _key(url):
+        parts = urlsplit(url)
+        return parts.path + ('?' + parts.query if parts.query else '')
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive, like CosDNA.com
+
+            def setup(self):
+                super().setup()     # once per connection accepted
+                with standin._lock:
+                    standin.stats['connections'] += 1
+
+            def do_GET(self):
+                status, headers, body = standin._respond(self.path,
+                                                         self.headers)
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _respond(self, path, request_headers=None):
+        '''
+        Helper function for the request handler in self.start()
+        Returns status, headers and body for path
+        '''
+        request_headers = request_headers or {}
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        roll = random.random()
+        with self._lock:
+            self.stats['requests'] += 1
+            if roll < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return 429, {'Retry-After': str(self.retry_after)}, b''
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 500, {}, b''
+            if path not in self.pages:
+                self.stats['missing'] += 1
+                return 404, {}, b''
+            page = self.pages[path]
+            headers = {'ETag': f'"{zlib.crc32(page):08x}"',
+                       'Last-Modified': self.last_modified}
+            if self._not_modified(headers, request_headers):
+                self.stats['not_modified'] += 1
+                return 304, headers, b''
+            self.stats['served'] += 1
+        headers['Content-Type'] = 'text/html; charset=utf-8'
+        return 200, headers, page
+
+    @staticmethod
+    def _not_modified(headers, request_headers):
+        '''
+        Helper function for self._respond()
+        Whether a conditional request's copy of the page is still current
+        '''
+        etag = request_headers.get('If-None-Match')
+        if etag is not None:
+            return etag == headers['ETag']
+        since = request_headers.get('If-Modified-Since')
+        if since is None:
+            return False
+        try:
+            return parsedate_to_datetime(since) >= \
+                parsedate_to_datetime(headers['Last-Modified'])
+        except (TypeError, ValueError):
+            return False
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+_PAGE_PARSERS = {
+    'search': (parse_search_page, _parse_search_page_html),
+    'product': (parse_product_page, _parse_product_page_html),
+    'ingredient': (parse_ingredient_page, _parse_ingredient_page_html),
+}
+
+
+def check_parsers(pages=os.path.join(DATA_DIR, 'pages')):
+    '''
+    Checks that the parse_*_page() functions return the same records as
+    the requests_html reference implementations. tests/test_parsers.py
+    runs it on the pages in tests/fixtures/pages
+
+    Parameters
+    ----------
+    pages : dict or str, default DATA_DIR/pages
+        URL -> raw page, or a directory saved with save_pages()
+
+    Returns
+    -------
+    list of (url, fast result, reference result) for every page where
+    they differ. A parse error counts as its exception class name
+    '''
+    if isinstance(pages, str):
+        pages = load_pages(pages)
+    mismatches = []
+    for url, content in pages.items():
+        results = []
+        for parse_page in _PAGE_PARSERS[page_kind(url)]:
+            try:
+                results.append(parse_page(content))
+            except PARSE_ERRORS as error:
+                results.append(type(error).__name__)
+        if results[0] != results[1]:
+            mismatches.append((url, *results))
+    return mismatches
+
+
+def benchmark_parsers(pages=os.path.join(DATA_DIR, 'pages'), repeat=3):
+    '''
+    Measures pages parsed per second by the parse_*_page() functions and
+    by the requests_html reference implementations
+
+    Parameters
+    ----------
+    pages : dict or str, default DATA_DIR/pages
+        URL -> raw page, or a directory saved with save_pages()
+
+    repeat : int, default 3
+        Times every page is parsed
+
+    Returns
+    -------
+    dict of pages/sec per implementation and the speedup
+    '''
+    if isinstance(pages, str):
+        pages = load_pages(pages)
+    pages = [(_PAGE_PARSERS[page_kind(url)], content)
+             for url, content in pages.items()]
+    results = {}
+    for i, implementation in enumerate(['compiled', 'requests_html']):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for parsers, content in pages:
+                try:
+                    parsers[i](content)
+                except PARSE_ERRORS:
+                    pass
+        elapsed = time.perf_counter() - start
+        results[implementation] = len(pages) * repeat / elapsed
+    results['speedup'] = results['compiled'] / results['requests_html']
+    return results
+
+
+def benchmark_normalization(n=20000, repeat=3, catalog=None, seed=0):
+    '''
+    Measures strings per second normalized by Cosmetic.clean() and
+    ngrams(): the reference implementations (patterns built and looked up
+    on every call), the compiled functions with an empty memo (cold) and a
+    filled one (warm), and the batch functions clean_all() and
+    ngrams_all()
+
+    Parameters
+    ----------
+    n : int, default 20000
+        Number of strings, drawn with a long tail from every ingredient
+        name, CosDNA name and alias of the catalog and every product name
+        of ProductResolver.names_path, like the rows of product pages
+
+    repeat : int, default 3
+        Each implementation is timed `repeat` times; the fastest is kept
+
+    catalog : str, default None
+        Path of the catalog, see load_catalog()
+
+    Returns
+    -------
+    dict of function -> implementation -> strings/sec, and 'mismatches':
+    strings where an implementation differs from the reference
+    '''
+    names = []
+    for record in load_catalog(catalog or IndexBundle.catalog).values():
+        names += [record['name'], record['cosdna_name']]
+        names += record.get('aliases') or []
+    if os.path.exists(ProductResolver.names_path):
+        with open(ProductResolver.names_path) as handle:
+            names += list(json.load(handle))
+    names = list(dict.fromkeys(name for name in names if name))
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    strings = rng.choices(names, weights, k=n)
+
+    def cold(function):
+        def run():
+            _clean_name.cache_clear()
+            _ngrams.cache_clear()
+            return function()
+        return run
+
+    implementations = {
+        'clean': {
+            'reference': lambda: [_clean_reference(x) for x in strings],
+            'compiled_cold': cold(lambda: [Cosmetic.clean(x)
+                                           for x in strings]),
+            'compiled_warm': lambda: [Cosmetic.clean(x) for x in strings],
+            'batch': lambda: clean_all(strings),
+        },
+        'ngrams': {
+            'reference': lambda: [_ngrams_reference(x) for x in strings],
+            'compiled_cold': cold(lambda: [ngrams(x) for x in strings]),
+            'compiled_warm': lambda: [ngrams(x) for x in strings],
+            'batch': lambda: ngrams_all(strings),
+        },
+    }
+    results = {'strings': n, 'distinct': len(set(strings)), 'mismatches': 0}
+    for function, timed in implementations.items():
+        expected = timed['reference']()
+        results[function] = {}
+        for implementation, run in timed.items():
+            mismatches = sum(a != b for a, b in zip(run(), expected))
+            results['mismatches'] += mismatches
+            results[function][implementation] = n / _best_time(run, repeat)
+    return results
+
+
+def benchmark_transport(routine=None, n=200):
+    '''
+    Compares the shared Transport() against one HTMLSession() per object,
+    which is how CosDNA() worked when it subclassed HTMLSession.
+
+    Parameters
+    ----------
+    routine : Routine, default None
+        If given, re-syncs the routine (deep, bypassing the response
+        cache) and counts the requests made and sockets opened by the
+        shared transport. The same requests are then replayed with one
+        HTMLSession() per object, and the sockets those sessions open are
+        counted too. Both arms hit the network, or the StandIn() the
+        domain points to, paced by the same RateLimiter() and
+        CircuitBreaker()
+
+    n : int, default 200
+        Number of objects to create when timing object creation
+
+    Returns
+    -------
+    dict of timings (seconds per object) and socket counts
+    '''
+    start = time.perf_counter()
+    for _ in range(n):
+        HTMLSession().close()
+    session_init = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for _ in range(n):
+        Ingredient(name='water')
+    ingredient_init = (time.perf_counter() - start) / n
+    results = {
+        'per_object_session_init_s': session_init,
+        'shared_transport_init_s': ingredient_init,
+        'speedup': session_init / ingredient_init,
+    }
+    if routine:
+        transport = CosDNA.transport
+        transport.set_pool_size(transport.pool_size)    # reset counters
+        cache, get = transport.cache, CosDNA.get
+        requests_before = transport.requests
+        fetched = []        # (object, url) of every request
+
+        def recording_get(cosmetic, url, **kwargs):
+            fetched.append((id(cosmetic), url))
+            return get(cosmetic, url, **kwargs)
+
+        transport.set_cache(None)
+        CosDNA.get = recording_get
+        try:
+            routine.link_sync(force=True, deep=True)
+        finally:
+            CosDNA.get = get
+            transport.set_cache(cache)
+        results['requests'] = transport.requests - requests_before
+        results['sockets_opened'] = transport.sockets_opened
+        results['sockets_opened_per_object_sessions'] = \
+            _per_object_sockets(fetched)
+    return results
+
+
+def _per_object_sockets(fetched):
+    '''
+    Helper function for benchmark_transport()
+    Replays (object, url) requests with one HTMLSession() per object.
+    Every session gets its own connection pool, but the requests are still
+    paced and guarded by the limiter and breaker of CosDNA.transport.
+    Returns the number of sockets the sessions opened
+    '''
+    transport = CosDNA.transport
+    sessions = {}
+    try:
+        for key, url in fetched:
+            if key not in sessions:
+                sessions[key] = HTMLSession()
+                adapter = CosDNAAdapter(limiter=transport.limiter,
+                                        breaker=transport.breaker,
+                                        timeout=transport.timeout,
+                                        retries=transport.retries)
+                sessions[key].mount('https://', adapter)
+                sessions[key].mount('http://', adapter)
+            try:
+                sessions[key].get(url)
+            except requests.exceptions.RequestException:
+                pass
+        opened = 0
+        for session in sessions.values():
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                opened += sum(pools[key].num_connections
+                              for key in pools.keys())
+        return opened
+    finally:
+        for session in sessions.values():
+            session.close()
+
+
+def measure_memory(pages=os.path.join(DATA_DIR, 'pages'),
+                   modes=('response', 'parsed', 'keep_html')):
+    '''
+    Measures the memory held per parsed Product() and Ingredient(), with
+    tracemalloc
+
+    Parameters
+    ----------
+    pages : dict or str, default DATA_DIR/pages
+        URL -> raw page, or a directory saved with save_pages()
+
+    modes : iterable, default ('response', 'parsed', 'keep_html')
+        'response' keeps each response after parsing, as every object did
+        before responses were released. 'parsed' keeps the parsed fields
+        only. 'keep_html' also keeps the page compressed (Cosmetic.keep_html)
+
+    Returns
+    -------
+    dict of mode -> {'product': bytes per object, 'ingredient': ...}
+    '''
+    if isinstance(pages, str):
+        pages = load_pages(pages)
+    pages = [(url, content) for url, content in pages.items()
+             if page_kind(url) != 'search']
+    keep_html = Cosmetic.keep_html
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = _measure_memory(pages, modes)
+    finally:
+        Cosmetic.keep_html = keep_html
+    return results
+
+
+def _measure_memory(pages, modes):
+    '''
+    Helper function for measure_memory()
+    '''
+    results = {}
+    for mode in modes:
+        Cosmetic.keep_html = mode == 'keep_html'
+        sizes, counts = Counter(), Counter()
+        for url, content in pages:
+            kind = page_kind(url)
+            tracemalloc.start()
+            response = requests.models.Response()
+            response._content, response.url = content, url
+            response.status_code = 200
+            cosmetic = (Product if kind == 'product' else
+                        Ingredient)(cosdna_url=url)
+            cosmetic._r = response
+            cosmetic._parse(cosmetic._read)
+            if mode == 'response':
+                cosmetic._r = response
+            del response
+            gc.collect()
+            sizes[kind] += tracemalloc.get_traced_memory()[0]
+            counts[kind] += 1
+            tracemalloc.stop()
+            del cosmetic
+        results[mode] = {kind: sizes[kind] / counts[kind]
+                         for kind in counts}
+    return results
+
+
+def load_catalog(path=IndexBundle.catalog):
+    '''
+    Loads the ingredient catalog
+    Returns dict of cosdna_id -> ingredient record (name, cosdna_name,
+    aliases, mass, hlb, cas_no, description)
+    '''
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def synthetic_catalog(n=5000, seed=0):
+    '''
+    Generates a catalog of n made-up ingredients, shaped like
+    load_catalog(), for benchmarks beyond the size of the real catalog
+    '''
+    rng = random.Random(seed)
+    catalog = {}
+    for i in range(n):
+        name = f'synthetic ingredient {i}'
+        catalog[f'{rng.getrandbits(40):010x}{i}'] = {
+            'name': name,
+            'cosdna_name': name,
+            'aliases': [f'{name} alias {j}' for j in range(rng.randint(0, 3))],
+            'mass': round(rng.uniform(18, 1000), 2),
+            'hlb': None,
+            'cas_no': (f'{rng.randint(50, 99999)}-{rng.randint(10, 99)}-'
+                       f'{i % 10}'),
+            'description': 'Synthetic',
+        }
+    return catalog
+
+
+def make_routine(catalog, n_products=10, ingredients=(8, 30), seed=0,
+                 name=None):
+    '''
+    Builds a synced, analyzed Routine() from catalog records without
+    touching the network
+
+    Parameters
+    ----------
+    catalog : dict
+        cosdna_id -> ingredient record, see load_catalog()
+
+    n_products : int, default 10
+        Number of products in the routine
+
+    ingredients : tuple, default (8, 30)
+        Minimum and maximum number of ingredients per product. Ingredients
+        are sampled with a long tail, like real products: a few appear in
+        almost every product, most in only a few
+    '''
+    rng = random.Random(seed)
+    ids = list(catalog)
+    weights = [1 / (rank + 1) for rank in range(len(ids))]
+    routine = Routine(name)
+    for n in range(n_products):
+        size = min(rng.randint(*ingredients), len(ids))
+        product_ids = list(dict.fromkeys(rng.choices(ids, weights, k=size)))
+        product = Product(f'brand{n % 7} product {n}',
+                          cosdna_url=f'{Cosmetic._domain}/eng/cosmetic_'
+                                     f'{seed:x}{n:06x}.html')
+        product._set_state({
+            'brand': f'brand{n % 7}',
+            'product': f'product {n}',
+            '_ingredients': [_catalog_ingredient(catalog, cosdna_id)
+                             for cosdna_id in product_ids],
+            '_synced': True,
+        })
+        routine.products.append(product)
+    return routine._analyze()
+
+
+def _catalog_ingredient(catalog, cosdna_id):
+    '''
+    Helper function for make_routine()
+    Returns a synced Ingredient() for catalog[cosdna_id]
+    '''
+    record = catalog[cosdna_id]
+    ingredient = Ingredient(name=record['name'],
+                            cosdna_url=f'{Cosmetic._domain}/eng/'
+                                       f'{cosdna_id}.html')
+    return ingredient._set_state({
+        '_cosdna_name': record['cosdna_name'],
+        'aliases': record['aliases'],
+        'mass': record['mass'],
+        'hlb': record['hlb'],
+        'cas_no': record['cas_no'],
+        'description': record['description'],
+        '_synced': True,
+    })
+
+
+def _best_time(function, repeat):
+    '''
+    Helper function for benchmark_analytics() and benchmark_normalization()
+    Returns the fastest of `repeat` calls to function, in seconds
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_analytics(scales=(10, 100, 10000), repeat=3,
+                        catalog=IndexBundle.catalog,
+                        synthetic=5000,
+                        directory=os.path.join(DATA_DIR, 'benchmarks'),
+                        label=None):
+    '''
+    Times the Routine() analytics (_analyze() and its helpers,
+    top_ingredients(), has() with a name and with a boolean query) and
+    ngrams() on routines of several sizes, built from the real catalog and
+    from a synthetic one. Saves the results to `directory` as
+    analytics_<label>.json, see compare_benchmarks()
+
+    Nothing is fetched: searches and syncs for has() and
+    top_ingredients(mask=...) are answered from in-memory copies of
+    Cosmetic.searches and CosDNA.registry seeded with the catalog, and
+    Cosmetic.catalog is swapped for an empty one
+
+    Parameters
+    ----------
+    scales : tuple, default (10, 100, 10000)
+        Numbers of products per routine
+
+    repeat : int, default 3
+        Each operation is timed `repeat` times; the fastest time is kept
+
+    catalog : str
+        Path of the real catalog, see load_catalog()
+
+    synthetic : int, default 5000
+        Size of the synthetic catalog. 0 skips it
+
+    directory : str, default DATA_DIR/benchmarks
+        Where to save the results. None doesn't save them
+
+    label : str, default None
+        Names the results, e.g. a version. Defaults to a timestamp
+
+    Returns
+    -------
+    dict with the run's metadata and a list of results, one per dataset,
+    scale and operation
+    '''
+    label = label or time.strftime('%Y%m%d-%H%M%S')
+    datasets = {'catalog': load_catalog(catalog)}
+    if synthetic:
+        datasets['synthetic'] = synthetic_catalog(synthetic)
+    searches, registry = Cosmetic.searches, CosDNA.registry
+    catalog_ = Cosmetic.catalog
+    results = []
+    try:
+        Cosmetic.searches, CosDNA.registry = SearchCache(':memory:'), \
+            SyncRegistry()
+        Cosmetic.catalog = Catalog(':memory:', seed=None)
+        for dataset, records in datasets.items():
+            _seed_offline(records)
+            for n_products in scales:
+                routine = make_routine(records, n_products)
+                common = [name for name, _ in routine.top_ingredients(5)]
+                names = [ingredient.name for product in routine.products
+                         for ingredient in product._ingredients]
+                operations = {
+                    '_analyze': routine._analyze,
+                    '_get_routine_info': routine._get_routine_info,
+                    '_translate_counter': lambda: routine._translate_counter(
+                        routine._routine_dict, Counter(routine._routine_ids)
+                    ),
+                    '_get_product_vectors': routine._get_product_vectors,
+                    'top_ingredients': lambda: routine.top_ingredients(10),
+                    'top_ingredients_mask': lambda: routine.top_ingredients(
+                        10, mask=common
+                    ),
+                    'has': lambda: routine.has(common[0]),
+                    'has_query': lambda: routine.has(
+                        f'{common[0]} AND NOT ({common[1]} OR {common[2]})'
+                    ),
+                    'ngrams': lambda: [ngrams(name) for name in names],
+                }
+                for operation, function in operations.items():
+                    results.append({
+                        'dataset': dataset,
+                        'products': n_products,
+                        'ingredients': len(routine._routine_ids),
+                        'operation': operation,
+                        'seconds': _best_time(function, repeat),
+                    })
+    finally:
+        Cosmetic.searches, CosDNA.registry = searches, registry
+        Cosmetic.catalog = catalog_
+    run = {
+        'label': label,
+        'created_at': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'analytics_{label}.json'),
+                  'w') as handle:
+            json.dump(run, handle, indent=4)
+    return run
+
+
+def _seed_offline(catalog):
+    '''
+    Helper function for benchmark_analytics()
+    Answers every search for a catalog name and every sync of a catalog
+    ingredient from Cosmetic.searches and CosDNA.registry. A name shared by
+    several records resolves to the record whose CosDNA name it is
+    '''
+    base_url = Ingredient._url('search')
+    urls = {}
+    for field in ('cosdna_name', 'name'):
+        for cosdna_id, record in catalog.items():
+            query = Cosmetic.clean(record[field], query=True)
+            urls.setdefault(query, f'{Cosmetic._domain}/eng/{cosdna_id}.html')
+    for query, url in urls.items():
+        Cosmetic.searches.store(base_url, query, None, url)
+    for cosdna_id in catalog:
+        CosDNA.registry.store(_catalog_ingredient(catalog, cosdna_id))
+
+
+def compare_benchmarks(before, after):
+    '''
+    Compares two runs of benchmark_analytics(), given as returned or as
+    paths of the saved JSON files
+
+    Returns dict of (dataset, products, operation) -> after / before.
+    Ratios above 1 are regressions
+    '''
+    runs = []
+    for run in (before, after):
+        if isinstance(run, str):
+            with open(run) as handle:
+                run = json.load(handle)
+        runs.append({(r['dataset'], r['products'], r['operation']):
+                     r['seconds'] for r in run['results']})
+    before, after = runs
+    return {key: after[key] / before[key] for key in after
+            if key in before and before[key]}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Manage batch-mode searches, the catalog and its '
+                    'index, the local stand-in and benchmarks'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export',
+                                 help='write pending searches to a CSV')
+    export.add_argument('path')
+    resolve = commands.add_parser('resolve', help='resolve pending searches')
+    resolve.add_argument('--corrections', default=None,
+                         help='CSV from `export` with resolutions filled in')
+    standin = commands.add_parser('standin',
+                                  help='serve recorded pages locally')
+    standin.add_argument('pages', nargs='?',
+                         default=os.path.join(DATA_DIR, 'pages'))
+    standin.add_argument('--port', type=int, default=8000)
+    standin.add_argument('--latency', type=float, nargs='+', default=[0.0],
+                         help='seconds, or MIN MAX for a random latency')
+    standin.add_argument('--error-rate', type=float, default=0.0)
+    standin.add_argument('--throttle-rate', type=float, default=0.0)
+    standin.add_argument('--retry-after', type=float, default=1.0)
+    catalog = commands.add_parser('catalog',
+                                  help='import or export the catalog JSON')
+    catalog.add_argument('--import', dest='import_path', default=None,
+                         help='e.g. data/ingredients/ingredients.json')
+    catalog.add_argument('--names', default=None,
+                         help='e.g. data/ingredients/ingredient-names.json')
+    catalog.add_argument('--export', dest='export_path', default=None)
+    index = commands.add_parser('index',
+                                help='rebuild the catalog IndexBundle')
+    index.add_argument('--catalog', default=IndexBundle.catalog)
+    index.add_argument('--path', default=IndexBundle.path)
+    memory = commands.add_parser('memory',
+                                 help='measure memory per parsed object')
+    memory.add_argument('pages', nargs='?',
+                        default=os.path.join(DATA_DIR, 'pages'))
+    resolver = commands.add_parser('resolver',
+                                   help='refit the product name resolver '
+                                        'and match names with it')
+    resolver.add_argument('names', nargs='*')
+    resolver.add_argument('-k', type=int, default=3)
+    benchmark = commands.add_parser('benchmark',
+                                    help='time the Routine() analytics')
+    benchmark.add_argument('--scales', type=int, nargs='+',
+                           default=[10, 100, 10000])
+    benchmark.add_argument('--repeat', type=int, default=3)
+    benchmark.add_argument('--label', default=None,
+                           help='e.g. a version; defaults to a timestamp')
+    benchmark.add_argument('--compare', default=None,
+                           help='JSON of an earlier run to compare against')
+    benchmark.add_argument('--normalization', action='store_true',
+                           help='time clean() and ngrams() instead')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        Cosmetic.pending.export(args.path)
+        print(f'{len(Cosmetic.pending)} pending searches written to '
+              f'{args.path}')
+    elif args.command == 'resolve':
+        resolve_pending(corrections=args.corrections)
+        print(f'{len(Cosmetic.pending)} searches still pending')
+    elif args.command == 'standin':
+        latency = args.latency[0] if len(args.latency) == 1 else args.latency
+        server = StandIn(args.pages, port=args.port, latency=latency,
+                         error_rate=args.error_rate,
+                         throttle_rate=args.throttle_rate,
+                         retry_after=args.retry_after).start()
+        print(f'Serving {len(server.pages)} pages at {server.url} '
+              "(use Cosmetic.set_domain(url)); Ctrl-C to stop")
+        try:
+            server._thread.join()
+        except KeyboardInterrupt:
+            server.stop()
+    elif args.command == 'catalog':
+        if args.import_path:
+            Cosmetic.catalog.import_json(args.import_path)
+        if args.names and not args.export_path:
+            Cosmetic.catalog.import_json(args.names)
+        if args.export_path:
+            Cosmetic.catalog.export_json(args.export_path, names=args.names)
+        print(f'{len(Cosmetic.catalog)} ingredients in '
+              f'{Cosmetic.catalog.path}')
+    elif args.command == 'index':
+        path = IndexBundle.build(args.catalog, args.path)
+        bundle = IndexBundle(path)
+        print(f"Indexed {len(bundle)} ingredients and {len(bundle.keys)} "
+              f"names in {path} ({os.path.getsize(path)} bytes)")
+    elif args.command == 'resolver':
+        resolver = ProductResolver.fit()
+        path = resolver.save()
+        print(f'Indexed {len(resolver.names)} product names in {path}')
+        for name, candidates in zip(args.names,
+                                    resolver.match(args.names, k=args.k)):
+            print(name)
+            for candidate, cosdna_id, score in candidates:
+                print(f'    {score:.2f} {candidate} ({cosdna_id})')
+    elif args.command == 'memory':
+        for mode, sizes in measure_memory(args.pages).items():
+            print(f'{mode:>9}', *(f'{kind} {size:,.0f} B'
+                                  for kind, size in sorted(sizes.items())))
+    elif args.command == 'benchmark' and args.normalization:
+        results = benchmark_normalization(repeat=args.repeat)
+        for function in ('clean', 'ngrams'):
+            for implementation, rate in results[function].items():
+                print(f'{function:>6} {implementation:<14} '
+                      f'{rate:12,.0f} strings/s')
+        print(f"{results['mismatches']} mismatches")
+    elif args.command == 'benchmark':
+        run = benchmark_analytics(scales=args.scales, repeat=args.repeat,
+                                  label=args.label)
+        for result in run['results']:
+            print('{dataset:>9} {products:>5} {operation:<22} '
+                  '{seconds:.6f}s'.format(**result))
+        if args.compare:
+            for key, ratio in compare_benchmarks(args.compare, run).items():
+                print(*key, f'{ratio:.2f}x')
@@ -0,0 +1,88 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+
+
+def _load():
+    '''
+    Imports OOP-hackaroutine.py, whose name isn't a valid module name
+    '''
+    spec = importlib.util.spec_from_file_location(
+        'hackaroutine', os.path.join(ROOT, 'OOP-hackaroutine.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['hackaroutine'] = module     # pickle finds classes here
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def har():
+    har = _load()
+    har.Cosmetic.interactive = False
+    return har
+
+
+@pytest.fixture
+def isolated(har, tmp_path, monkeypatch):
+    '''
+    Gives the test its own catalog, caches, queue and an unpaced transport
+    '''
+    monkeypatch.setattr(har.CosDNA, 'transport', har.Transport())
+    monkeypatch.setattr(har.CosDNA, 'registry', har.SyncRegistry())
+    # set under the lazy attribute, so the shared bundle is never built
+    monkeypatch.setattr(vars(har.CosDNA)['index'], '_value',
+                        har.IndexBundle.load(str(tmp_path / 'index.bundle')))
+    monkeypatch.setattr(har.Cosmetic, 'catalog', har.Catalog(
+        str(tmp_path / 'catalog.sqlite'), seed=None
+    ))
+    monkeypatch.setattr(har.Cosmetic, 'searches', har.SearchCache(
+        str(tmp_path / 'searches.sqlite')
+    ))
+    monkeypatch.setattr(har.Cosmetic, 'pending', har.PendingQueue(
+        str(tmp_path / 'pending.sqlite')
+    ))
+    return har
+
+
+@pytest.fixture
+def offline(isolated, monkeypatch):
+    '''
+    isolated, answering every request with the recorded no-results
+    search page
+    '''
+    with open(os.path.join(FIXTURES, 'pages', 'search_000001.html'),
+              'rb') as handle:
+        no_results = handle.read()
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = no_results
+        response.url = request.url
+        response.request = request
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    return isolated
+
+
+@pytest.fixture
+def standin(isolated):
+    '''
+    isolated, with CosDNA.com replaced by a StandIn() of the fixture pages
+    '''
+    with isolated.StandIn(os.path.join(FIXTURES, 'pages')) as standin:
+        isolated.Cosmetic.set_domain(standin.url)
+        try:
+            yield standin
+        finally:
+            isolated.Cosmetic.set_domain()
@@ -0,0 +1,97 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def catalog(har):
+    return har.synthetic_catalog(200, seed=1)
+
+
+def routine(har, catalog, seed, name=None, unparsed=False):
+    routine = har.make_routine(catalog, 4, seed=seed, name=name)
+    if unparsed:
+        for product in routine.products:
+            product._ingredients = product._ingredients + [
+                har.Ingredient('mystery extract')
+            ]
+        routine._analyze()
+    return routine
+
+
+def test_routine_index_replaces_key(har, catalog):
+    index = har.RoutineIndex()
+    index.add(routine(har, catalog, 1), key='a')
+    index.add(routine(har, catalog, 2), key='b')
+    replacement = routine(har, catalog, 3)
+    index.add(replacement, key='a')
+    assert len(index) == 2
+    keys = [key for key, _ in index.query(replacement)]
+    assert sorted(keys) == sorted(set(keys))
+    assert keys[0] == 'a'
+    index.remove('a')
+    assert index.keys == ['b']
+    assert [key for key, _ in index.query(replacement)] in ([], ['b'])
+
+
+def test_routine_index_keeps_unnamed_routines(har, catalog):
+    routines = [routine(har, catalog, seed) for seed in (1, 2, 3)]
+    index = har.RoutineIndex(routines)
+    assert index.keys == [0, 1, 2]
+    index.remove(1)
+    assert index.add(routines[1]) == 3
+    assert index.add(routines[0], key='named') == 'named'
+    assert len(index) == 4
+    assert index.similar(0)[0] == ('named', pytest.approx(1.0))
+
+
+def test_routine_index_ignores_unparsed_products(har, catalog):
+    left = dict(list(catalog.items())[:100])
+    right = dict(list(catalog.items())[100:])
+    index = har.RoutineIndex([routine(har, left, 1, 'left', True)])
+    assert index.query(routine(har, right, 2, 'right', True)) == []
+
+
+def test_recommend_ignores_unknown_ingredients(offline):
+    har = offline
+    records = har.load_catalog()
+    ids = list(records)
+    routine = har.make_routine({i: records[i] for i in ids[:12]}, 2, seed=4)
+    wanted, other = ids[40], ids[41]
+
+    def listing(*ingredients):
+        return [{'name': records[i]['name'], 'cosdna_id': i}
+                for i in ingredients]
+    har.Cosmetic.catalog.upsert_products({
+        'cosmetic_a': {'name': 'a', 'brand': 'b', 'product': 'a',
+                       'ingredients': listing(*ids[:6], other)},
+        'cosmetic_b': {'name': 'b', 'brand': 'b', 'product': 'b',
+                       'ingredients': listing(ids[0], wanted)},
+        'cosmetic_c': {'name': 'c', 'brand': 'b', 'product': 'c',
+                       'ingredients': listing(ids[50], ids[51])},
+    })
+    candidates = har.CandidateIndex(har.Cosmetic.catalog)
+    want = [records[wanted]['name']]
+    unknown = 'no such ingredient'
+    expected = routine.recommend(want=want, candidates=candidates)
+    assert expected[0][1] == 'cosmetic_b'
+    assert routine.recommend(want=want + [unknown],
+                             candidates=candidates) == expected
+    assert routine.recommend(avoid=[unknown], want=want,
+                             candidates=candidates) == expected
+    assert [row[1] for row in routine.recommend(
+        avoid=[records[other]['name']], want=want, candidates=candidates
+    )] == ['cosmetic_b']
+
+
+def test_unresolvable_names_match_nothing(offline):
+    har = offline
+    records = har.load_catalog()
+    routine = har.make_routine(dict(list(records.items())[:12]), 3, seed=2)
+    # an unlinked ingredient, listed as 'unavailable'
+    routine.products[0]._ingredients[0]._cosdna_id = 'unavailable'
+    routine._analyze()
+    unknown = 'zzz no such thing'
+    assert routine.has(unknown) == []
+    assert routine.has(f'NOT {unknown}') == [
+        product.name for product in routine.products
+    ]
+    assert routine.top_ingredients(mask=[unknown]) == []
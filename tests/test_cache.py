@@ -0,0 +1,78 @@
+import pytest
+
+
+@pytest.fixture
+def cache(isolated, standin, tmp_path):
+    cache = isolated.ResponseCache(str(tmp_path / 'responses.sqlite'),
+                                   ttl=60)
+    isolated.CosDNA.transport.set_cache(cache)
+    return cache
+
+
+def page(standin, name='cosmetic_8f1a95'):
+    return f'{standin.url}/eng/{name}.html'
+
+
+def age(cache, seconds):
+    cache.conn.execute('UPDATE responses SET stored_at = stored_at - ?',
+                       (seconds,))
+    cache.conn.commit()
+
+
+def test_fresh_entries_skip_the_network(isolated, standin, cache):
+    transport = isolated.CosDNA.transport
+    first = transport.get(page(standin))
+    second = transport.get(page(standin))
+    assert second.content == first.content
+    assert standin.stats['requests'] == 1
+    assert cache.stats['hits'] == 1
+    age(cache, 61)
+    assert not cache.lookup(page(standin))['fresh']
+    transport.get(page(standin))
+    assert standin.stats['requests'] == 2
+
+
+@pytest.mark.parametrize('validator', ['etag', 'last_modified'])
+def test_unchanged_page_revalidates(isolated, standin, cache, validator):
+    transport = isolated.CosDNA.transport
+    body = transport.get(page(standin)).content
+    age(cache, 61)
+    other = {'etag': 'last_modified', 'last_modified': 'etag'}[validator]
+    cache.conn.execute(f'UPDATE responses SET {other} = NULL')
+    response = transport.get(page(standin))
+    assert response.status_code == 200
+    assert response.content == body
+    assert standin.stats['not_modified'] == 1
+    assert standin.stats['served'] == 1
+    assert cache.stats['revalidated'] == 1
+    transport.get(page(standin))        # fresh again
+    assert standin.stats['requests'] == 2
+
+
+def test_changed_page_is_downloaded_again(isolated, standin, cache):
+    transport = isolated.CosDNA.transport
+    transport.get(page(standin))
+    age(cache, 61)
+    standin.pages['/eng/cosmetic_8f1a95.html'] = b'<html>changed</html>'
+    assert transport.get(page(standin)).content == b'<html>changed</html>'
+    assert standin.stats['served'] == 2
+    assert cache.lookup(page(standin))['body'] == b'<html>changed</html>'
+
+
+def test_least_recently_used_entries_are_evicted(isolated, standin, cache):
+    transport = isolated.CosDNA.transport
+    names = ['cosmetic_8f1a95', 'cosmetic_4b02ce', '90172810251']
+    for name in names:
+        transport.get(page(standin, name))
+    sizes = dict(cache.conn.execute('SELECT url, size FROM responses'))
+    cache.clear()
+    cache.max_size = sum(sizes.values()) - 1     # one page too many
+    transport.get(page(standin, names[0]))
+    transport.get(page(standin, names[1]))
+    transport.get(page(standin, names[0]))      # names[1] is now oldest
+    transport.get(page(standin, names[2]))
+    assert cache.lookup(page(standin, names[1])) is None
+    assert cache.lookup(page(standin, names[0])) is not None
+    assert cache.lookup(page(standin, names[2])) is not None
+    assert cache.stats['evictions'] == 1
+    assert cache.size <= cache.max_size
@@ -0,0 +1,121 @@
+from email.utils import formatdate
+
+import pytest
+
+
+class Blocked(Exception):
+    '''
+    acquire() would wait for a release() that never comes
+    '''
+
+
+class FakeClock():
+    '''
+    Stands in for the time module; waiting moves the clock forward
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1.7e9 + self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeCondition():
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            raise Blocked()
+        self.clock.sleep(timeout)
+
+    def notify_all(self):
+        pass
+
+
+@pytest.fixture
+def clock(har, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(har, 'time', clock)
+    return clock
+
+
+def limiter(har, clock, **kwargs):
+    limiter = har.RateLimiter(**kwargs)
+    limiter._cond = FakeCondition(clock)
+    return limiter
+
+
+def send(limiter, clock, status=200, latency=0.1, retry_after=None):
+    '''
+    One request through limiter; returns when it was sent
+    '''
+    limiter.acquire()
+    sent = clock.now
+    limiter.release(status, latency, retry_after)
+    return sent - 1000.0
+
+
+def test_token_bucket_paces_after_burst(har, clock):
+    paced = limiter(har, clock, rate=2.0, burst=3, max_concurrency=100)
+    times = [send(paced, clock) for _ in range(7)]
+    assert times == pytest.approx([0, 0, 0, 0.5, 1.0, 1.5, 2.0])
+    clock.sleep(10)                 # the bucket refills, up to burst
+    times = [send(paced, clock) - 12.0 for _ in range(4)]
+    assert times == pytest.approx([0, 0, 0, 0.5])
+
+
+def test_aimd_backs_off_and_recovers(har, clock):
+    paced = limiter(har, clock, rate=1000.0, burst=1000, max_concurrency=8,
+                    target_latency=1.0, decrease=0.5)
+    send(paced, clock, latency=2.0)
+    assert paced.limit == 4
+    send(paced, clock, status=429, retry_after='0')
+    assert paced.limit == 2
+    paced.acquire()
+    paced.acquire()
+    with pytest.raises(Blocked):    # two requests already in flight
+        paced.acquire()
+    paced.release(200, 0.1)
+    paced.release(200, 0.1)
+    assert paced.limit == pytest.approx(2.5 + 1 / 2.5)
+    for _ in range(100):
+        send(paced, clock)
+    assert paced.limit == 8
+
+
+def test_retry_after_is_honored_and_capped(har, clock):
+    paced = limiter(har, clock, rate=1000.0, burst=1000, max_pause=10.0)
+    start = send(paced, clock, status=429, retry_after='3')
+    assert send(paced, clock) - start == pytest.approx(3)
+    start = send(paced, clock, status=503,
+                 retry_after=formatdate(clock.time() + 5, usegmt=True))
+    assert send(paced, clock) - start == pytest.approx(5, abs=1)
+    start = send(paced, clock, status=429, retry_after='120')
+    assert send(paced, clock) - start == pytest.approx(10)
+
+
+def test_backoff_doubles_without_retry_after(har, clock):
+    paced = limiter(har, clock, rate=1000.0, burst=1000, backoff=1.0,
+                    max_backoffs=2, max_pause=60.0)
+    times = [send(paced, clock, status=429) for _ in range(5)]
+    pauses = [later - earlier for earlier, later in zip(times, times[1:])]
+    # strikes stop growing at max_backoffs
+    assert pauses == pytest.approx([1, 2, 4, 4])
+    clock.sleep(100)
+    send(paced, clock)              # a success resets the backoff
+    start = send(paced, clock, status=429)
+    assert send(paced, clock) - start == pytest.approx(1)
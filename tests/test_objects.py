@@ -0,0 +1,39 @@
+import os
+import pickle
+
+from conftest import ROOT
+
+
+def test_unpickle_state_from_before_slots(har):
+    # __dict__ of a synced product, as pickled before __slots__: no
+    # 'failure' or '_html', and a response still attached
+    ingredient = {'_name': 'aqua', '_synced': True, '_skip': False,
+                  '_cosdna_url': 'https://cosdna.com/eng/90172810251.html',
+                  '_cosdna_id': None, '_query': 'aqua', 'cas_no': None,
+                  '_cosdna_name': 'water', 'aliases': ['aqua'],
+                  'mass': 18.02, 'hlb': None, 'description': '', '_r': None}
+    water = har.Ingredient.__new__(har.Ingredient)
+    water.__setstate__(ingredient)
+    product = har.Product.__new__(har.Product)
+    product.__setstate__({
+        '_name': 'cosrx snail essence', '_synced': True, '_skip': False,
+        '_cosdna_url': 'https://cosdna.com/eng/cosmetic_8f1a95.html',
+        '_cosdna_id': None, '_query': 'cosrx snail essence',
+        'brand': 'cosrx', 'product': 'snail essence',
+        '_ingredients': [water], '_r': object(), 'headers': {},
+    })
+    assert product.failure is None and product.html is None
+    assert product.ingredients == ['water']
+    assert product._cosdna_ids == ['90172810251']
+    restored = pickle.loads(pickle.dumps(product))
+    assert restored.name == product.name
+    assert restored.ingredients == ['water']
+
+
+def test_unpickle_routines_from_html_session_era(har):
+    # saved when CosDNA subclassed HTMLSession: session settings only
+    path = os.path.join(ROOT, 'data', 'am_routine_objects.pickle')
+    with open(path, 'rb') as handle:
+        routines = pickle.load(handle)
+    assert all(isinstance(routine, har.Routine) for routine in routines)
+    assert all(routine.products == [] for routine in routines)
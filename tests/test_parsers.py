@@ -0,0 +1,29 @@
+import os
+
+from conftest import FIXTURES
+
+
+PAGES = os.path.join(FIXTURES, 'pages')
+
+
+def test_parsers_match_reference(har):
+    assert har.check_parsers(PAGES) == []
+
+
+def test_parsed_fields(har):
+    pages = har.load_pages(PAGES)
+    product = har.parse_product_page(
+        pages['https://cosdna.com/eng/cosmetic_4b02ce.html']
+    )
+    assert product['brand'] == 'klairs'
+    assert product['ingredients'][2] == {'name': 'dimethyl sulfone',
+                                         'href': None}
+    water = har.parse_ingredient_page(
+        pages['https://cosdna.com/eng/90172810251.html']
+    )
+    assert (water['mass'], water['hlb'], water['cas_no']) == \
+        (18.02, None, '7732-18-5')
+    assert har.parse_search_page(
+        pages['https://cosdna.com/eng/product.php?q=no+such+product'
+              '&sort=featured']
+    ) == {'href': None, 'no_results': True}
@@ -0,0 +1,55 @@
+import csv
+
+
+def test_corrections_csv_resolves_queue(isolated, standin, tmp_path):
+    har = isolated
+    no_results = standin.pages['/eng/product.php?q=no+such+product'
+                               '&sort=featured']
+    names = ['no such product', 'mystery serum', 'other cream', 'last lotion']
+    for name in names[1:]:
+        query = name.replace(' ', '+')
+        standin.pages[f'/eng/product.php?q={query}&sort=featured'] = \
+            no_results
+    routine = har.Routine('r')
+    routine.products = [har.Product(name) for name in names]
+    routine.link_sync()
+    queue = har.Cosmetic.pending
+    assert [entry['name'] for entry in queue.entries()] == names
+    assert not any(product.linked for product in routine.products)
+
+    path = queue.export(str(tmp_path / 'pending.csv'))
+    with open(path, newline='') as handle:
+        rows = list(csv.DictReader(handle))
+    found = f'{standin.url}/eng/cosmetic_8f1a95.html'
+    resolutions = {
+        'no such product': found,
+        'mystery serum': 'cosrx advanced snail 96 mucin power essence',
+        'other cream': 'SKIP',
+        'last lotion': '',
+    }
+    for row in rows:
+        row['resolution'] = resolutions[row['name']]
+    with open(path, 'w', newline='') as handle:
+        writer = csv.DictWriter(handle, fieldnames=har.PendingQueue.fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    assert har.resolve_pending([routine], corrections=path) == [routine]
+    assert [entry['name'] for entry in queue.entries()] == ['last lotion']
+    assert len(queue) == 1
+    assert {entry['name']: entry['resolution']
+            for entry in queue.entries('resolved')} == {
+        'no such product': found, 'mystery serum': found,
+    }
+    assert [entry['name'] for entry in queue.entries('skip')] == \
+        ['other cream']
+    assert [(product.linked, product._skip)
+            for product in routine.products] == [
+        (True, False), (True, False), (False, True), (False, False)
+    ]
+    # resolved queries are answered by Cosmetic.searches from now on
+    requests = standin.stats['requests']
+    product = har.Product('mystery serum')
+    product.link()
+    assert product._cosdna_url == found
+    assert standin.stats['requests'] == requests
@@ -0,0 +1,33 @@
+import pytest
+
+
+def test_names_with_parentheses(har):
+    assert har.parse_query('water (aqua)') == ('term', 'water (aqua)')
+    assert har.parse_query('fragrance (parfum) AND NOT water (aqua)') == (
+        'and', ('term', 'fragrance (parfum)'),
+        ('not', ('term', 'water (aqua)'))
+    )
+    assert har.parse_query('(water (aqua) OR glycerin)') == (
+        'or', ('term', 'water (aqua)'), ('term', 'glycerin')
+    )
+    assert har.parse_query('glycyrrhiza glabra (licorice) root extract') \
+        == ('term', 'glycyrrhiza glabra (licorice) root extract')
+
+
+def test_precedence(har):
+    a, b, c = ('term', 'a'), ('term', 'b'), ('term', 'c')
+    assert har.parse_query('a OR b AND c') == ('or', a, ('and', b, c))
+    assert har.parse_query('(a OR b) AND c') == ('and', ('or', a, b), c)
+    assert har.parse_query('NOT a AND b') == ('and', ('not', a), b)
+    assert har.parse_query('NOT (a AND b)') == ('not', ('and', a, b))
+    assert har.parse_query('NOT NOT a') == ('not', ('not', a))
+    assert har.parse_query('a AND b OR c') == ('or', ('and', a, b), c)
+
+
+@pytest.mark.parametrize('query', [
+    '', 'AND', 'a AND', 'OR a', 'NOT', 'a NOT b', '(a', 'a)', '(a OR b',
+    '()', 'a AND ()', 'water (aqua', '(a) b',
+])
+def test_malformed(har, query):
+    with pytest.raises(ValueError):
+        har.parse_query(query)
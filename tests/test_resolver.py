@@ -0,0 +1,48 @@
+import json
+
+
+def fitted(har, tmp_path, monkeypatch):
+    names_path = tmp_path / 'brand_product_names.json'
+    with open(names_path, 'w') as handle:
+        json.dump({
+            "kiehl's ultra facial cream": {'brand': "kiehl's",
+                                           'product': 'ultra facial cream'},
+            'cerave hydrating cleanser': {'brand': 'cerave',
+                                          'product': 'hydrating cleanser'},
+        }, handle)
+    monkeypatch.setattr(har.ProductResolver, 'names_path', str(names_path))
+    har.Cosmetic.catalog.upsert_products({
+        'cosmetic_8f1a95': {
+            'name': 'cosrx advanced snail 96 mucin power essence',
+            'brand': 'cosrx', 'product': 'advanced snail 96 mucin power '
+                                         'essence', 'ingredients': []},
+    })
+    return har.ProductResolver.fit()
+
+
+QUERIES = ['kiels ultra facial cream', 'cosrx snail mucin essence',
+           'cerave hydrating clenser']
+
+
+def test_saved_resolver_matches_fitted(isolated, tmp_path, monkeypatch):
+    har = isolated
+    resolver = fitted(har, tmp_path, monkeypatch)
+    path = resolver.save(str(tmp_path / 'resolver.npz'))
+    read = har.ProductResolver.read(path)
+    assert read.names == resolver.names
+    assert read.records == resolver.records
+    assert read.match(QUERIES) == resolver.match(QUERIES)
+    assert read.match(QUERIES, k=1)[1][0][1] == 'cosmetic_8f1a95'
+
+
+def test_load_reads_a_valid_file(isolated, tmp_path, monkeypatch):
+    har = isolated
+    path = fitted(har, tmp_path, monkeypatch).save(
+        str(tmp_path / 'resolver.npz')
+    )
+
+    def refit(*args, **kwargs):
+        raise AssertionError('refitted a valid index')
+    monkeypatch.setattr(har.ProductResolver, 'fit', refit)
+    assert har.ProductResolver.load(path).match(QUERIES[:1], k=1)[0][0][0] \
+        == "kiehl's ultra facial cream"
@@ -0,0 +1,34 @@
+def age(searches, seconds):
+    searches.conn.execute(
+        'UPDATE searches SET resolved_at = resolved_at - ?', (seconds,)
+    )
+    searches.conn.commit()
+
+
+def test_negative_results_expire_positive_results_persist(isolated,
+                                                          standin):
+    har = isolated
+    searches = har.Cosmetic.searches
+    searches.negative_ttl = 3600
+    found = 'cosrx advanced snail 96 mucin power essence'
+    for name in (found, 'no such product'):
+        har.Product(name).link()
+    assert standin.stats['requests'] == 2
+    assert len(searches) == 2
+
+    def link_again():
+        products = [har.Product(name) for name in (found, 'no such product')]
+        for product in products:
+            product.link()
+        return [product._cosdna_url for product in products]
+
+    # within negative_ttl, neither query is searched again
+    age(searches, 3599)
+    assert link_again() == [f'{standin.url}/eng/cosmetic_8f1a95.html', None]
+    assert standin.stats['requests'] == 2
+    assert searches.stats['negative_hits'] == 1
+    # past it, only the query without hits is
+    age(searches, 2)
+    assert link_again() == [f'{standin.url}/eng/cosmetic_8f1a95.html', None]
+    assert standin.stats['requests'] == 3
+    assert searches.stats['hits'] == 2
@@ -0,0 +1,70 @@
+import json
+import zlib
+
+import pytest
+
+
+@pytest.fixture
+def routines(offline):
+    har = offline
+    catalog = dict(list(har.load_catalog().items())[:30])
+    har.Cosmetic.catalog.upsert_ingredients(catalog)
+    routines = [har.make_routine(catalog, 5, seed=seed, name=f'r{seed}')
+                for seed in (1, 2)]
+    # an unlinked ingredient, and a skipped product
+    routines[0].products[0]._ingredients[0]._cosdna_id = 'unavailable'
+    skipped = har.Product('unknown brand mystery')
+    skipped._set_state({'_ingredients': [], '_skip': True})
+    routines[1].products.append(skipped)
+    for routine in routines:
+        routine._analyze()
+    return catalog, routines
+
+
+def describe(routine):
+    return [(product.name, product.cosdna_id, product.ingredients,
+             product._cosdna_ids) for product in routine.products]
+
+
+def test_round_trip(offline, routines, tmp_path):
+    har = offline
+    catalog, saved = routines
+    queries = [record['name'] for record in list(catalog.values())[:5]]
+    queries.append(f'{queries[0]} AND NOT {queries[1]}')
+    path = har.Routine.save_all(saved, str(tmp_path / 'routines.snapshot'))
+    loaded = har.Routine.load(path)
+    assert [routine._name for routine in loaded] == ['r1', 'r2']
+    for before, after in zip(saved, loaded):
+        assert describe(after) == describe(before)
+        assert after.top_ingredients() == before.top_ingredients()
+        assert after.has(queries) == before.has(queries)
+    assert any(loaded[0].has(queries))
+
+
+def write(path, snapshot):
+    with open(path, 'wb') as handle:
+        handle.write(zlib.compress(json.dumps(snapshot).encode()))
+
+
+def test_rejects_corrupt_and_unknown_snapshots(offline, routines, tmp_path):
+    har = offline
+    path = har.Routine.save_all(routines[1], str(tmp_path / 'good'))
+    with open(path, 'rb') as handle:
+        good = handle.read()
+    snapshot = json.loads(zlib.decompress(good))
+    corrupt = tmp_path / 'corrupt'
+    corrupt.write_bytes(good[:len(good) // 2])
+    pickled = tmp_path / 'pickled'
+    pickled.write_bytes(b'\x80\x04\x95\x00\x00\x00\x00')
+    newer = str(tmp_path / 'newer')
+    write(newer, dict(snapshot, version=har.Routine.snapshot_version + 1))
+    older = str(tmp_path / 'older')
+    write(older, dict(snapshot, version=0))
+    unversioned = str(tmp_path / 'unversioned')
+    write(unversioned, {key: value for key, value in snapshot.items()
+                        if key != 'version'})
+    other = str(tmp_path / 'other')
+    write(other, dict(snapshot, format='something else'))
+    for path in (corrupt, pickled, newer, older, unversioned, other):
+        with pytest.raises(ValueError):
+            har.Routine.load(str(path))
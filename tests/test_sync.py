@@ -0,0 +1,56 @@
+import contextlib
+import io
+
+
+PRODUCTS = ['cosmetic_8f1a95', 'cosmetic_4b02ce']
+
+
+def link_sync(har, standin, **kwargs):
+    routine = har.Routine('parity')
+    routine.products = [har.Product(cosdna_url=f'{standin.url}/eng/{id_}.html')
+                        for id_ in PRODUCTS]
+    before = standin.stats['requests']
+    with contextlib.redirect_stdout(io.StringIO()):
+        routine.link_sync(deep=True, **kwargs)
+    return routine, standin.stats['requests'] - before
+
+
+def test_concurrent_link_sync_matches_serial(har, standin, tmp_path):
+    results = {}
+    for concurrency in (None, 4):
+        for force in (False, True):
+            har.Cosmetic.catalog = har.Catalog(
+                str(tmp_path / f'catalog_{concurrency}_{force}.sqlite'),
+                seed=None
+            )
+            har.CosDNA.registry.clear()
+            first, _ = link_sync(har, standin, concurrency=concurrency)
+            again, requests_ = link_sync(har, standin, force=force,
+                                         concurrency=concurrency)
+            assert again._counts == first._counts
+            results[concurrency, force] = (
+                dict(again._counts), requests_,
+                [(p.name, p.ingredients, [i.synced for i in p._ingredients])
+                 for p in again.products],
+            )
+    for force in (False, True):
+        assert results[None, force] == results[4, force]
+    # force refetches the products, not their ingredients
+    assert results[None, True][1] == results[None, False][1] + len(PRODUCTS)
+
+
+def test_failed_product_is_refetched_asynchronously(har, standin,
+                                                    monkeypatch):
+    routine = har.Routine('failed')
+    url = f'{standin.url}/eng/{PRODUCTS[0]}.html'
+    routine.products = [har.Product(cosdna_url=url)]
+    routine.products[0]._fail('sync', url, ConnectionError('earlier run'))
+
+    def blocking_sync(self, *args, **kwargs):
+        raise AssertionError('synced in the event loop')
+    monkeypatch.setattr(har.Product, 'sync', blocking_sync)
+    with contextlib.redirect_stdout(io.StringIO()):
+        routine.link_sync(concurrency=4)
+    product = routine.products[0]
+    assert product.synced and not product.failed
+    assert product.brand == 'cosrx'
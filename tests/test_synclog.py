@@ -0,0 +1,80 @@
+import json
+import os
+
+
+def record(name, description=None):
+    return {'name': name, 'cosdna_name': name, 'aliases': [], 'mass': None,
+            'hlb': None, 'cas_no': None, 'description': description}
+
+
+def crash(log):
+    '''
+    Leaves log behind as a killed process would: written, unlocked
+    '''
+    log.sync()
+    log._handle.close()
+    log._release()
+
+
+def test_replay_cuts_torn_last_line(har, tmp_path):
+    log = har.SyncLog(str(tmp_path / 'catalog.log.jsonl'))
+    log.append('ingredient', 'a', record('a'))
+    log.append('ingredient', 'b', record('b'))
+    crash(log)
+    with open(log.path, 'a') as handle:
+        handle.write('{"kind": "ingredient", "cosdna_id": "c", "rec')
+    replayed = har.SyncLog(log.base)
+    replayed.path = log.path
+    assert replayed.records('ingredient') == {'a': record('a'),
+                                              'b': record('b')}
+    replayed.append('ingredient', 'c', record('c'))
+    replayed.close()
+    with open(log.path) as handle:
+        lines = [json.loads(line) for line in handle]
+    assert [line['cosdna_id'] for line in lines] == ['a', 'b', 'c']
+
+
+def test_catalog_folds_logs_of_dead_processes(har, tmp_path):
+    base = str(tmp_path / 'catalog.log.jsonl')
+    dead = [har.SyncLog(base), har.SyncLog(base)]
+    for i, log in enumerate(dead):
+        log.append('ingredient', f'dead{i}', record(f'dead {i}'))
+        crash(log)
+    alive = har.SyncLog(base)
+    alive.append('ingredient', 'alive', record('alive'))
+    catalog = har.Catalog(str(tmp_path / 'catalog.sqlite'), seed=None,
+                          log=har.SyncLog(base))
+    try:
+        assert catalog.ingredient('dead0')['name'] == 'dead 0'
+        assert catalog.ingredient('dead1')['name'] == 'dead 1'
+        assert not any(os.path.exists(log.path) for log in dead)
+        # a log still locked by its process is left alone
+        assert catalog.ingredient('alive') is None
+        assert os.path.exists(alive.path)
+    finally:
+        catalog.close()
+        alive.close()
+
+
+def test_compaction_keeps_latest_record(har, tmp_path):
+    base = str(tmp_path / 'catalog.log.jsonl')
+    log = har.SyncLog(base)
+    log.append('ingredient', 'a', record('a', 'first'))
+    log.rotate()                # compaction interrupted by a crash
+    log.append('ingredient', 'a', record('a', 'second'))
+    log.append('ingredient', 'b', record('b', 'only'))
+    log.append('ingredient', 'b', record('b', 'latest'))
+    crash(log)
+    catalog = har.Catalog(str(tmp_path / 'catalog.sqlite'), seed=None,
+                          log=har.SyncLog(base))
+    try:
+        # the catalog keeps the first name, but every other field is new
+        assert catalog.ingredient('a')['description'] == 'second'
+        assert catalog.ingredient('b')['description'] == 'latest'
+        assert len(catalog.log) == 0
+        catalog.log.append('ingredient', 'a', record('a', 'third'))
+        assert catalog.ingredient('a')['description'] == 'third'
+        assert catalog.compact() == 1
+        assert catalog.ingredient('a')['description'] == 'third'
+    finally:
+        catalog.close()
@@ -0,0 +1,73 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+import pytest
+
+
+def respond(status, headers=None):
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers or {})
+        response._content = b''
+        response.url = request.url
+        response.request = request
+        return response
+    return send
+
+
+def get(adapter, url='https://cosdna.com/eng/cosmetic_0.html'):
+    return adapter.send(requests.Request('GET', url).prepare())
+
+
+@pytest.mark.parametrize('status', [500, 503])
+def test_breaker_opens_on_5xx(har, monkeypatch, status):
+    monkeypatch.setattr(HTTPAdapter, 'send', respond(status))
+    breaker = har.CircuitBreaker(threshold=3)
+    adapter = har.CosDNAAdapter(breaker=breaker, retries=0)
+    for _ in range(3):
+        assert get(adapter).status_code == status
+    assert breaker.state == 'open'
+    with pytest.raises(har.CircuitOpen):
+        get(adapter)
+
+
+def test_breaker_opens_on_exhausted_429(har, monkeypatch):
+    monkeypatch.setattr(HTTPAdapter, 'send',
+                        respond(429, {'Retry-After': '0'}))
+    breaker = har.CircuitBreaker(threshold=2)
+    limiter = har.RateLimiter(rate=1000, max_backoffs=1)
+    adapter = har.CosDNAAdapter(breaker=breaker, limiter=limiter, retries=0)
+    for _ in range(2):
+        assert get(adapter).status_code == 429
+    assert breaker.state == 'open'
+
+
+def test_breaker_stays_closed_on_404(har, monkeypatch):
+    monkeypatch.setattr(HTTPAdapter, 'send', respond(404))
+    breaker = har.CircuitBreaker(threshold=2)
+    adapter = har.CosDNAAdapter(breaker=breaker, retries=0)
+    for _ in range(3):
+        get(adapter)
+    assert breaker.state == 'closed'
+
+
+def test_per_object_replay_shares_limiter_and_breaker(isolated, standin,
+                                                      monkeypatch):
+    har = isolated
+    transport = har.CosDNA.transport
+    fetched = [(key, f'{standin.url}/eng/cosmetic_8f1a95.html')
+               for key in (1, 2)]
+    breaker = har.CircuitBreaker(threshold=1)
+    breaker.record(False)
+    transport.set_breaker(breaker)
+    assert har._per_object_sockets(fetched) == 0
+    assert standin.stats['requests'] == 0
+    assert breaker.stats['rejected'] == 2
+
+    acquired = []
+    limiter = har.RateLimiter()
+    monkeypatch.setattr(limiter, 'acquire', lambda: acquired.append(1))
+    transport.set_breaker(har.CircuitBreaker()).set_limiter(limiter)
+    assert har._per_object_sockets(fetched) == 2
+    assert len(acquired) == standin.stats['requests'] == 2